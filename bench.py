@@ -0,0 +1,816 @@
+"""
+ชุดทดสอบประสิทธิภาพ (benchmark / load test) แบบออฟไลน์สำหรับ main.py
+
+ขับ Slash Command handlers (play, poll + PollView callbacks, speak) และ Flask routes
+(/, /api/auth_status, /web_control/*) โดยใช้ของปลอม (fakes) ของ Discord, Spotify, Firestore,
+yt-dlp และ gTTS ที่ตั้งค่า latency ได้ แล้วรายงาน throughput, p50/p99 latency และการใช้หน่วยความจำ
+ที่ระดับ concurrency ต่างๆ เพื่อวัดผลของการเปลี่ยนแปลงใน main.py ก่อน deploy
+
+ตัวอย่าง:
+    python bench.py
+    python bench.py --concurrency 1 8 32 --requests 200 --spotify-latency 0.08
+    python bench.py --only web --json results.json
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import random
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+# ตัวแปรสภาพแวดล้อมขั้นต่ำที่ main.py ต้องการตอน import (ไม่ทับค่าที่ผู้ใช้ตั้งไว้)
+os.environ.setdefault("GUILD_ID", "1")
+os.environ.setdefault("FLASK_SECRET_KEY", "bench")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "discord_poke_bench.log"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("FIREBASE_CREDENTIALS_BASE64", "e30=") # "{}" ที่เข้ารหัส base64 เพื่อให้เรียก fake Firestore
+
+
+class Latency:
+    """ค่า latency (วินาที) ของแต่ละบริการปลอม ตั้งค่าจาก command line"""
+    discord = 0.03
+    spotify = 0.05
+    firestore = 0.02
+    ytdlp = 0.3
+    tts = 0.15
+
+
+# --- Fakes: Spotify ---
+class FakeSpotifyException(Exception):
+    def __init__(self, http_status=500, msg="fake"):
+        super().__init__(msg)
+        self.http_status = http_status
+
+
+class FakeSpotify:
+    """Spotify client ปลอม ทุกเมธอดบล็อกเธรดตาม latency เหมือนการเรียก HTTP ของ spotipy"""
+    def __init__(self, auth_manager=None):
+        self.auth_manager = auth_manager
+
+    def _call(self, result=None):
+        time.sleep(Latency.spotify)
+        return result
+
+    def current_user(self):
+        return self._call({"id": "bench"})
+
+    def track(self, uri):
+        return self._call({"name": "Bench Track", "artists": [{"name": "Bench Artist"}], "uri": uri, "duration_ms": 200000})
+
+    def playlist(self, playlist_id, **kwargs):
+        return self._call({"name": "Bench Playlist"})
+
+    def album(self, album_id):
+        return self._call({"name": "Bench Album", "tracks": self._page(album_id, 0, 50, total=12)})
+
+    @staticmethod
+    def _page(prefix, offset, limit, total=40):
+        # เพลงที่ id ซ้ำกันข้ามเพลย์ลิสต์ เพื่อให้แคชการจับคู่ถูกใช้งานด้วย
+        return {"total": total, "items": [
+            {"id": f"{prefix[-1:]}{n}", "name": f"Bench Song {n}", "artists": [{"name": "Bench Artist"}],
+             "duration_ms": 200000, "external_ids": {"isrc": f"BENCH{n:07d}"}}
+            for n in range(offset, min(offset + limit, total))]}
+
+    def playlist_items(self, playlist_id, limit=100, offset=0, **kwargs):
+        page = self._page(playlist_id, offset, limit)
+        page["items"] = [{"track": item} for item in page["items"]]
+        return self._call(page)
+
+    def album_tracks(self, album_id, limit=50, offset=0, **kwargs):
+        return self._call(self._page(album_id, offset, limit, total=12))
+
+    def tracks(self, ids, **kwargs):
+        return self._call({"tracks": [
+            {"id": track_id, "name": f"Bench Song {track_id[1:]}", "artists": [{"name": "Bench Artist"}],
+             "duration_ms": 200000, "external_ids": {"isrc": f"BENCH{int(track_id[1:]):07d}"}} for track_id in ids]})
+
+    def search(self, q, type="track", limit=1, **kwargs):
+        items = [
+            {"name": f"{q} {n}" if n else q, "artists": [{"name": "Bench Artist"}], "uri": f"spotify:track:bench{n}",
+             "duration_ms": 200000, "external_urls": {"spotify": f"https://open.spotify.com/track/{abs(hash((q, n))) % 10 ** 12}"}}
+            for n in range(limit)
+        ]
+        return self._call({"tracks": {"items": items}})
+
+    def devices(self):
+        return self._call({"devices": [{"id": "device-1", "is_active": True}]})
+
+    def start_playback(self, **kwargs):
+        return self._call()
+
+    def pause_playback(self, **kwargs):
+        return self._call()
+
+    def next_track(self, **kwargs):
+        return self._call()
+
+    def previous_track(self, **kwargs):
+        return self._call()
+
+    def current_playback(self, **kwargs):
+        return self._call({"is_playing": True, "progress_ms": 1000, "item": {"name": "Bench Track", "duration_ms": 200000}})
+
+    def recommendations(self, **kwargs):
+        return self._call({"tracks": []})
+
+
+class FakeSpotifyOAuth:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def set_cached_token(self, token_info):
+        self.token_info = token_info
+
+    def get_authorize_url(self):
+        return "https://accounts.spotify.com/authorize?bench=1"
+
+    def get_access_token(self, code):
+        time.sleep(Latency.spotify)
+        return {"access_token": "bench"}
+
+
+# --- Fakes: Firestore ---
+class FakeFirebaseError(Exception):
+    pass
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, store, path):
+        self._store = store
+        self._path = path
+
+    def get(self):
+        time.sleep(Latency.firestore)
+        with self._store.lock:
+            return FakeDocumentSnapshot(self._path[-1], self._store.documents.get(self._path))
+
+    def set(self, data, merge=False):
+        time.sleep(Latency.firestore)
+        with self._store.lock:
+            current = dict(self._store.documents.get(self._path) or {}) if merge else {}
+            current.update(data)
+            self._store.documents[self._path] = current
+
+    def update(self, data):
+        self.set(data, merge=True)
+
+    def delete(self):
+        time.sleep(Latency.firestore)
+        with self._store.lock:
+            self._store.documents.pop(self._path, None)
+
+
+class FakeCollectionReference:
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+
+    def document(self, doc_id):
+        return FakeDocumentReference(self._store, (self._name, str(doc_id)))
+
+    def get(self):
+        time.sleep(Latency.firestore)
+        with self._store.lock:
+            return [
+                FakeDocumentSnapshot(path[1], data)
+                for path, data in self._store.documents.items() if path[0] == self._name
+            ]
+
+    def stream(self):
+        return iter(self.get())
+
+
+class FakeFirestoreClient:
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+
+# --- Fakes: yt-dlp และ gTTS ---
+class FakeExtractorError(Exception):
+    pass
+
+
+class FakeYoutubeDL:
+    def __init__(self, options=None):
+        self.options = options or {}
+
+    def extract_info(self, url, download=False, **kwargs):
+        time.sleep(Latency.ytdlp)
+        video_id = str(abs(hash(url)) % 10 ** 11)
+        if url.startswith("ytsearch") and self.options.get("extract_flat"):
+            # ผลการค้นหาแบบ flat: ชื่อวิดีโอคือคำค้น (ให้ตัวจับคู่ของ Spotify ได้คะแนนสูง)
+            query = url.split(":", 1)[1].strip('"')
+            return {"_type": "playlist", "entries": [
+                {"id": video_id, "title": query, "duration": 200, "channel": "Bench Artist - Topic",
+                 "url": f"https://www.youtube.com/watch?v={video_id}"}]}
+        return {
+            "id": video_id,
+            "title": f"Bench {url[-16:]}",
+            "url": f"https://media.invalid/{video_id}.webm",
+            "duration": 200,
+            "webpage_url": url,
+        }
+
+
+class FakeGTTS:
+    def __init__(self, text, lang="en", **kwargs):
+        self.text = text
+
+    def save(self, filename):
+        time.sleep(Latency.tts)
+        with open(filename, "wb") as handle:
+            handle.write(b"\0" * 1024)
+
+    def write_to_fp(self, fp):
+        time.sleep(Latency.tts)
+        fp.write(b"\0" * 1024)
+
+
+def _install_fake_modules():
+    """ใส่โมดูลปลอมลงใน sys.modules ก่อน import main (main.py โหลดไลบรารีเหล่านี้แบบ lazy)"""
+    spotipy = types.ModuleType("spotipy")
+    spotipy.Spotify = FakeSpotify
+    spotipy.SpotifyOAuth = FakeSpotifyOAuth
+    spotipy.SpotifyClientCredentials = FakeSpotifyOAuth
+    spotipy.exceptions = types.SimpleNamespace(SpotifyException=FakeSpotifyException)
+    spotipy.oauth2 = types.SimpleNamespace(SpotifyOAuth=FakeSpotifyOAuth, SpotifyClientCredentials=FakeSpotifyOAuth)
+
+    yt_dlp = types.ModuleType("yt_dlp")
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    yt_dlp.utils = types.SimpleNamespace(ExtractorError=FakeExtractorError, DownloadError=FakeExtractorError)
+
+    gtts = types.ModuleType("gtts")
+    gtts.gTTS = FakeGTTS
+
+    fake_db = FakeFirestoreClient()
+    firestore = types.ModuleType("firebase_admin.firestore")
+    firestore.client = lambda: fake_db
+    firestore.DELETE_FIELD = object()
+    exceptions = types.ModuleType("firebase_admin.exceptions")
+    exceptions.FirebaseError = FakeFirebaseError
+    firebase_admin = types.ModuleType("firebase_admin")
+    firebase_admin.credentials = types.SimpleNamespace(Certificate=lambda data: data)
+    firebase_admin.initialize_app = lambda cred=None, **kwargs: None
+    firebase_admin.firestore = firestore
+    firebase_admin.exceptions = exceptions
+
+    sys.modules.update({
+        "spotipy": spotipy,
+        "yt_dlp": yt_dlp,
+        "gtts": gtts,
+        "firebase_admin": firebase_admin,
+        "firebase_admin.firestore": firestore,
+        "firebase_admin.exceptions": exceptions,
+    })
+    return fake_db
+
+
+# --- Fakes: Discord ---
+_ids = itertools.count(10 ** 17)
+
+
+class FakeUser:
+    def __init__(self, user_id, voice_channel=None):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.voice = types.SimpleNamespace(channel=voice_channel) if voice_channel else None
+
+    async def send(self, *args, **kwargs):
+        await asyncio.sleep(Latency.discord)
+
+
+class FakeMessage:
+    def __init__(self, content=None, embed=None, view=None, channel=None):
+        self.id = next(_ids)
+        self.channel = channel or types.SimpleNamespace(id=1)
+        self.content = content
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(Latency.discord)
+        self.__dict__.update(kwargs)
+        return self
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(Latency.discord)
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        await asyncio.sleep(Latency.discord)
+        self._done = True
+        self._interaction.sent.append(content)
+
+    async def send_autocomplete(self, choices):
+        await asyncio.sleep(Latency.discord)
+        self._done = True
+
+    async def send_modal(self, modal):
+        await asyncio.sleep(Latency.discord)
+        self._done = True
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(Latency.discord)
+        self._interaction.sent.append(content)
+        return FakeMessage(content=content, embed=kwargs.get("embed"), view=kwargs.get("view"))
+
+
+class FakeInteraction:
+    def __init__(self, user, data=None, message=None, guild_id=None):
+        import discord
+        self.id = next(_ids)
+        self.user = user
+        self.data = data or {}
+        self.message = message
+        self.guild_id = guild_id or int(os.environ["GUILD_ID"])
+        self.guild = None
+        self.channel = None
+        self.command = None
+        self.command_failed = False
+        self.created_at = discord.utils.utcnow()
+        self.type = discord.InteractionType.application_command
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.sent = []
+
+    async def original_response(self):
+        return FakeMessage()
+
+    async def edit_original_response(self, **kwargs):
+        await asyncio.sleep(Latency.discord)
+
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.name = "bench-voice"
+        self.members = []
+        self.guild = types.SimpleNamespace(id=int(os.environ["GUILD_ID"]))
+
+    async def send(self, *args, **kwargs):
+        await asyncio.sleep(Latency.discord)
+
+
+class FakeVoiceClient:
+    """Voice client ปลอม: เล่นเสร็จทันทีและเรียก after callback โดยไม่เปิด ffmpeg หรือ UDP"""
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self._playing = False
+        self._paused = False
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._playing
+
+    def is_paused(self):
+        return self._paused
+
+    def play(self, source, *, after=None, **kwargs):
+        self.source = source
+        cleanup = getattr(source, "cleanup", None)
+        if cleanup:
+            cleanup()
+        if after:
+            after(None)
+
+    def stop(self):
+        self._playing = False
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    async def disconnect(self, **kwargs):
+        pass
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+
+class FakeAudioSource:
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        self.volume = kwargs.get("volume", 1.0)
+
+    def read(self):
+        return b""
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+# --- ตัววัดผล ---
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _summarise(name, concurrency, latencies, elapsed, errors, rss_before_kb, heap_peak):
+    latencies.sort()
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before_kb,
+        "heap_peak_kb": heap_peak / 1024 if heap_peak is not None else None,
+    }
+
+
+def _start_heap_tracking(enabled):
+    if enabled:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+
+
+def _stop_heap_tracking(enabled):
+    if not enabled:
+        return None
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+async def _run_async_scenario(name, operation, concurrency, total, track_heap):
+    """รัน operation (coroutine function รับลำดับงาน) จำนวน total ครั้ง โดยมีงานพร้อมกันไม่เกิน concurrency"""
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    async def one(index):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await operation(index)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    _start_heap_tracking(track_heap)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    return _summarise(name, concurrency, latencies, elapsed, errors, rss_before, _stop_heap_tracking(track_heap))
+
+
+def _run_thread_scenario(name, operation, concurrency, total, track_heap):
+    """เหมือน _run_async_scenario แต่สำหรับ operation แบบ synchronous (Flask test client) ใช้ thread pool"""
+    from concurrent.futures import ThreadPoolExecutor
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def one(index):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            operation(index)
+        except Exception:
+            with lock:
+                errors += 1
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    _start_heap_tracking(track_heap)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    return _summarise(name, concurrency, latencies, elapsed, errors, rss_before, _stop_heap_tracking(track_heap))
+
+
+# --- Scenarios ---
+class BenchEnvironment:
+    """เตรียม main.py ให้ทำงานกับ fakes: loop ของบอทในเธรดพื้นหลัง, ผู้ใช้ที่เชื่อมโยงแล้ว และ voice client"""
+    def __init__(self, main):
+        self.main = main
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="bench-bot-loop", daemon=True)
+        self.thread.start()
+        main.bot.loop = self.loop # route ของ Flask ใช้ bot.loop ผ่าน run_coroutine_threadsafe
+        # ข้อผิดพลาดของ task พื้นหลัง (เช่น _play_next_in_queue ที่ถูก create_task) นับเป็น error ของ scenario
+        self.background_errors = 0
+        self.loop.set_exception_handler(self._on_background_error)
+        self.call(self._set_ready())
+
+        # แทนที่แหล่งเสียง FFmpeg ด้วยของปลอม (ไม่มี ffmpeg ในสภาพแวดล้อม benchmark)
+        main.discord.FFmpegPCMAudio = FakeAudioSource
+        main.discord.FFmpegOpusAudio = FakeAudioSource
+        main.discord.PCMVolumeTransformer = FakeAudioSource
+
+        self.voice_channel = FakeVoiceChannel(next(_ids))
+        # ช่องเสียงปลอมใช้เป็นช่องข้อความด้วย (บอทส่ง "กำลังเล่น" ฯลฯ ไปยังช่องที่หาได้จาก bot.get_channel)
+        main.bot.get_channel = lambda channel_id: self.voice_channel if channel_id == self.voice_channel.id else None
+        self.users = [FakeUser(next(_ids), self.voice_channel) for _ in range(64)]
+        for user in self.users:
+            main.spotify_users[user.id] = FakeSpotify()
+
+    async def _set_ready(self):
+        self.main.bot_ready.set()
+
+    def _on_background_error(self, loop, context):
+        self.background_errors += 1
+        loop.default_exception_handler(context)
+
+    async def _settle(self, timeout):
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+
+    def take_background_errors(self, timeout=5.0):
+        """รอ task พื้นหลังที่ค้างจาก scenario (ไม่เกิน timeout) แล้วคืนจำนวนข้อผิดพลาดที่ไม่มีใครรับตั้งแต่ครั้งก่อน"""
+        self.call(self._settle(timeout))
+        gc.collect() # ให้ task ที่ล้มเหลวถูกเก็บและรายงาน "Task exception was never retrieved"
+        self.call(asyncio.sleep(0))
+        errors, self.background_errors = self.background_errors, 0
+        return errors
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def user(self, index):
+        return self.users[index % len(self.users)]
+
+    def connect_voice(self):
+        self.main.voice_client = FakeVoiceClient(self.voice_channel)
+
+
+def discord_scenarios(env):
+    main = env.main
+
+    async def play(index):
+        interaction = FakeInteraction(env.user(index))
+        await main.play.callback(interaction, f"bench song {index % 10}")
+
+    async def play_voice(index):
+        # /play target:voice กับเพลย์ลิสต์ 40 เพลง/อัลบั้ม 12 เพลง (สลับกัน) ที่ต้องจับคู่กับ YouTube
+        env.connect_voice()
+        interaction = FakeInteraction(env.user(index))
+        kind = "playlist" if index % 2 else "album"
+        await main.play.callback(interaction, f"https://open.spotify.com/{kind}/bench{index % 7}", "voice")
+
+    async def speak(index):
+        env.connect_voice()
+        interaction = FakeInteraction(env.user(index))
+        await main.speak.callback(interaction, f"hello {index}", "en")
+
+    polls = {}
+
+    async def poll_vote(index):
+        # หนึ่งโพลล์ต่อ 50 โหวต เพื่อให้ทั้งการสร้างโพลล์และการโหวตถูกวัดผล
+        poll_number = index // 50
+        if poll_number not in polls:
+            creator = FakeInteraction(env.user(index))
+            await main.create_poll.callback(creator, f"Bench poll {poll_number}", "A, B, C, D")
+            polls[poll_number] = main.active_polls and max(main.active_polls)
+        poll_id = polls[poll_number]
+        message = FakeMessage()
+        message.id = poll_id
+        option = index % 4
+        interaction = FakeInteraction(
+            env.user(index),
+            data={"custom_id": f"poll_{poll_id}_{option}"},
+            message=message
+        )
+        view = main.PollView(poll_id, main.active_polls[poll_id]["question"], main.active_polls[poll_id]["options"])
+        await view._button_callback(interaction)
+
+    large_polls = {}
+
+    async def large_poll(index, mode):
+        # โพลล์ 60 ตัวเลือกต่อ 200 บัตร: multi ใช้เมนูเลือก, ranked ใช้ฟอร์มจัดอันดับและนับแบบ Instant-runoff
+        poll_number = (mode, index // 200)
+        if poll_number not in large_polls:
+            creator = FakeInteraction(env.user(index))
+            options = ", ".join(f"Option {i}" for i in range(60))
+            await main.create_poll.callback(creator, f"Bench {mode} poll {poll_number[1]}", options, mode)
+            large_polls[poll_number] = max(main.active_polls)
+        poll_id = large_polls[poll_number]
+        poll = main.active_polls[poll_id]
+        message = FakeMessage()
+        message.id = poll_id
+        view = main.PollView(poll_id, poll["question"], poll["options"], mode)
+        rng = random.Random(index)
+        if mode == "multi":
+            chunk = index % 3
+            values = [str(i) for i in rng.sample(range(chunk * 25, min(chunk * 25 + 25, 60)), 3)]
+            interaction = FakeInteraction(env.user(index), data={"custom_id": f"poll_select_{poll_id}_{chunk}", "values": values}, message=message)
+            await view._select_callback(interaction)
+        else:
+            interaction = FakeInteraction(env.user(index), message=message)
+            await view._record_ranking(interaction, ", ".join(str(i + 1) for i in rng.sample(range(60), 5)))
+            await view.update_poll_message(message) # วัดเวลานับคะแนนแบบ Instant-runoff ด้วย
+
+    async def poll_select(index):
+        await large_poll(index, "multi")
+
+    async def poll_ranked(index):
+        await large_poll(index, "ranked")
+
+    async def play_autocomplete(index):
+        # พิมพ์ทีละตัวอักษรเหมือนผู้ใช้จริง (ยาว 1-12 ตัวอักษร) เพื่อวัดทั้งคำขอที่ถูก debounce และที่ค้นหาจริง
+        interaction = FakeInteraction(env.user(index))
+        interaction.type = main.discord.InteractionType.autocomplete
+        await main.play_query_autocomplete(interaction, f"bench song {index % 10}"[:1 + index % 12])
+
+    return {"play": play, "play_voice": play_voice, "play_autocomplete": play_autocomplete, "speak": speak, "poll_vote": poll_vote,
+            "poll_select": poll_select, "poll_ranked": poll_ranked}
+
+
+def web_scenarios(env):
+    main = env.main
+    clients = {}
+
+    def client_for(index):
+        # หนึ่ง test client (หนึ่ง session) ต่อผู้ใช้ต่อเธรด
+        key = (threading.get_ident(), index % len(env.users))
+        client = clients.get(key)
+        if client is None:
+            client = main.app.test_client()
+            session_id = f"bench-session-{key[0]}-{key[1]}"
+            with client.session_transaction() as flask_session:
+                flask_session["session_id"] = session_id
+            main.web_logged_in_users[session_id] = env.user(index).id
+            clients[key] = client
+        return client
+
+    def get(path):
+        def operation(index):
+            env.connect_voice()
+            response = client_for(index).get(path)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{path} -> {response.status_code}")
+        return operation
+
+    def add(index):
+        response = client_for(index).post("/web_control/add", data={"url": f"https://youtu.be/bench{index}"})
+        if response.status_code >= 500:
+            raise RuntimeError(f"/web_control/add -> {response.status_code}")
+
+    def add_bulk(index):
+        urls = [f"https://youtu.be/bulk{index}-{n}" for n in range(10)] + ["not a url"]
+        response = client_for(index).post("/web_control/add_bulk", json={"urls": urls})
+        if response.status_code >= 500 or response.get_json()["added"] != 10:
+            raise RuntimeError(f"/web_control/add_bulk -> {response.status_code} {response.get_data(as_text=True)[:200]}")
+
+    etags = {}
+
+    def state(index):
+        # poll แบบเดียวกับเบราว์เซอร์: ส่ง If-None-Match ด้วย ETag ล่าสุดของแท็บนี้
+        env.connect_voice()
+        key = (threading.get_ident(), index % len(env.users))
+        headers = {"If-None-Match": etags[key]} if key in etags else {}
+        response = client_for(index).get("/api/state", headers=headers)
+        if response.status_code not in (200, 304):
+            raise RuntimeError(f"/api/state -> {response.status_code}")
+        etags[key] = response.headers["ETag"]
+
+    return {
+        "web_index": get("/"),
+        "web_auth_status": get("/api/auth_status"),
+        "web_add": add,
+        "web_add_bulk": add_bulk,
+        "web_play": get("/web_control/play"),
+        "web_pause": get("/web_control/pause"),
+        "web_stop": get("/web_control/stop"),
+        "web_skip": get("/web_control/skip"),
+        "web_previous": get("/web_control/previous"),
+        "web_volume_up": get("/web_control/volume_up"),
+        "web_now_playing": get("/api/now_playing"),
+        "web_state": state,
+    }
+
+
+def _print_table(results):
+    header = f"{'scenario':<18}{'conc':>6}{'reqs':>7}{'err':>5}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}{'rss+ KB':>10}{'heap KB':>10}"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        heap = f"{row['heap_peak_kb']:.0f}" if row["heap_peak_kb"] is not None else "-"
+        print(
+            f"{row['scenario']:<18}{row['concurrency']:>6}{row['requests']:>7}{row['errors']:>5}"
+            f"{row['throughput_rps']:>10.1f}{row['p50_ms']:>10.1f}{row['p99_ms']:>10.1f}"
+            f"{row['rss_growth_kb']:>10}{heap:>10}"
+        )
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark ของ command handlers และ web routes ใน main.py")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="ระดับ concurrency ที่จะทดสอบ")
+    parser.add_argument("--requests", type=int, default=100, help="จำนวน request ต่อ scenario ต่อระดับ concurrency")
+    parser.add_argument("--only", choices=["discord", "web"], help="รันเฉพาะกลุ่ม scenario")
+    parser.add_argument("--scenario", nargs="+", help="รันเฉพาะ scenario ที่ระบุชื่อ")
+    parser.add_argument("--discord-latency", type=float, default=Latency.discord)
+    parser.add_argument("--spotify-latency", type=float, default=Latency.spotify)
+    parser.add_argument("--firestore-latency", type=float, default=Latency.firestore)
+    parser.add_argument("--ytdlp-latency", type=float, default=Latency.ytdlp)
+    parser.add_argument("--tts-latency", type=float, default=Latency.tts)
+    parser.add_argument("--heap", action="store_true", help="วัด peak ของ Python heap ด้วย tracemalloc (มี overhead)")
+    parser.add_argument("--json", metavar="PATH", help="บันทึกผลลัพธ์เป็น JSON สำหรับเปรียบเทียบระหว่างเวอร์ชัน")
+    args = parser.parse_args(argv)
+
+    Latency.discord = args.discord_latency
+    Latency.spotify = args.spotify_latency
+    Latency.firestore = args.firestore_latency
+    Latency.ytdlp = args.ytdlp_latency
+    Latency.tts = args.tts_latency
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    _install_fake_modules()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="discord_poke_bench_")) # ไฟล์ชั่วคราว (เช่นไฟล์ TTS) ไม่ไปปนใน repo
+    import main
+    env = BenchEnvironment(main)
+
+    results = []
+    groups = []
+    if args.only in (None, "discord"):
+        groups.append(("async", discord_scenarios(env)))
+    if args.only in (None, "web"):
+        groups.append(("thread", web_scenarios(env)))
+
+    for kind, scenarios in groups:
+        for name, operation in scenarios.items():
+            if args.scenario and name not in args.scenario:
+                continue
+            for concurrency in args.concurrency:
+                if kind == "async":
+                    row = env.call(_run_async_scenario(name, operation, concurrency, args.requests, args.heap))
+                else:
+                    row = _run_thread_scenario(name, operation, concurrency, args.requests, args.heap)
+                row["errors"] += env.take_background_errors()
+                results.append(row)
+                print(f"  {name} @ {concurrency}: {row['throughput_rps']:.1f} req/s", file=sys.stderr)
+
+    _print_table(results)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as handle:
+            latency = {
+                "discord": Latency.discord, "spotify": Latency.spotify, "firestore": Latency.firestore,
+                "ytdlp": Latency.ytdlp, "tts": Latency.tts,
+            }
+            json.dump({"latency": latency, "results": results}, handle, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
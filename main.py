@@ -1,28 +1,111 @@
+import time
+_PROCESS_START = time.perf_counter() # เวลาเริ่มต้นโปรเซส ใช้สำหรับรายงานเวลาในการบูต
+
 import discord
 from discord.ext import commands
 from discord import app_commands
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from gtts import gTTS 
+from flask import Flask, Response, g, render_template, request, redirect, url_for, session, flash, jsonify
 import os
 import threading
 import logging
+import logging.handlers
+import queue as stdlib_queue
+import atexit
 import json
 import base64 
+import hashlib
+import importlib
+import contextlib
+import contextvars
+import functools
+import collections
+import io
+import shutil
+import bisect
+import heapq
+import array
+import urllib.parse
+import urllib.request
+import sys
+import traceback
+import tracemalloc
+import concurrent.futures
+import socket
+import hmac
+import re
+import shlex
+import subprocess
+import signal
 from dotenv import load_dotenv
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-import httpx
 import asyncio
-import yt_dlp
 import random
 
-# Firestore imports
-import firebase_admin
-from firebase_admin import credentials, firestore
-from firebase_admin import exceptions as firebase_exceptions 
 
-# ปิดข้อความรายงานบั๊กของ yt_dlp เพื่อไม่ให้แสดงในคอนโซล
-yt_dlp.utils.bug_reports_message = lambda: ''
+class _LazyModule:
+    """
+    ตัวแทนโมดูลที่จะ import จริงเมื่อมีการเข้าถึง attribute ครั้งแรก
+    ใช้กับไลบรารีที่ import ช้า (yt_dlp, gtts, spotipy, firebase_admin, httpx) เพื่อลดเวลา cold start
+    """
+    def __init__(self, name: str, on_load=None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock: # ป้องกันการ import ซ้อนกันจากหลายเธรด (event loop, Flask, voice)
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    if self._on_load:
+                        self._on_load(module)
+                    self._module = module
+                    _record_startup_phase(f"import {self._name}", time.perf_counter() - started)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def _configure_yt_dlp(module):
+    # ปิดข้อความรายงานบั๊กของ yt_dlp เพื่อไม่ให้แสดงในคอนโซล
+    module.utils.bug_reports_message = lambda: ''
+
+
+# ไลบรารีหนักๆ จะถูกโหลดเมื่อใช้งานครั้งแรกเท่านั้น
+yt_dlp = _LazyModule("yt_dlp", on_load=_configure_yt_dlp)
+gtts = _LazyModule("gtts")
+spotipy = _LazyModule("spotipy")
+httpx = _LazyModule("httpx")
+numpy = _LazyModule("numpy") # ใช้นับคะแนนโพลล์แบบจัดอันดับ
+
+# Firestore imports (โหลดแบบ lazy เช่นกัน)
+firebase_admin = _LazyModule("firebase_admin")
+firestore = _LazyModule("firebase_admin.firestore")
+firebase_exceptions = _LazyModule("firebase_admin.exceptions")
+
+# --- รายงานเวลาในการบูต ---
+# เก็บ (ชื่อขั้นตอน, ระยะเวลาเป็นวินาที) ตามลำดับที่เกิดขึ้น
+_startup_phases = []
+_startup_report_logged = False
+
+def _record_startup_phase(name: str, seconds: float):
+    """บันทึกระยะเวลาของขั้นตอนหนึ่งในการบูต (เฉพาะก่อนที่จะแสดงรายงาน)"""
+    if not _startup_report_logged:
+        _startup_phases.append((name, seconds))
+
+def _log_startup_report():
+    """แสดงรายงานสรุปว่าเวลาในการบูตถูกใช้ไปกับขั้นตอนใดบ้าง (แสดงครั้งเดียวต่อโปรเซส)"""
+    global _startup_report_logged
+    if _startup_report_logged:
+        return
+    _startup_report_logged = True
+    total = time.perf_counter() - _PROCESS_START
+    lines = [f"  {name:<32} {seconds * 1000:9.1f} ms" for name, seconds in _startup_phases]
+    logging.info("รายงานเวลาบูต (รวม %.1f ms):\n%s", total * 1000, "\n".join(lines))
+
+_record_startup_phase("module imports", time.perf_counter() - _PROCESS_START)
 
 # --- โหลดตัวแปรสภาพแวดล้อม ---
 load_dotenv()
@@ -46,47 +129,1101 @@ DISCORD_CLIENT_SECRET = os.getenv("DISCORD_CLIENT_SECRET")
 DISCORD_REDIRECT_URI = os.getenv("DISCORD_REDIRECT_URI")
 # Scopes ที่จำเป็นสำหรับ Discord OAuth2
 DISCORD_OAUTH_SCOPES = "identify guilds"
+# ตั้งเป็น 1 เพื่อบังคับซิงค์ Slash Commands ทุกครั้งที่บูต แม้นิยามคำสั่งจะไม่เปลี่ยนแปลง
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
+
+# --- Sharding / หลายโปรเซส ---
+# SHARD_PROCESSES > 1: โปรเซสหลักจะเป็น supervisor ที่รันเว็บ และสร้าง worker process ตามจำนวนนี้
+# แต่ละ worker รัน AutoShardedBot สำหรับ shard ชุดหนึ่ง และเปิด IPC server บน IPC_BASE_PORT + WORKER_INDEX
+SHARD_PROCESSES = max(1, int(os.getenv("SHARD_PROCESSES", "1")))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT") or (SHARD_PROCESSES if SHARD_PROCESSES > 1 else 0)) # 0 = ไม่ใช้ sharding
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.getenv("WORKER_INDEX") else None # ตั้งค่าโดย supervisor
+IPC_HOST = os.getenv("IPC_HOST", "127.0.0.1") # host ของบอทที่เว็บจะเชื่อมต่อไป
+IPC_BIND_HOST = os.getenv("IPC_BIND_HOST", IPC_HOST) # address ที่ IPC server ของบอท bind (เช่น 0.0.0.0 เมื่อเว็บอยู่คนละ container)
+IPC_BASE_PORT = int(os.getenv("IPC_BASE_PORT", "6100"))
+IPC_TIMEOUT = float(os.getenv("IPC_TIMEOUT", "10"))
+IPC_SECRET = os.getenv("IPC_SECRET", "") # จำเป็นสำหรับ RUN_MODE=bot และ IPC ที่ bind นอก loopback; RUN_MODE=all จะสุ่มค่าให้ worker หากไม่ได้ตั้งไว้
+# RUN_MODE: "all" = บอทและเว็บในโปรเซสเดียวกัน (ค่าเริ่มต้น)
+#           "bot" = บอทอย่างเดียว และเปิด IPC server ให้เว็บที่รันแยกส่งคำสั่งเข้ามา
+#           "web" = เว็บอย่างเดียว ไม่มีบอทในโปรเซส รันได้หลาย worker ด้วย `gunicorn main:app`
+#                   เซสชันอ่านจาก Firestore และคำสั่งควบคุมผู้เล่นส่งไปยังบอทผ่าน IPC
+RUN_MODE = os.getenv("RUN_MODE", "all").lower()
+IS_WEB_ONLY = RUN_MODE == "web"
+IS_SUPERVISOR = SHARD_PROCESSES > 1 and WORKER_INDEX is None and not IS_WEB_ONLY
+IS_WORKER = WORKER_INDEX is not None
+# ระยะเวลา (วินาที) ที่ web worker แคชผลการค้นหาเซสชัน -> ผู้ใช้จาก Firestore
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "60"))
+# เซสชันที่ยังไม่พบผู้ใช้ (ยังไม่ล็อกอิน) แคชไว้สั้นๆ เท่านั้น เพราะ callback การล็อกอินอาจไปลงที่ worker อื่น
+SESSION_NEGATIVE_CACHE_TTL = float(os.getenv("SESSION_NEGATIVE_CACHE_TTL", "2"))
 
 # --- Firebase Setup ---
 # ข้อมูลรับรอง Firebase ที่เข้ารหัส Base64 ควรอยู่ในตัวแปรสภาพแวดล้อม
 firebase_credentials_base64 = os.getenv("FIREBASE_CREDENTIALS_BASE64")
-db = None # กำหนด db เป็น None เริ่มต้น
-if not firebase_credentials_base64:
-    logging.error("FIREBASE_CREDENTIALS_BASE64 environment variable not set. Firestore will not work.")
-else:
+db = None # กำหนด db เป็น None เริ่มต้น (ถูกตั้งค่าโดย _init_firebase)
+_firebase_init_future = None # concurrent.futures.Future ของการเริ่มต้น Firebase
+_firebase_init_lock = threading.Lock()
+
+def _init_firebase():
+    """
+    เริ่มต้น Firebase Admin SDK และคืนค่า Firestore client (หรือ None หากล้มเหลว)
+    ทำงานในเธรดแยก เพราะการ import firebase_admin และการสร้าง client ใช้เวลานาน
+    """
+    global db
+    started = time.perf_counter()
+    if not firebase_credentials_base64:
+        logging.error("FIREBASE_CREDENTIALS_BASE64 environment variable not set. Firestore will not work.")
+        return None
     try:
         # ถอดรหัสข้อมูลรับรอง base64 และแยกวิเคราะห์ JSON
         decoded_credentials = base64.b64decode(firebase_credentials_base64).decode('utf-8')
-        cred = credentials.Certificate(json.loads(decoded_credentials))
+        cred = firebase_admin.credentials.Certificate(json.loads(decoded_credentials))
         firebase_admin.initialize_app(cred)
         db = firestore.client()
         logging.info("Firebase Admin SDK initialized successfully.")
     except Exception as e:
-        logging.error(f"ข้อผิดพลาดในการเริ่มต้น Firebase Admin SDK: {e}", exc_info=True)
+        logging.error("ข้อผิดพลาดในการเริ่มต้น Firebase Admin SDK: %s", e, exc_info=True)
         db = None # ตั้งค่า db เป็น None หากเริ่มต้นล้มเหลว
+    _record_startup_phase("firebase init (background)", time.perf_counter() - started)
+    return db
+
+def _start_firebase_init() -> concurrent.futures.Future:
+    """เริ่มการเริ่มต้น Firebase ในเธรดพื้นหลัง (ครั้งเดียวต่อโปรเซส) และคืนค่า Future ของผลลัพธ์"""
+    global _firebase_init_future
+    with _firebase_init_lock:
+        if _firebase_init_future is None:
+            future = concurrent.futures.Future()
+            threading.Thread(
+                target=lambda: future.set_result(_init_firebase()),
+                name="firebase-init",
+                daemon=True
+            ).start()
+            _firebase_init_future = future
+    return _firebase_init_future
+
+async def _get_firestore_db():
+    """
+    รอให้ Firebase เริ่มต้นเสร็จแล้วคืนค่า Firestore client (หรือ None)
+    ใช้ asyncio.wrap_future จึงเรียกได้จากทุก event loop (ทั้ง bot.loop และ loop ของ Flask)
+    """
+    return await asyncio.wrap_future(_start_firebase_init())
 
 # --- ตัวแปร Global ---
 # เก็บ Spotify client object สำหรับแต่ละ Discord user ID
 spotify_users = {}  # Key: Discord User ID, Value: Spotify client
 # เก็บการเชื่อมโยง Flask session ID กับ Discord user ID สำหรับการควบคุมผ่านเว็บ
+# ในโหมด RUN_MODE=web แต่ละ worker เก็บเฉพาะเซสชันที่ล็อกอินผ่านตัวเอง ที่เก็บกลางคือ Firestore (ดู get_web_session_user)
 web_logged_in_users = {}  # Key: Flask Session ID, Value: Discord User ID
 voice_client = None # Object สำหรับการจัดการการเชื่อมต่อช่องเสียงของ Discord
 queue = []  # คิวเพลงสำหรับเล่น (รองรับ YouTube/SoundCloud URL)
 volume = 1.0 # ระดับเสียงเริ่มต้น (0.0 ถึง 2.0)
+# เพลงที่กำลังเล่น: {"url": URL ที่ใช้เล่นซ้ำได้, "title": str, "duration": วินาทีหรือ None,
+#                 "track": ผลลัพธ์ของ _resolve_queue_entry, "source": TrackedAudioSource, "text_channel_id": int} หรือ None
+now_playing = None
+_shutting_down = False # True เมื่อเริ่มปิดบอท: ไม่รับคำสั่งใหม่และไม่เล่นเพลงถัดไป
+_inflight_interactions = 0 # จำนวน interaction ที่กำลังประมวลผล (รอให้เสร็จก่อนปิดบอท)
+_pending_firestore_calls = 0 # จำนวนการเรียก Firestore ที่ยังไม่เสร็จ (รอให้เสร็จก่อนปิดบอท)
 
 # --- ตัวแปร Global สำหรับระบบโพลล์ ---
-# Key: poll_message_id, Value: {"question": str, "options": list[str], "votes": {option_str: set[user_id]}}
+# Key: poll_message_id, Value: {"channel_id": int, "question": str, "options": list[str],
+#                              "mode": "single" | "multi" | "ranked", "ballots": PollBallots}
 active_polls = {}
 
 # --- ตั้งค่าการบันทึก Log ---
-logging.basicConfig(
-    level=logging.INFO, # ระดับ Log ขั้นต่ำที่แสดง
-    format='%(asctime)s:%(levelname)s:%(message)s', # รูปแบบของข้อความ Log
-    handlers=[
-        logging.FileHandler("bot.log"), # บันทึก Log ลงไฟล์
-        logging.StreamHandler() # แสดง Log ในคอนโซล
-    ]
-)
+# ทุกเธรด (event loop, voice, Flask) แค่ใส่ LogRecord ลงคิว ส่วนการ format และเขียนไฟล์/คอนโซล
+# ทำใน listener thread เพียงเธรดเดียว เพื่อไม่ให้การเขียน Log ไปหน่วง heartbeat ของ gateway หรือเธรดเสียง
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower() # "text" หรือ "json"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024))) # หมุนไฟล์เมื่อใหญ่เกินขนาดนี้ (0 = ปิด)
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight") # หมุนไฟล์ตามเวลา (รูปแบบเดียวกับ TimedRotatingFileHandler)
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "7"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+class _SizedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """หมุนไฟล์ Log ทั้งตามเวลา และเมื่อไฟล์มีขนาดเกิน max_bytes"""
+    def __init__(self, filename, max_bytes: int = 0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        self.stream.seek(0, 2)
+        return self.stream.tell() >= self.max_bytes
+
+    def rotation_filename(self, default_name):
+        # การหมุนตามขนาดอาจเกิดหลายครั้งในช่วงเวลาเดียวกัน จึงต่อท้ายด้วยลำดับเพื่อไม่ให้ทับไฟล์เดิม
+        name = super().rotation_filename(default_name)
+        candidate, index = name, 1
+        while os.path.exists(candidate):
+            candidate = f"{name}.{index}"
+            index += 1
+        return candidate
+
+class _JsonFormatter(logging.Formatter):
+    """จัดรูปแบบ Log เป็น JSON หนึ่งบรรทัดต่อหนึ่งเรคคอร์ด สำหรับส่งเข้าระบบรวบรวม Log"""
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "location": f"{record.module}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler ที่ไม่ format ข้อความในเธรดผู้เรียก (ต่างจาก QueueHandler.prepare ปกติ)
+    และทิ้งเรคคอร์ดแทนการบล็อกเมื่อคิวเต็ม (นับใน metric log_records_dropped_total)
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except stdlib_queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+def _setup_logging():
+    """ตั้งค่า logging แบบคิว และคืนค่า QueueListener ที่เริ่มทำงานแล้ว"""
+    if LOG_FORMAT == "json":
+        formatter = _JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s') # รูปแบบของข้อความ Log
+
+    file_handler = _SizedTimedRotatingFileHandler(
+        LOG_FILE,
+        max_bytes=LOG_MAX_BYTES,
+        when=LOG_ROTATE_WHEN,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8",
+        delay=True
+    ) # บันทึก Log ลงไฟล์
+    stream_handler = logging.StreamHandler() # แสดง Log ในคอนโซล
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = stdlib_queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    root_logger.addHandler(_NonBlockingQueueHandler(log_queue))
+    root_logger.setLevel(LOG_LEVEL) # ระดับ Log ขั้นต่ำที่แสดง
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # flush Log ที่ค้างอยู่ในคิวก่อนปิดโปรเซส
+    return listener
+
+log_listener = _setup_logging()
+
+# --- Metrics (รูปแบบ Prometheus) ---
+# Registry แบบ in-process สำหรับ counters, gauges และ latency histograms
+# เปิดให้ Prometheus ดึงข้อมูลผ่าน route /metrics ของ Flask App
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, labelvalues, extra=None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.extend(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+class _Metric:
+    """คลาสพื้นฐานของ metric ที่มี label (ปลอดภัยต่อการใช้งานจากหลายเธรด)"""
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"metric {self.name} ต้องการ labels {self.labelnames} แต่ได้รับ {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labelvalues, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labelvalues, extra)} {value}")
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    """ค่าที่เพิ่มขึ้นอย่างเดียว เช่น จำนวนคำสั่งที่ถูกเรียก"""
+    type_name = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        with self._lock:
+            return [("", key, None, value) for key, value in self._values.items()]
+
+class Gauge(_Metric):
+    """ค่าที่ขึ้นลงได้ เช่น ความยาวคิว; รองรับการอ่านค่าจากฟังก์ชันในตอน scrape"""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """ให้ค่าของ gauge (ที่ไม่มี label) มาจากการเรียก function ทุกครั้งที่ render"""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                return [("", (), None, float(self._function()))]
+            except Exception as e:
+                logging.warning("ไม่สามารถอ่านค่า gauge %s: %s", self.name, e)
+                return []
+        with self._lock:
+            return [("", key, None, value) for key, value in self._values.items()]
+
+class Histogram(_Metric):
+    """การกระจายของค่า (เช่น latency เป็นวินาที) แบ่งตาม buckets"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """จับเวลาบล็อกโค้ด; หากมี label ชื่อ status จะตั้งเป็น 'error' อัตโนมัติเมื่อเกิดข้อผิดพลาด"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            if "status" in self.labelnames:
+                labels["status"] = "error"
+            raise
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, state["counts"]):
+                    cumulative += count
+                    samples.append(("_bucket", key, {"le": repr(float(bound))}, cumulative))
+                samples.append(("_bucket", key, {"le": "+Inf"}, state["count"]))
+                samples.append(("_sum", key, None, state["sum"]))
+                samples.append(("_count", key, None, state["count"]))
+        return samples
+
+class MetricsRegistry:
+    """รวบรวม metrics ทั้งหมดของโปรเซส และ render เป็น Prometheus text exposition format"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} ถูกลงทะเบียนไปแล้ว")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics_list = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics_list) + "\n"
+
+metrics = MetricsRegistry()
+
+LOG_RECORDS_DROPPED = metrics.counter(
+    "log_records_dropped_total", "เรคคอร์ด log ที่ถูกทิ้งเพราะคิวของ logging เต็ม (LOG_QUEUE_SIZE)")
+
+COMMAND_LATENCY = metrics.histogram(
+    "discord_command_duration_seconds", "เวลาที่ใช้ในการประมวลผล Slash Command", ("command", "kind", "status"))
+COMPONENT_LATENCY = metrics.histogram(
+    "discord_component_duration_seconds", "เวลาที่ใช้ในการประมวลผลการกดปุ่ม/เมนู", ("component", "status"))
+YTDLP_EXTRACT_LATENCY = metrics.histogram(
+    "ytdlp_extract_duration_seconds", "เวลาที่ yt-dlp ใช้ในการดึงข้อมูลเพลง", ("status",))
+PLAY_NEXT_LATENCY = metrics.histogram(
+    "player_play_next_duration_seconds", "เวลาตั้งแต่เริ่ม _play_next_in_queue จนเริ่มเล่นเพลง", ("status",))
+SPOTIFY_CALL_LATENCY = metrics.histogram(
+    "spotify_api_duration_seconds", "เวลาที่ใช้ในการเรียก Spotify Web API", ("method", "status"))
+FIRESTORE_LATENCY = metrics.histogram(
+    "firestore_operation_duration_seconds", "เวลาที่ใช้ในการอ่าน/เขียน Firestore", ("operation", "status"))
+HTTP_REQUEST_LATENCY = metrics.histogram(
+    "http_request_duration_seconds", "เวลาที่ใช้ในการตอบ HTTP request ของเว็บ", ("endpoint", "method", "status"))
+QUEUE_DEPTH = metrics.gauge("player_queue_depth", "จำนวนเพลงที่รออยู่ในคิว")
+VOICE_SESSIONS = metrics.gauge("voice_sessions_active", "จำนวนการเชื่อมต่อช่องเสียงที่ใช้งานอยู่")
+ACTIVE_POLLS = metrics.gauge("polls_active", "จำนวนโพลล์ที่ยังทำงานอยู่")
+POLL_TALLY_LATENCY = metrics.histogram(
+    "poll_tally_duration_seconds", "เวลาที่ใช้นับคะแนนโพลล์แบบจัดอันดับ", ("mode",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+LINKED_SPOTIFY_USERS = metrics.gauge("spotify_linked_users", "จำนวนผู้ใช้ที่เชื่อมโยง Spotify ในหน่วยความจำ")
+
+# --- Tracing แบบ span ข้ามเธรด/event loop/โปรเซส ---
+# span ปัจจุบันถูกเก็บใน contextvar จึงตามไปกับ asyncio task และ asyncio.to_thread เอง
+# จุดที่ข้ามขอบเขต (Flask -> bot loop, เว็บ -> worker ผ่าน IPC, event loop -> executor) สร้าง span ลูกที่แยก
+# เวลารอคิว (queue_ms: ตั้งแต่ส่งงานจนงานเริ่มรัน) ออกจากเวลาทำงานจริง (exec_ms)
+# span ที่จบแล้วถูกส่งออกโดยเธรดเดียวในพื้นหลัง เป็นไฟล์ JSONL หรือ OTLP/HTTP (JSON) ไปยัง collector
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").lower() # "" = ปิด, "file" = JSONL ใน TRACE_FILE, "otlp" = POST ไปยัง TRACE_OTLP_ENDPOINT
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0")) # สัดส่วนของ request ที่เริ่ม trace ใหม่
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "discord-bot")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000")) # span ที่รอส่งออกเกินนี้จะถูกทิ้ง
+
+TRACE_SPANS = metrics.counter("trace_spans_total", "จำนวน span แยกตามผลการส่งออก", ("result",))
+
+_current_span = contextvars.ContextVar("trace_span", default=None)
+
+class Span:
+    """หนึ่งช่วงของงานใน trace; start_ns คือเวลาที่ส่งงาน และ exec_start_ns คือเวลาที่งานเริ่มรันจริง"""
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "exec_start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace_id: str, parent_id, name: str, queued_since_ns: int = None, attributes: dict = None):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.exec_start_ns = time.time_ns()
+        self.start_ns = queued_since_ns or self.exec_start_ns
+        self.end_ns = None
+        self.attributes = dict(attributes or {}, thread=threading.current_thread().name)
+        self.error = None
+
+    @property
+    def traceparent(self) -> str:
+        """หัวข้อ traceparent ตามมาตรฐาน W3C Trace Context สำหรับส่งต่อให้โปรเซสอื่น"""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+            "start_ns": self.start_ns, "end_ns": self.end_ns,
+            "queue_ms": round((self.exec_start_ns - self.start_ns) / 1e6, 3),
+            "exec_ms": round((self.end_ns - self.exec_start_ns) / 1e6, 3),
+            "attributes": self.attributes, "error": self.error,
+        }
+
+class _RemoteParent:
+    """span ต้นทางจากอีกโปรเซส (อ่านจาก traceparent)"""
+    __slots__ = ("trace_id", "span_id")
+
+    def __init__(self, trace_id: str, span_id: str):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+def parse_traceparent(value):
+    """อ่าน traceparent ("00-<trace id>-<span id>-<flags>") คืนค่า _RemoteParent หรือ None หากรูปแบบไม่ถูกต้อง/ไม่ถูกสุ่มเก็บ"""
+    parts = (value or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        if not int(parts[1], 16) or not int(parts[3], 16) & 1:
+            return None
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return _RemoteParent(parts[1].lower(), parts[2].lower())
+
+class Tracer:
+    """สร้าง span และส่งออกในเธรดพื้นหลัง (ไม่มีค่าใช้จ่ายเมื่อปิด tracing หรือไม่มี trace ที่กำลังทำงาน)"""
+    def __init__(self, export: str):
+        self.export = export
+        self._queue = stdlib_queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.export in ("file", "otlp")
+
+    def start(self, name: str, *, parent=None, root: bool = False, queued_since_ns: int = None, **attributes):
+        """
+        เริ่ม span ลูกของ parent (หรือ span ปัจจุบัน) และตั้งเป็น span ปัจจุบัน คืนค่า (span, token) หรือ (None, None)
+        root=True เริ่ม trace ใหม่ (ตาม TRACE_SAMPLE_RATE) เมื่อไม่มี parent
+        """
+        if not self.enabled:
+            return None, None
+        parent = parent or _current_span.get()
+        if parent is None:
+            if not root or random.random() >= TRACE_SAMPLE_RATE:
+                return None, None
+            span = Span(f"{random.getrandbits(128):032x}", None, name, queued_since_ns, attributes)
+        else:
+            span = Span(parent.trace_id, parent.span_id, name, queued_since_ns, attributes)
+        return span, _current_span.set(span)
+
+    def finish(self, span, token, error: BaseException = None):
+        if span is None:
+            return
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = repr(error)
+        _current_span.reset(token)
+        try:
+            self._queue.put_nowait(span)
+        except stdlib_queue.Full:
+            TRACE_SPANS.inc(result="dropped")
+            return
+        if self._thread is None:
+            self._start_exporter()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **kwargs):
+        """with tracer.span("ชื่องาน", key=value): ... (ไม่ทำอะไรเลยหากไม่มี trace ที่กำลังทำงาน)"""
+        span, token = self.start(name, **kwargs)
+        try:
+            yield span
+        except BaseException as e:
+            self.finish(span, token, e)
+            raise
+        self.finish(span, token)
+
+    def wrap_coroutine(self, name: str, coro, **attributes):
+        """ห่อ coroutine ที่จะส่งข้ามไปรันบน event loop อื่น เพื่อบันทึกเวลารอคิวของ loop นั้น"""
+        parent = _current_span.get() if self.enabled else None
+        if parent is None:
+            return coro
+        queued_since = time.time_ns()
+
+        async def traced():
+            with self.span(name, parent=parent, queued_since_ns=queued_since, **attributes):
+                return await coro
+        return traced()
+
+    def _start_exporter(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._export_loop, name="trace-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _export_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 512:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except stdlib_queue.Empty:
+                    break
+            self._export_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self, timeout: float = 2.0):
+        """รอจนส่งออก span ที่ค้างอยู่หมด (เรียกตอนปิดโปรเซส)"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _export_batch(self, batch: list):
+        try:
+            if self.export == "file":
+                with open(TRACE_FILE, "a", encoding="utf-8") as trace_file:
+                    trace_file.writelines(json.dumps(span.to_dict(), default=str) + "\n" for span in batch)
+            else:
+                body = json.dumps(_otlp_payload(batch), default=str).encode("utf-8")
+                otlp_request = urllib.request.Request(
+                    TRACE_OTLP_ENDPOINT, data=body, method="POST", headers={"Content-Type": "application/json"})
+                with urllib.request.urlopen(otlp_request, timeout=5) as response:
+                    response.read()
+            TRACE_SPANS.inc(len(batch), result="exported")
+        except Exception as e:
+            TRACE_SPANS.inc(len(batch), result="failed")
+            logging.warning("ส่งออก trace %s span ไม่สำเร็จ: %s", len(batch), e)
+
+def _otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+def _otlp_payload(batch: list) -> dict:
+    """แปลง span เป็น ExportTraceServiceRequest ของ OTLP/HTTP แบบ JSON"""
+    spans = []
+    for span in batch:
+        attributes = dict(span.attributes, queue_ms=(span.exec_start_ns - span.start_ns) / 1e6,
+                          exec_ms=(span.end_ns - span.exec_start_ns) / 1e6)
+        entry = {
+            "traceId": span.trace_id, "spanId": span.span_id, "name": span.name, "kind": 1,
+            "startTimeUnixNano": str(span.start_ns), "endTimeUnixNano": str(span.end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            entry["parentSpanId"] = span.parent_id
+        spans.append(entry)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_otlp_attribute("service.name", TRACE_SERVICE_NAME),
+                                    _otlp_attribute("process.pid", os.getpid())]},
+        "scopeSpans": [{"scope": {"name": "main"}, "spans": spans}],
+    }]}
+
+tracer = Tracer(TRACE_EXPORT)
+
+# --- Executor แยกตามประเภทงานที่บล็อก ---
+# งาน Spotify, Firestore, TTS, yt-dlp และไฟล์แคชมี worker ของตัวเอง แทนการใช้ default executor ของ asyncio ร่วมกัน
+# งานประเภทหนึ่งที่ช้าหรือมาพร้อมกันจำนวนมาก (เช่น yt-dlp ของเพลย์ลิสต์ยาว) จึงไม่แย่ง worker ของคำสั่งอย่าง /pause
+# ภายใน pool งานถูกหยิบตามลำดับความสำคัญ (high > normal > low) และจำกัดความยาวคิว:
+#   low ถูกปฏิเสธเมื่อคิวยาวถึงครึ่งหนึ่งของขีดจำกัด, normal และ high รับเสมอ แต่เมื่อคิวเต็มจะทิ้งงาน low ที่รออยู่ก่อน
+#   (งาน normal คือคำขอของผู้ใช้ เช่นเพลงถัดไปในคิว จึงต้องไม่หายไปเพราะคิวเต็ม)
+EXECUTOR_DEFAULTS = {  # ชื่อ pool: (จำนวน worker, ความยาวคิวสูงสุด) ปรับได้ด้วย EXECUTOR_<NAME>_WORKERS และ EXECUTOR_<NAME>_QUEUE
+    "spotify": (8, 64),
+    "firestore": (4, 128),
+    "tts": (2, 16),
+    "ytdlp": (4, 32),
+    "io": (2, 64),
+}
+WORK_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+EXECUTOR_QUEUE_DEPTH = metrics.gauge("executor_queue_depth", "จำนวนงานที่รอ worker แยกตาม pool", ("pool",))
+EXECUTOR_ACTIVE_WORKERS = metrics.gauge("executor_active_workers", "จำนวน worker ที่กำลังทำงานแยกตาม pool", ("pool",))
+EXECUTOR_WAIT_TIME = metrics.histogram(
+    "executor_wait_seconds", "เวลาที่งานรอในคิวก่อนได้ worker", ("pool", "priority"),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+EXECUTOR_REJECTED = metrics.counter(
+    "executor_rejected_total", "งานที่ไม่ถูกรับ (rejected) หรือถูกทิ้งออกจากคิว (shed) เพราะ pool เต็ม", ("pool", "priority", "reason"))
+
+class ExecutorSaturated(RuntimeError):
+    """pool ของงานประเภทนี้เต็ม งานจึงไม่ถูกรับหรือถูกทิ้งออกจากคิว"""
+
+# ลำดับความสำคัญของงานที่ถูกส่งเข้า executor จากโค้ดที่ทำงานภายใต้ context นี้ (ตามไปกับ asyncio task ที่สร้างภายใน)
+_work_priority = contextvars.ContextVar("work_priority", default="normal")
+
+@contextlib.contextmanager
+def work_priority(level: str):
+    """กำหนดลำดับความสำคัญของงาน executor ที่เกิดภายในบล็อก (รวมถึง task ที่สร้างภายในบล็อก)"""
+    token = _work_priority.set(level)
+    try:
+        yield
+    finally:
+        _work_priority.reset(token)
+
+class WorkloadExecutor:
+    """thread pool ของงานประเภทเดียว: คิวเรียงตามลำดับความสำคัญ, จำกัดความยาวคิว และบันทึก metrics ของคิวและ worker
+
+    worker ถูกสร้างเมื่อมีงานและไม่มี worker ว่าง จนครบ max_workers
+    contextvars ของผู้ส่งงาน (เช่น span ของ trace) ถูกคัดลอกไปใช้ในเธรดที่รันงาน
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(2, max_queue)
+        self._pending = [] # heap ของ (ลำดับความสำคัญ, ลำดับที่ส่ง, เวลาที่เข้าคิว, ชื่อระดับ, future, call)
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._workers = []
+        self._idle = 0
+        self._active = 0
+        self._keyed = {} # Key: queue_key ของงานที่ยังไม่เสร็จ, Value: future (ใช้ยกลำดับความสำคัญด้วย escalate())
+
+    def submit(self, function, *args, priority: str = "normal", queue_key=None, **kwargs) -> concurrent.futures.Future:
+        """ส่งงานเข้าคิว คืนค่า concurrent.futures.Future หรือโยน ExecutorSaturated หากเป็นงาน low และคิวยาวเกินไป
+        queue_key: ระบุงานเพื่อให้ผู้เรียกที่รอผลเดียวกันยกลำดับความสำคัญได้ภายหลังด้วย escalate()"""
+        future = concurrent.futures.Future()
+        call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+        with self._condition:
+            if priority == "low":
+                if len(self._pending) >= self.max_queue // 2:
+                    EXECUTOR_REJECTED.inc(pool=self.name, priority=priority, reason="rejected")
+                    raise ExecutorSaturated(f"executor {self.name} เต็ม ({len(self._pending)} งานรออยู่)")
+            elif len(self._pending) >= self.max_queue:
+                # ทิ้งงาน low ที่เข้าคิวล่าสุดเพื่อให้ที่งานที่สำคัญกว่า
+                self._shed_low()
+            self._sequence += 1
+            heapq.heappush(self._pending, (WORK_PRIORITIES[priority], self._sequence, time.perf_counter(), priority, future, call))
+            EXECUTOR_QUEUE_DEPTH.set(len(self._pending), pool=self.name)
+            if self._idle == 0 and len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name=f"pool-{self.name}-{len(self._workers)}", daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            else:
+                self._condition.notify()
+        if queue_key is not None:
+            self._keyed[queue_key] = future
+            future.add_done_callback(lambda done: self._keyed.pop(queue_key, None) if self._keyed.get(queue_key) is done else None)
+        return future
+
+    async def run(self, function, *args, priority: str = None, queue_key=None, **kwargs):
+        """รันงานใน pool และรอผลลัพธ์ (ลำดับความสำคัญเริ่มต้นมาจาก work_priority ของ context ปัจจุบัน)"""
+        return await asyncio.wrap_future(
+            self.submit(function, *args, priority=priority or _work_priority.get(), queue_key=queue_key, **kwargs))
+
+    def escalate(self, queue_key, priority: str) -> bool:
+        """ยกลำดับความสำคัญของงานที่ยังรออยู่ในคิว (ไม่ลดลง) คืนค่า True หากมีการเปลี่ยนแปลง"""
+        future = self._keyed.get(queue_key)
+        if future is None:
+            return False
+        level = WORK_PRIORITIES[priority]
+        with self._condition:
+            for index, entry in enumerate(self._pending):
+                if entry[4] is future:
+                    if level >= entry[0]:
+                        return False
+                    self._pending[index] = (level, entry[1], entry[2], priority, entry[4], entry[5])
+                    heapq.heapify(self._pending)
+                    return True
+        return False
+
+    def _shed_low(self):
+        # เรียกขณะถือ self._condition
+        low = [entry for entry in self._pending if entry[3] == "low"]
+        if not low:
+            return
+        entry = max(low, key=lambda item: item[1])
+        self._pending.remove(entry)
+        heapq.heapify(self._pending)
+        EXECUTOR_REJECTED.inc(pool=self.name, priority="low", reason="shed")
+        if entry[4].set_running_or_notify_cancel():
+            entry[4].set_exception(ExecutorSaturated(f"งานถูกทิ้งออกจากคิวของ executor {self.name}"))
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._idle += 1
+                    self._condition.wait()
+                    self._idle -= 1
+                _, _, enqueued_at, priority, future, call = heapq.heappop(self._pending)
+                EXECUTOR_QUEUE_DEPTH.set(len(self._pending), pool=self.name)
+                if not future.set_running_or_notify_cancel():
+                    continue # ผู้รอยกเลิกไปแล้วระหว่างอยู่ในคิว
+                self._active += 1
+                EXECUTOR_ACTIVE_WORKERS.set(self._active, pool=self.name)
+            EXECUTOR_WAIT_TIME.observe(time.perf_counter() - enqueued_at, pool=self.name, priority=priority)
+            try:
+                result = call()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self._condition:
+                    self._active -= 1
+                    EXECUTOR_ACTIVE_WORKERS.set(self._active, pool=self.name)
+
+executors = {
+    name: WorkloadExecutor(name, int(os.getenv(f"EXECUTOR_{name.upper()}_WORKERS", workers)),
+                           int(os.getenv(f"EXECUTOR_{name.upper()}_QUEUE", max_queue)))
+    for name, (workers, max_queue) in EXECUTOR_DEFAULTS.items()
+}
+
+async def run_in_thread(span_name: str, function, *args, executor: WorkloadExecutor = None, priority: str = None,
+                        queue_key=None, **kwargs):
+    """รัน function ใน executor ของงานประเภทนั้น (หรือ default executor ของ asyncio หากไม่ระบุ)
+    และบันทึก span ของงาน (แยกเวลารอ executor ออกจากเวลาทำงาน) เมื่อมี trace ที่กำลังทำงาน"""
+    call = functools.partial(function, *args, **kwargs)
+    if tracer.enabled and _current_span.get() is not None:
+        queued_since = time.time_ns()
+
+        def traced():
+            with tracer.span(span_name, queued_since_ns=queued_since):
+                return function(*args, **kwargs)
+        call = traced
+    if executor is None:
+        return await asyncio.to_thread(call)
+    return await executor.run(call, priority=priority, queue_key=queue_key)
+
+def _timed_call(histogram: Histogram, function, *args, labels: dict, **kwargs):
+    """เรียก function แบบ synchronous และบันทึกเวลาลง histogram (status = ok/error)"""
+    with histogram.time(status="ok", **labels):
+        return function(*args, **kwargs)
+
+def _timed_spotify_call(function, *args, **kwargs):
+    """เรียกเมธอดของ Spotify client พร้อมบันทึก latency ตามชื่อเมธอด"""
+    return _timed_call(SPOTIFY_CALL_LATENCY, function, *args, labels={"method": function.__name__}, **kwargs)
+
+# คำสั่งควบคุมการเล่นที่ผู้ใช้รอผลทันที ได้ลำดับความสำคัญสูงสุดใน executor ของ Spotify
+SPOTIFY_CONTROL_METHODS = {"start_playback", "pause_playback", "next_track", "previous_track", "devices"}
+
+async def _spotify_call(function, *args, **kwargs):
+    """เรียก Spotify API ในเธรดแยก (ไม่บล็อก event loop) พร้อมบันทึก latency"""
+    priority = "high" if function.__name__ in SPOTIFY_CONTROL_METHODS else None
+    return await run_in_thread(f"spotify.{function.__name__}", _timed_spotify_call, function, *args,
+                               executor=executors["spotify"], priority=priority, **kwargs)
+
+async def _firestore_call(operation: str, function, *args, **kwargs):
+    """เรียก Firestore ในเธรดแยก พร้อมบันทึก latency ตามประเภทการทำงาน (read/write/list)"""
+    global _pending_firestore_calls
+    _pending_firestore_calls += 1
+    try:
+        return await run_in_thread(
+            f"firestore.{operation}", _timed_call, FIRESTORE_LATENCY, function, *args,
+            labels={"operation": operation}, executor=executors["firestore"], **kwargs)
+    finally:
+        _pending_firestore_calls -= 1
+
+@contextlib.contextmanager
+def _track_inflight_interaction():
+    """นับ interaction ที่กำลังประมวลผล เพื่อให้การปิดบอทรอจนกว่าจะเสร็จ"""
+    global _inflight_interactions
+    _inflight_interactions += 1
+    try:
+        yield
+    finally:
+        _inflight_interactions -= 1
+
+
+# --- Single-flight: รวมคำขอที่ซ้ำกันขณะกำลังทำงาน ---
+# เมื่อมีคำขอ key เดียวกัน (เช่น ผู้ใช้, การทำงาน, อาร์กิวเมนต์) เข้ามาระหว่างที่ตัวแรกยังไม่เสร็จ
+# ตัวที่ตามมาจะรอผลลัพธ์ (หรือข้อผิดพลาด) ของตัวแรกแทนการเรียก Spotify/yt-dlp/Firestore ซ้ำ
+# ใช้ concurrent.futures.Future จึงแชร์ผลได้ทั้งระหว่าง event loop ต่างๆ และเธรดของ Flask
+SINGLEFLIGHT_CALLS = metrics.counter(
+    "singleflight_calls_total", "จำนวนการเรียกผ่าน single-flight (leader = ทำงานจริง, shared = ใช้ผลร่วม)", ("group", "role"))
+
+class SingleFlight:
+    """กลุ่มของการทำงานที่ต้องการรวมคำขอซ้ำ แยกตาม key"""
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {} # Key: key ของคำขอ, Value: concurrent.futures.Future ของตัวที่กำลังทำงาน
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        """คืนค่า (future, is_leader) ตัวแรกของ key จะเป็น leader และต้องตั้งค่าผลลัพธ์ให้ future"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                SINGLEFLIGHT_CALLS.inc(group=self.name, role="shared")
+                return future, False
+            future = self._calls[key] = concurrent.futures.Future()
+        SINGLEFLIGHT_CALLS.inc(group=self.name, role="leader")
+        return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _abandon(self, key, future):
+        """leader ถูกยกเลิก (เช่น wait_for หมดเวลา): ปล่อย key และยกเลิก future เพื่อให้ผู้รอเรียกใหม่เอง
+        แทนที่จะได้ CancelledError ของ leader ไปด้วย"""
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        future.cancel()
+
+    async def do(self, key, function, *args, **kwargs):
+        """เรียก coroutine function หนึ่งครั้งต่อ key ที่กำลังทำงานอยู่"""
+        while True:
+            future, is_leader = self._join(key)
+            if is_leader:
+                break
+            try:
+                # shield: ผู้รอที่ถูกยกเลิกต้องไม่ยกเลิกผลลัพธ์ที่ผู้อื่นรออยู่
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise # ผู้รอเองถูกยกเลิก
+                # leader ถูกยกเลิก: เริ่มใหม่ (ผู้รอตัวแรกที่กลับมาจะเป็น leader)
+        try:
+            result = await function(*args, **kwargs)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._abandon(key, future)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def do_sync(self, key, function, *args, **kwargs):
+        """เหมือน do() สำหรับโค้ดแบบ synchronous (เช่นเธรดของ Flask)"""
+        while True:
+            future, is_leader = self._join(key)
+            if is_leader:
+                break
+            try:
+                return future.result()
+            except concurrent.futures.CancelledError:
+                pass # leader ถูกยกเลิก: เริ่มใหม่
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._abandon(key, future)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+# กลุ่ม single-flight ของแต่ละประเภทงาน
+play_flight = SingleFlight("play") # (user, query) ของ /play
+spotify_control_flight = SingleFlight("spotify_control") # (user, เมธอด) ของ pause/resume/skip/previous
+spotify_link_flight = SingleFlight("spotify_link_status") # user ที่กำลังตรวจสอบโทเค็น
+ytdlp_flight = SingleFlight("ytdlp_extract") # URL ที่กำลังดึงข้อมูลด้วย yt-dlp
+firestore_read_flight = SingleFlight("firestore_read") # การอ่าน Firestore ที่ซ้ำกัน
+control_dispatch_flight = SingleFlight("control_dispatch") # คำสั่งจากเว็บที่ส่งไปยังบอท
+
+
+# --- Event-loop watchdog ---
+# ตรวจจับช่วงที่ event loop ถูกบล็อก (เช่นการเรียก API แบบ synchronous บน loop)
+# เธรด monitor จะจับ stack ของเธรด event loop ขณะที่ยังถูกบล็อกอยู่ เพื่อระบุโค้ดที่เป็นต้นเหตุ
+LOOP_WATCHDOG_ENABLED = os.getenv("LOOP_WATCHDOG", "0") == "1"
+LOOP_WATCHDOG_INTERVAL = float(os.getenv("LOOP_WATCHDOG_INTERVAL", "0.1")) # ความถี่ในการวัด (วินาที)
+LOOP_WATCHDOG_THRESHOLD = float(os.getenv("LOOP_WATCHDOG_THRESHOLD", "0.25")) # บล็อกนานเกินนี้จึงจับ stack
+LOOP_WATCHDOG_REPORT_INTERVAL = float(os.getenv("LOOP_WATCHDOG_REPORT_INTERVAL", "300")) # สรุปผู้กระทำผิดทุกกี่วินาที
+
+EVENT_LOOP_LAG = metrics.histogram(
+    "event_loop_lag_seconds", "ความล่าช้าของ event loop เทียบกับเวลาที่ควรตื่น", (),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+EVENT_LOOP_BLOCKED = metrics.counter(
+    "event_loop_blocked_total", "จำนวนครั้งที่ event loop ถูกบล็อกเกิน threshold แยกตามตำแหน่งโค้ด", ("site",))
+EVENT_LOOP_BLOCKED_SECONDS = metrics.counter(
+    "event_loop_blocked_seconds_total", "เวลารวมที่ event loop ถูกบล็อก แยกตามตำแหน่งโค้ด", ("site",))
+
+class EventLoopWatchdog:
+    """วัด lag ของ event loop อย่างต่อเนื่อง และบันทึกตำแหน่งโค้ดที่บล็อก loop นานเกิน threshold"""
+    def __init__(self, interval: float, threshold: float, report_interval: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._offenders = {} # Key: site, Value: {"count", "total", "max", "stack"}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """เริ่ม heartbeat บน loop, เธรด monitor และงานสรุปผลเป็นระยะ (เรียกจากภายใน loop)"""
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        loop.create_task(self._heartbeat())
+        loop.create_task(self._report_periodically())
+        threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True).start()
+        logging.info("Event-loop watchdog เริ่มทำงาน (threshold %.0f ms)", self.threshold * 1000)
+
+    def stop(self):
+        self._stop.set()
+
+    async def _heartbeat(self):
+        while not self._stop.is_set():
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            EVENT_LOOP_LAG.observe(max(0.0, now - expected))
+            self._last_tick = now
+
+    def _monitor(self):
+        stall_started = None
+        stall_site = None
+        while not self._stop.wait(self.interval / 2):
+            stalled_for = time.monotonic() - self._last_tick - self.interval
+            if stalled_for >= self.threshold:
+                if stall_started is None:
+                    # จับ stack ครั้งเดียวต่อการบล็อกหนึ่งครั้ง ขณะที่โค้ดต้นเหตุยังทำงานอยู่
+                    stall_started = self._last_tick
+                    stall_site = self._capture_offender()
+            elif stall_started is not None:
+                self._finish_stall(stall_site, self._last_tick - stall_started - self.interval)
+                stall_started = stall_site = None
+
+    def _capture_offender(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        site = self._site_for(stack)
+        with self._lock:
+            offender = self._offenders.setdefault(site, {"count": 0, "total": 0.0, "max": 0.0, "stack": None})
+            offender["stack"] = stack
+        logging.warning(
+            "Event loop ถูกบล็อกนานกว่า %.0f ms ที่ %s\n%s",
+            self.threshold * 1000, site, _LazyStackText(stack)
+        )
+        return site
+
+    @staticmethod
+    def _site_for(stack) -> str:
+        """เลือกเฟรมที่อยู่ในโค้ดของบอทที่ลึกที่สุด (หากไม่มี ใช้เฟรมที่ลึกที่สุด) เป็นตัวแทนต้นเหตุ"""
+        own_frames = [entry for entry in stack if entry.filename == __file__]
+        entry = (own_frames or list(stack))[-1]
+        return f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+
+    def _finish_stall(self, site, duration: float):
+        if site is None:
+            return
+        duration = max(duration, self.threshold)
+        with self._lock:
+            offender = self._offenders[site]
+            offender["count"] += 1
+            offender["total"] += duration
+            offender["max"] = max(offender["max"], duration)
+        EVENT_LOOP_BLOCKED.inc(site=site)
+        EVENT_LOOP_BLOCKED_SECONDS.inc(duration, site=site)
+
+    def worst_offenders(self, limit: int = 5):
+        """คืนค่ารายการ (site, สถิติ) เรียงตามเวลาบล็อกรวมจากมากไปน้อย"""
+        with self._lock:
+            items = [(site, dict(stats)) for site, stats in self._offenders.items()]
+        items.sort(key=lambda item: item[1]["total"], reverse=True)
+        return items[:limit]
+
+    async def _report_periodically(self):
+        while not self._stop.is_set():
+            await asyncio.sleep(self.report_interval)
+            offenders = self.worst_offenders()
+            if not offenders:
+                continue
+            lines = [
+                f"  {site}: {stats['count']} ครั้ง, รวม {stats['total'] * 1000:.0f} ms, นานสุด {stats['max'] * 1000:.0f} ms"
+                for site, stats in offenders
+            ]
+            logging.warning("โค้ดที่บล็อก event loop มากที่สุด:\n%s", "\n".join(lines))
+
+class _LazyStackText:
+    """ห่อ stack ไว้ให้ format เป็นข้อความเฉพาะตอนที่ listener ของ logging เขียน Log จริง"""
+    def __init__(self, stack):
+        self.stack = stack
+
+    def __str__(self):
+        return "".join(traceback.format_list(self.stack))
+
+loop_watchdog = EventLoopWatchdog(LOOP_WATCHDOG_INTERVAL, LOOP_WATCHDOG_THRESHOLD, LOOP_WATCHDOG_REPORT_INTERVAL) if LOOP_WATCHDOG_ENABLED else None
+
+
+class InstrumentedCommandTree(app_commands.CommandTree):
+    """CommandTree ที่บันทึกเวลาในการประมวลผลทุก Slash Command และ autocomplete ลง metrics"""
+    async def _call(self, interaction: discord.Interaction):
+        if _shutting_down and interaction.type is discord.InteractionType.application_command:
+            await interaction.response.send_message("⏳ บอทกำลังรีสตาร์ท โปรดลองอีกครั้งในอีกสักครู่", ephemeral=True)
+            return
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            with _track_inflight_interaction():
+                await super()._call(interaction)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            if interaction.command_failed:
+                status = "error"
+            command_name = _interaction_command_name(interaction)
+            kind = "autocomplete" if interaction.type is discord.InteractionType.autocomplete else "command"
+            COMMAND_LATENCY.observe(time.perf_counter() - started, command=command_name, kind=kind, status=status)
+
+# --- Fast path สำหรับ Slash Commands ---
+# Discord ให้เวลาตอบรับ interaction เพียง 3 วินาทีนับจากที่สร้าง คำสั่งที่ต้องเรียก API ภายนอก
+# จึงควร defer ทันที แล้วทำงานที่ช้าภายในงบเวลาของคำสั่ง (COMMAND_TIMEOUT) และตอบผ่าน followup
+INTERACTION_DEADLINE = 3.0
+INTERACTION_NEAR_DEADLINE = float(os.getenv("INTERACTION_NEAR_DEADLINE", "2.0")) # ตอบรับช้ากว่านี้ถือว่าเฉียด deadline
+COMMAND_TIMEOUT = float(os.getenv("COMMAND_TIMEOUT", "12")) # งบเวลาเริ่มต้นของงานหลัง defer (วินาที)
+
+INTERACTION_ACK_LATENCY = metrics.histogram(
+    "interaction_ack_seconds", "เวลาตั้งแต่ Discord สร้าง interaction จนบอทตอบรับ (defer)", ("command",),
+    buckets=(0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 5.0))
+INTERACTION_DEADLINE_TOTAL = metrics.counter(
+    "interaction_deadline_total", "ผลการตอบรับเทียบกับ deadline 3 วินาที (ok/near/missed)", ("command", "outcome"))
+COMMAND_TIMEOUTS = metrics.counter(
+    "command_timeouts_total", "จำนวนคำสั่งที่ทำงานเกินงบเวลาหลัง defer", ("command",))
+
+def _interaction_command_name(interaction: discord.Interaction) -> str:
+    command = interaction.command
+    return command.qualified_name if command else (interaction.data or {}).get("name", "unknown")
+
+async def acknowledge_interaction(interaction: discord.Interaction, *, ephemeral: bool = False) -> bool:
+    """
+    defer interaction ทันที และบันทึกว่าตอบรับทัน deadline หรือไม่
+    คืนค่า False หาก interaction หมดอายุไปแล้ว (Discord ตอบ Unknown interaction)
+    """
+    command_name = _interaction_command_name(interaction)
+    outcome = "ok"
+    try:
+        if not interaction.response.is_done():
+            await interaction.response.defer(ephemeral=ephemeral, thinking=True)
+    except discord.NotFound:
+        outcome = "missed"
+        logging.warning("ตอบรับคำสั่ง %s ไม่ทัน deadline (interaction %s หมดอายุ)", command_name, interaction.id)
+        return False
+    finally:
+        elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+        INTERACTION_ACK_LATENCY.observe(elapsed, command=command_name)
+        if outcome == "ok" and elapsed >= INTERACTION_DEADLINE:
+            outcome = "missed"
+        elif outcome == "ok" and elapsed >= INTERACTION_NEAR_DEADLINE:
+            outcome = "near"
+        INTERACTION_DEADLINE_TOTAL.inc(command=command_name, outcome=outcome)
+    return True
+
+async def run_deferred(interaction: discord.Interaction, work, *, ephemeral: bool = False, timeout: float = None):
+    """
+    ตอบรับ interaction ทันที แล้วรัน work() (coroutine function ที่ตอบกลับผ่าน interaction.followup เอง)
+    ภายในงบเวลา timeout หากเกินจะแจ้งผู้ใช้และบันทึกลง metrics
+    """
+    if not await acknowledge_interaction(interaction, ephemeral=ephemeral):
+        return
+    try:
+        await asyncio.wait_for(work(), timeout or COMMAND_TIMEOUT)
+    except asyncio.TimeoutError:
+        command_name = _interaction_command_name(interaction)
+        COMMAND_TIMEOUTS.inc(command=command_name)
+        logging.warning("คำสั่ง %s ใช้เวลาเกินงบ %.1f วินาที", command_name, timeout or COMMAND_TIMEOUT)
+        await interaction.followup.send("⌛ คำสั่งใช้เวลานานเกินไป โปรดลองอีกครั้ง", ephemeral=True)
 
 # --- ตั้งค่า Discord Bot ---
 # Intents ที่จำเป็นสำหรับบอท Discord
@@ -95,40 +1232,51 @@ intents.message_content = True
 intents.voice_states = True 
 intents.members = True 
 
-bot = commands.Bot(command_prefix="!", intents=intents) # สร้าง Instance ของบอท
+def _worker_shard_ids(worker_index: int) -> list:
+    """shard ที่ worker ลำดับนี้รับผิดชอบ (กระจายแบบ round-robin)"""
+    return list(range(worker_index, SHARD_COUNT, SHARD_PROCESSES))
+
+def _worker_for_guild(guild_id: int) -> int:
+    """ลำดับ worker ที่ดูแล guild นี้ (คำนวณ shard ตามสูตรของ Discord: (guild_id >> 22) % shard_count)"""
+    if not SHARD_COUNT or not guild_id:
+        return 0
+    return ((guild_id >> 22) % SHARD_COUNT) % SHARD_PROCESSES
+
+if SHARD_COUNT:
+    # แบ่ง gateway ออกเป็นหลาย shard; ใน worker process จะเชื่อมต่อเฉพาะ shard ของตัวเอง
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        tree_cls=InstrumentedCommandTree,
+        shard_count=SHARD_COUNT,
+        shard_ids=_worker_shard_ids(WORKER_INDEX) if IS_WORKER else None
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=InstrumentedCommandTree) # สร้าง Instance ของบอท
 tree = bot.tree # สำหรับการจัดการ Slash Commands
 bot_ready = asyncio.Event() # Event สำหรับส่งสัญญาณเมื่อบอทพร้อมใช้งานเต็มที่
+_bot_run_started = _PROCESS_START # เวลาที่เริ่มเรียก bot.run() (ตั้งค่าใหม่ใน __main__)
+
+# gauges ที่อ่านค่าจากสถานะปัจจุบันทุกครั้งที่ scrape
+QUEUE_DEPTH.set_function(lambda: len(queue))
+VOICE_SESSIONS.set_function(lambda: sum(1 for vc in bot.voice_clients if vc.is_connected()))
+ACTIVE_POLLS.set_function(lambda: len(active_polls))
+LINKED_SPOTIFY_USERS.set_function(lambda: len(spotify_users))
 
 # --- ตั้งค่า Flask App ---
 app = Flask(__name__, static_folder="static", template_folder="templates") # สร้าง Instance ของ Flask App
 # คีย์ลับสำหรับ Flask session ควรตั้งค่าในไฟล์ .env เพื่อความปลอดภัย
 app.secret_key = os.getenv("FLASK_SECRET_KEY") or os.urandom(24) 
+if IS_WEB_ONLY and not os.getenv("FLASK_SECRET_KEY"):
+    # แต่ละ web worker จะสุ่มคีย์ของตัวเอง ทำให้คุกกี้เซสชันใช้ข้าม worker ไม่ได้
+    logging.warning("RUN_MODE=web แต่ไม่ได้ตั้งค่า FLASK_SECRET_KEY เซสชันจะใช้ได้เฉพาะ worker ที่สร้างมันเท่านั้น")
 
 # --- ฟังก์ชันช่วย (Helper Functions) ---
 
-def get_user_spotify_client(discord_user_id: int):
-    """
-    ดึง Spotify client สำหรับผู้ใช้ Discord
-    ตรวจสอบการหมดอายุของโทเค็นโดยพยายามเรียก API ง่ายๆ และลบออกหากไม่ถูกต้อง
-    """
-    sp_client = spotify_users.get(discord_user_id)
-    if sp_client:
-        try:
-            # ทดสอบว่าโทเค็นยังใช้ได้หรือไม่
-            sp_client.current_user() 
-            return sp_client
-        except spotipy.exceptions.SpotifyException as e:
-            logging.warning(f"Spotify token expired for user {discord_user_id}: {e}")
-            # ถ้าโทเค็นหมดอายุ ให้ลบออกจากแคชของเราและ Firestore
-            if discord_user_id in spotify_users:
-                del spotify_users[discord_user_id]
-                # ลบฟิลด์ spotify_token_info จาก Firestore
-                asyncio.run_coroutine_threadsafe(
-                    update_user_data_in_firestore(discord_user_id, spotify_token_info=firestore.DELETE_FIELD),
-                    bot.loop
-                ).result()
-            return None
-    return None
+async def forget_spotify_user(discord_user_id: int):
+    """ลบ Spotify client ที่โทเค็นใช้ไม่ได้แล้วออกจากแคชและ Firestore"""
+    if spotify_users.pop(discord_user_id, None) is not None:
+        await update_user_data_in_firestore(discord_user_id, spotify_token_info=firestore.DELETE_FIELD)
 
 async def update_user_data_in_firestore(discord_user_id: int, spotify_token_info: dict = None, flask_session_to_add: str = None, flask_session_to_remove: str = None):
     """
@@ -138,6 +1286,7 @@ async def update_user_data_in_firestore(discord_user_id: int, spotify_token_info
     :param flask_session_to_add: Flask session ID ที่จะเพิ่ม (เป็นทางเลือก)
     :param flask_session_to_remove: Flask session ID ที่จะลบ (เป็นทางเลือก)
     """
+    db = await _get_firestore_db()
     if db is None:
         logging.error("Firestore DB is not initialized. Cannot update user data.")
         return
@@ -146,10 +1295,10 @@ async def update_user_data_in_firestore(discord_user_id: int, spotify_token_info
     user_data_to_update = {}
 
     try:
-        doc = await asyncio.to_thread(user_ref.get)
+        doc = await _firestore_call("read", user_ref.get)
         current_data = doc.to_dict() if doc.exists else {}
     except firebase_exceptions.FirebaseError as e:
-        logging.error(f"Error fetching user {discord_user_id} data from Firestore: {e}", exc_info=True)
+        logging.error("Error fetching user %s data from Firestore: %s", discord_user_id, e, exc_info=True)
         return
 
     if spotify_token_info is not None: # ตรวจสอบว่าเป็น None จริงๆ (ไม่รวม firestore.DELETE_FIELD)
@@ -169,25 +1318,27 @@ async def update_user_data_in_firestore(discord_user_id: int, spotify_token_info
     if user_data_to_update: # อัปเดตเฉพาะเมื่อมีข้อมูลที่จะตั้งค่า
         try:
             # ใช้ set with merge=True เพื่ออัปเดตฟิลด์เฉพาะโดยไม่เขียนทับเอกสารทั้งหมด
-            await asyncio.to_thread(user_ref.set, user_data_to_update, merge=True)
-            logging.info(f"ข้อมูลผู้ใช้ {discord_user_id} อัปเดตใน Firestore แล้ว.")
+            await _firestore_call("write", user_ref.set, user_data_to_update, merge=True)
+            logging.info("ข้อมูลผู้ใช้ %s อัปเดตใน Firestore แล้ว.", discord_user_id)
         except firebase_exceptions.FirebaseError as e:
-            logging.error(f"ข้อผิดพลาดในการอัปเดตข้อมูลผู้ใช้ {discord_user_id} ใน Firestore: {e}", exc_info=True)
+            logging.error("ข้อผิดพลาดในการอัปเดตข้อมูลผู้ใช้ %s ใน Firestore: %s", discord_user_id, e, exc_info=True)
 
-async def load_all_user_data_from_firestore():
+async def load_all_user_data_from_firestore(include_spotify: bool = True):
     """
     โหลดข้อมูลผู้ใช้ทั้งหมด (โทเค็น Spotify, เซสชัน Flask) จาก Firestore เข้าสู่ตัวแปร global
     เพื่อฟื้นฟูสถานะเมื่อบอทเริ่มต้น
+    include_spotify=False ใช้ในโปรเซส supervisor ที่รันเฉพาะเว็บ จึงไม่ต้องสร้าง Spotify client
     """
     global spotify_users, web_logged_in_users 
 
+    db = await _get_firestore_db()
     if db is None:
         logging.warning("Firestore DB is not initialized. Cannot load user data.")
         return
 
     try:
         users_ref = db.collection('users')
-        docs = await asyncio.to_thread(users_ref.get) # ดึงเอกสารผู้ใช้ทั้งหมด
+        docs = await _firestore_call("list", users_ref.get) # ดึงเอกสารผู้ใช้ทั้งหมด
 
         for doc in docs:
             user_id = int(doc.id)
@@ -195,8 +1346,8 @@ async def load_all_user_data_from_firestore():
             
             # โหลดข้อมูลโทเค็น Spotify
             token_info = data.get('spotify_token_info')
-            if token_info:
-                auth_manager = SpotifyOAuth(
+            if token_info and include_spotify:
+                auth_manager = spotipy.SpotifyOAuth(
                     client_id=SPOTIPY_CLIENT_ID,
                     client_secret=SPOTIPY_CLIENT_SECRET,
                     redirect_uri=SPOTIPY_REDIRECT_URI,
@@ -206,15 +1357,15 @@ async def load_all_user_data_from_firestore():
                 sp_user = spotipy.Spotify(auth_manager=auth_manager)
                 try:
                     # ตรวจสอบโทเค็นโดยการเรียกใช้ API ง่ายๆ
-                    await asyncio.to_thread(sp_user.current_user)
+                    await _spotify_call(sp_user.current_user)
                     spotify_users[user_id] = sp_user
-                    logging.info(f"โหลดโทเค็น Spotify ที่ถูกต้องสำหรับผู้ใช้ ID: {user_id} จาก Firestore แล้ว")
+                    logging.info("โหลดโทเค็น Spotify ที่ถูกต้องสำหรับผู้ใช้ ID: %s จาก Firestore แล้ว", user_id)
                 except spotipy.exceptions.SpotifyException:
-                    logging.warning(f"โทเค็น Spotify สำหรับผู้ใช้ {user_id} หมดอายุเมื่อเริ่มต้น (Firestore) ลบออกจากแคชในเครื่อง.")
+                    logging.warning("โทเค็น Spotify สำหรับผู้ใช้ %s หมดอายุเมื่อเริ่มต้น (Firestore) ลบออกจากแคชในเครื่อง.", user_id)
                     # คุณอาจต้องการลบออกจาก Firestore ที่นี่ด้วยหากไม่ถูกต้องอย่างสม่ำเสมอ
                     # await update_user_data_in_firestore(user_id, spotify_token_info=firestore.DELETE_FIELD)
                 except Exception as e:
-                    logging.error(f"ข้อผิดพลาดในการตรวจสอบโทเค็น Spotify ที่โหลดสำหรับผู้ใช้ {user_id}: {e}", exc_info=True)
+                    logging.error("ข้อผิดพลาดในการตรวจสอบโทเค็น Spotify ที่โหลดสำหรับผู้ใช้ %s: %s", user_id, e, exc_info=True)
 
             # โหลด Flask sessions
             flask_sessions_list = data.get('flask_sessions', [])
@@ -223,30 +1374,33 @@ async def load_all_user_data_from_firestore():
             
         logging.info("โหลดข้อมูลผู้ใช้ทั้งหมด (โทเค็น Spotify และเซสชัน Flask) จาก Firestore แล้ว.")
     except firebase_exceptions.FirebaseError as e:
-        logging.error(f"ข้อผิดพลาดในการโหลดข้อมูลผู้ใช้ทั้งหมดจาก Firestore: {e}", exc_info=True)
+        logging.error("ข้อผิดพลาดในการโหลดข้อมูลผู้ใช้ทั้งหมดจาก Firestore: %s", e, exc_info=True)
     except Exception as e:
-        logging.error(f"ข้อผิดพลาดที่ไม่คาดคิดในการโหลดข้อมูลผู้ใช้จาก Firestore: {e}", exc_info=True)
+        logging.error("ข้อผิดพลาดที่ไม่คาดคิดในการโหลดข้อมูลผู้ใช้จาก Firestore: %s", e, exc_info=True)
 
 
 async def _check_spotify_link_status(discord_user_id: int) -> bool:
     """
     ตรวจสอบสถานะการเชื่อมโยง Spotify ของผู้ใช้
+    การตรวจสอบของผู้ใช้เดียวกันที่ซ้อนกัน (เช่น หลายแท็บเรียก /api/auth_status) จะใช้ผลลัพธ์ร่วมกัน
     """
+    return await spotify_link_flight.do(discord_user_id, _verify_spotify_link, discord_user_id)
+
+async def _verify_spotify_link(discord_user_id: int) -> bool:
+    """เรียก Spotify API เพื่อยืนยันว่าโทเค็นของผู้ใช้ยังใช้ได้ (ลบออกจากแคชหากหมดอายุ)"""
     sp_client = spotify_users.get(discord_user_id)
     if sp_client:
         try:
             # ทำการเรียก Spotify API เล็กน้อยเพื่อตรวจสอบโทเค็น
-            await asyncio.to_thread(sp_client.current_user)
+            await _spotify_call(sp_client.current_user)
             return True
         except spotipy.exceptions.SpotifyException as e:
-            logging.warning(f"ตรวจสอบโทเค็น Spotify ล้มเหลวสำหรับผู้ใช้ {discord_user_id}: {e}")
+            logging.warning("ตรวจสอบโทเค็น Spotify ล้มเหลวสำหรับผู้ใช้ %s: %s", discord_user_id, e)
             # หากโทเค็นหมดอายุ ให้ลบออกจากแคชและ Firestore
-            if discord_user_id in spotify_users:
-                del spotify_users[discord_user_id]
-                await update_user_data_in_firestore(discord_user_id, spotify_token_info=firestore.DELETE_FIELD)
+            await forget_spotify_user(discord_user_id)
             return False
         except Exception as e:
-            logging.error(f"ข้อผิดพลาดที่ไม่คาดคิดระหว่างการตรวจสอบโทเค็น Spotify สำหรับผู้ใช้ {discord_user_id}: {e}", exc_info=True)
+            logging.error("ข้อผิดพลาดที่ไม่คาดคิดระหว่างการตรวจสอบโทเค็น Spotify สำหรับผู้ใช้ %s: %s", discord_user_id, e, exc_info=True)
             return False
     return False
 
@@ -282,17 +1436,281 @@ async def _fetch_discord_token_and_user(code: str):
         user_data = user_response.json()
         return token_info, user_data
 
+# --- ปรับความดังให้เท่ากัน (Loudness normalisation) ---
+# วัด integrated loudness ของแต่ละเพลงครั้งเดียวด้วย ffmpeg loudnorm (ในพื้นหลัง ไม่หน่วงการเล่น)
+# แล้วแคช gain (dB) ตาม video ID การเล่นครั้งต่อไปจะใช้ filter volume แบบคงที่ซึ่งแทบไม่กิน CPU
+# แทนการรัน loudnorm แบบ real-time ทุกครั้ง
+AUDIO_NORMALIZE = os.getenv("AUDIO_NORMALIZE", "0") == "1"
+LOUDNESS_TARGET_LUFS = float(os.getenv("LOUDNESS_TARGET_LUFS", "-16"))
+LOUDNESS_CACHE_FILE = os.getenv("LOUDNESS_CACHE_FILE", "loudness_cache.json")
+LOUDNESS_MAX_GAIN_DB = 12.0 # ไม่ขยายเสียงเพลงที่เบามากเกินไป (ป้องกัน noise และ clipping)
+LOUDNESS_ANALYSIS_CONCURRENCY = int(os.getenv("LOUDNESS_ANALYSIS_CONCURRENCY", "1"))
+
+LOUDNESS_ANALYSIS_LATENCY = metrics.histogram(
+    "loudness_analysis_duration_seconds", "เวลาที่ใช้วัดความดังของเพลงหนึ่งเพลง", ("status",),
+    buckets=(1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0))
+LOUDNESS_GAIN_LOOKUPS = metrics.counter(
+    "loudness_gain_lookups_total", "การค้นหา gain ที่แคชไว้ตอนเริ่มเล่น (hit/miss)", ("result",))
+
+_loudness_gains = None # Key: video ID, Value: gain (dB) โหลดจากไฟล์เมื่อใช้ครั้งแรก
+_loudness_pending = set() # video ID ที่กำลังวัดอยู่
+_loudness_semaphore = None # จำกัดจำนวน ffmpeg ที่วัดความดังพร้อมกัน (สร้างบน bot loop)
+
+def _load_loudness_cache() -> dict:
+    global _loudness_gains
+    if _loudness_gains is None:
+        try:
+            with open(LOUDNESS_CACHE_FILE, "r", encoding="utf-8") as f:
+                _loudness_gains = json.load(f)
+        except FileNotFoundError:
+            _loudness_gains = {}
+        except (OSError, ValueError) as e:
+            logging.warning("ไม่สามารถอ่านแคชความดัง %s: %s", LOUDNESS_CACHE_FILE, e)
+            _loudness_gains = {}
+    return _loudness_gains
+
+def _write_json_atomic(path: str, data):
+    """เขียน JSON แบบ atomic (เขียนไฟล์ชั่วคราวแล้ว rename) เพื่อไม่ให้ไฟล์เสียหากโปรเซสหยุดกลางทาง"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+def _save_loudness_cache(gains: dict):
+    _write_json_atomic(LOUDNESS_CACHE_FILE, gains)
+
+def loudness_filter_options(video_id: str):
+    """คืนค่า options ของ ffmpeg สำหรับปรับ gain ของเพลงนี้ (หรือ None หากปิดใช้งานหรือยังไม่ได้วัด)"""
+    if not AUDIO_NORMALIZE or not video_id:
+        return None
+    gain = _load_loudness_cache().get(video_id)
+    LOUDNESS_GAIN_LOOKUPS.inc(result="miss" if gain is None else "hit")
+    if gain is None:
+        return None
+    return f"-af volume={gain:.2f}dB"
+
+async def _measure_loudness(audio_url: str) -> float:
+    """ถอดรหัสทั้งเพลงผ่าน loudnorm (ไม่ส่งเสียงออก) และคืนค่า integrated loudness (LUFS)"""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-nostats", "-vn", "-i", audio_url,
+        "-af", f"loudnorm=I={LOUDNESS_TARGET_LUFS}:print_format=json", "-f", "null", "-",
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    output = stderr.decode("utf-8", errors="replace")
+    # loudnorm พิมพ์ผลเป็นบล็อก JSON ท้าย stderr
+    start = output.rfind("{")
+    if process.returncode != 0 or start == -1:
+        raise RuntimeError(f"ffmpeg loudnorm ล้มเหลว (exit {process.returncode})")
+    return float(json.loads(output[start:output.rfind("}") + 1])["input_i"])
+
+def schedule_loudness_analysis(video_id: str, audio_url: str):
+    """เริ่มวัดความดังของเพลงในพื้นหลัง หากเปิดใช้งานและยังไม่เคยวัด"""
+    if not AUDIO_NORMALIZE or not video_id or video_id in _loudness_pending or video_id in _load_loudness_cache():
+        return
+    _loudness_pending.add(video_id)
+    asyncio.create_task(_analyse_loudness(video_id, audio_url))
+
+async def _analyse_loudness(video_id: str, audio_url: str):
+    global _loudness_semaphore
+    if _loudness_semaphore is None:
+        _loudness_semaphore = asyncio.Semaphore(LOUDNESS_ANALYSIS_CONCURRENCY)
+    try:
+        async with _loudness_semaphore:
+            with LOUDNESS_ANALYSIS_LATENCY.time(status="ok"):
+                loudness = await _measure_loudness(audio_url)
+        if loudness == float("-inf"):
+            return # เงียบทั้งเพลง ไม่ต้องปรับ
+        gain = min(LOUDNESS_TARGET_LUFS - loudness, LOUDNESS_MAX_GAIN_DB)
+        gains = _load_loudness_cache()
+        gains[video_id] = round(gain, 2)
+        await run_in_thread("loudness.save", _save_loudness_cache, dict(gains), executor=executors["io"], priority="low")
+        logging.info("วัดความดังของ %s: %.1f LUFS (gain %.1f dB)", video_id, loudness, gain)
+    except Exception as e:
+        logging.warning("ไม่สามารถวัดความดังของ %s: %s", video_id, e)
+    finally:
+        _loudness_pending.discard(video_id)
+
+
+# --- แคชเสียงในเครื่อง ---
+# เพลงที่ถูกเล่นซ้ำบ่อยจะถูกเก็บเป็น Opus ใน Ogg (เล็ก และ ffmpeg อ่านได้เร็ว) ตาม video ID
+# ไฟล์ถูกเขียนเป็น output ที่สองของ ffmpeg ระหว่างที่สตรีมอยู่แล้ว (ไม่ต้องดาวน์โหลดแยก)
+# และจะถูกเก็บเข้าแคชเฉพาะเมื่อเล่นจนจบเพลงเท่านั้น การเล่นครั้งต่อไปอ่านจากดิสก์แทนการสตรีมใหม่
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "") # ว่าง = ปิดใช้งาน
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+AUDIO_CACHE_BITRATE = os.getenv("AUDIO_CACHE_BITRATE", "96k")
+
+AUDIO_CACHE_LOOKUPS = metrics.counter("audio_cache_lookups_total", "การค้นหาเพลงในแคชเสียง (hit/miss)", ("result",))
+AUDIO_CACHE_BYTES = metrics.gauge("audio_cache_bytes", "ขนาดรวมของไฟล์ในแคชเสียง")
+
+# ดึง video ID จากลิงก์ YouTube ได้โดยไม่ต้องเรียก yt-dlp
+_YOUTUBE_ID_PATTERN = re.compile(r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/)|youtu\.be/)([A-Za-z0-9_-]{11})")
+
+class AudioCache:
+    """แคชไฟล์ Ogg/Opus ขนาดจำกัด ลบไฟล์ที่ไม่ได้เล่นนานที่สุดก่อน (LRU ตาม mtime)"""
+    STALE_PART_SECONDS = 6 * 3600 # ไฟล์ .part ที่ค้างนานกว่านี้ถือว่าถูกทิ้ง (เช่นโปรเซสตายกลางเพลง)
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _paths(self, video_id: str):
+        base = os.path.join(self.directory, video_id)
+        return f"{base}.ogg", f"{base}.json"
+
+    def lookup(self, url: str, video_id: str = None):
+        """คืนค่าข้อมูลเพลงที่แคชไว้ {"audio_url", "title", "webpage_url", "id"} หรือ None"""
+        if not video_id:
+            match = _YOUTUBE_ID_PATTERN.search(url)
+            video_id = match.group(1) if match else None
+        if not video_id:
+            return None
+        audio_path, meta_path = self._paths(video_id)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            os.utime(audio_path) # อัปเดตเวลาใช้งานล่าสุดสำหรับ LRU
+        except (OSError, ValueError):
+            AUDIO_CACHE_LOOKUPS.inc(result="miss")
+            return None
+        AUDIO_CACHE_LOOKUPS.inc(result="hit")
+        return {"audio_url": audio_path, "title": meta.get("title", "Unknown Title"),
+                "webpage_url": meta.get("webpage_url") or url, "id": video_id, "duration": meta.get("duration")}
+
+    def begin_write(self, video_id: str):
+        """
+        คืนค่า (path ของไฟล์ชั่วคราว, options ของ ffmpeg) ที่เพิ่ม output Ogg/Opus ก่อน output PCM ของ discord.py
+        FFmpegPCMAudio ใส่ "-f s16le -ar 48000 -ac 2" ไว้ก่อน options จึงต้องระบุ -f ogg ซ้ำให้ output แรก
+        แล้วกำหนด format ของ PCM (pipe:1) อีกครั้งหลังชื่อไฟล์
+        """
+        part_path = os.path.join(self.directory, f"{video_id}.{os.getpid()}.{os.urandom(4).hex()}.part")
+        options = (f"-map 0:a:0 -c:a libopus -b:a {AUDIO_CACHE_BITRATE} -f ogg {shlex.quote(part_path)} "
+                   f"-map 0:a:0 -f s16le -ar 48000 -ac 2")
+        return part_path, options
+
+    def finish_write(self, part_path: str, track: dict, completed: bool):
+        """ย้ายไฟล์ชั่วคราวเข้าแคชหากเล่นจนจบ ไม่เช่นนั้นลบทิ้ง (เรียกจากเธรดแยก)"""
+        try:
+            if not completed or os.path.getsize(part_path) == 0:
+                os.remove(part_path)
+                return
+            audio_path, meta_path = self._paths(track["id"])
+            with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump({"title": track["title"], "webpage_url": track["webpage_url"], "duration": track.get("duration")}, f)
+            os.replace(part_path, audio_path)
+            os.replace(f"{meta_path}.tmp", meta_path)
+            logging.info("เก็บ %s (%s) เข้าแคชเสียงแล้ว", track["id"], track["title"])
+        except OSError as e:
+            logging.warning("ไม่สามารถเก็บ %s เข้าแคชเสียง: %s", track.get("id"), e)
+        self.evict()
+
+    def evict(self):
+        """ลบไฟล์ที่ใช้งานล่าสุดนานที่สุดจนขนาดรวมไม่เกิน max_bytes และลบไฟล์ .part ที่ค้าง"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for entry in os.scandir(self.directory):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(".part"):
+                    if now - stat.st_mtime > self.STALE_PART_SECONDS:
+                        with contextlib.suppress(OSError):
+                            os.remove(entry.path)
+                elif entry.name.endswith(".ogg"):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for stale_path in (path, path[:-len(".ogg")] + ".json"):
+                    with contextlib.suppress(OSError):
+                        os.remove(stale_path)
+                total -= size
+            self.total_bytes = total
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES) if AUDIO_CACHE_DIR else None
+if audio_cache:
+    AUDIO_CACHE_BYTES.set_function(lambda: audio_cache.total_bytes)
+    threading.Thread(target=audio_cache.evict, name="audio-cache-scan", daemon=True).start() # คำนวณขนาดเริ่มต้น
+
+
+class TrackedAudioSource(discord.AudioSource):
+    """
+    แหล่งเสียงที่นับจำนวนเฟรม (20ms) ที่ส่งออกไปแล้ว เพื่อรู้ตำแหน่งที่กำลังเล่นอย่างแม่นยำ (ไม่นับช่วงที่หยุดชั่วคราว)
+    และห่อด้วย PCMVolumeTransformer เพื่อให้ปรับระดับเสียงระหว่างเล่นได้
+    """
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, original: discord.AudioSource, volume: float = 1.0, start_offset: float = 0.0):
+        self._inner = discord.PCMVolumeTransformer(original, volume=volume)
+        self.start_offset = start_offset
+        self.frames = 0
+        self.finished = False # True เมื่อ ffmpeg ส่งเสียงหมดแล้ว (เล่นจนจบ ไม่ใช่ถูกหยุด)
+        self.replaced = False # True เมื่อถูกหยุดเพื่อเล่นเพลงเดิมจากตำแหน่งใหม่ (seek) จึงไม่ต้องเล่นเพลงถัดไป
+        self.cache_write = None # (path ไฟล์ชั่วคราว, ข้อมูลเพลง) เมื่อกำลังเขียนเพลงนี้ลงแคชเสียง
+
+    @property
+    def volume(self) -> float:
+        return self._inner.volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._inner.volume = value
+
+    @property
+    def position(self) -> float:
+        """ตำแหน่งปัจจุบันในเพลง (วินาที)"""
+        return self.start_offset + self.frames * self.FRAME_SECONDS
+
+    def read(self) -> bytes:
+        data = self._inner.read()
+        if data:
+            self.frames += 1
+        else:
+            self.finished = True
+        return data
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        self._inner.cleanup()
+
 # ฟังก์ชัน Callback สำหรับหลังจากเล่นเสียงเสร็จสิ้น
-async def _after_playback_cleanup(error, channel_id):
+async def _after_playback_cleanup(error, channel_id, finished_source=None):
     """
     จัดการหลังจากเล่นเสียงเสร็จสิ้น, รวมถึงการจัดการข้อผิดพลาดและการเล่นเพลงถัดไปในคิว
     """
+    global now_playing
+    if finished_source is not None and finished_source.cache_write:
+        part_path, track = finished_source.cache_write
+        completed = finished_source.finished and not error
+        try:
+            executors["io"].submit(audio_cache.finish_write, part_path, track, completed)
+        except ExecutorSaturated as e:
+            logging.warning("ไม่สามารถบันทึกแคชเสียง %s: %s", part_path, e)
+    if _shutting_down:
+        return # หยุดเพราะกำลังปิดบอท สถานะถูกบันทึกไว้แล้ว ไม่ต้องเล่นเพลงถัดไป
+    if finished_source is not None and finished_source.replaced:
+        return # ถูกแทนที่ด้วยแหล่งเสียงใหม่ของเพลงเดิม (seek)
+    if now_playing and now_playing["source"] is finished_source:
+        now_playing = None
+
     if error:
-        logging.error(f"ข้อผิดพลาดในการเล่นเสียง: {error}")
+        logging.error("ข้อผิดพลาดในการเล่นเสียง: %s", error)
         channel = bot.get_channel(channel_id)
         if channel:
             await channel.send(f"❌ เกิดข้อผิดพลาดระหว่างเล่น: {error}")
     
+    # คิวหมดแล้ว: ต่อด้วยเพลงที่ autoplay เตรียมไว้ (หากเปิดใช้งาน)
+    if not queue and voice_client and voice_client.is_connected() and not voice_client.is_playing():
+        await _take_autoplay_track()
+
     # พยายามเล่นเพลงถัดไปในคิว
     if queue and voice_client and voice_client.is_connected() and not voice_client.is_playing():
         channel = bot.get_channel(channel_id)
@@ -305,8 +1723,172 @@ async def _after_playback_cleanup(error, channel_id):
             await channel.send("✅ เล่นเพลงในคิวทั้งหมดแล้ว!")
 
 
-async def _play_next_in_queue(channel: discord.VoiceChannel):
-    """เล่นเพลงถัดไปในคิว รองรับ URL ของ YouTube/SoundCloud"""
+# ตัวเลือกของ yt-dlp สำหรับดึง URL เสียงของเพลงในคิว (รองรับ YouTube, SoundCloud และอื่นๆ)
+YTDL_PLAYBACK_OPTIONS = {
+    'format': 'bestaudio/best', 
+    'default_search': 'ytsearch', 
+    'source_address': '0.0.0.0', 
+    'verbose': False, 
+    'noplaylist': True # ไม่ดึงเพลย์ลิสต์ทั้งหมดโดยอัตโนมัติหากไม่ได้ระบุอย่างชัดเจน
+}
+
+async def _ytdlp_shared(key: str, span_name: str, extract):
+    """
+    เรียก yt-dlp บน executor ของ yt-dlp โดยรวมคำขอที่ key ซ้ำกันผ่าน ytdlp_flight
+    ผู้ร่วมรอที่มีลำดับความสำคัญสูงกว่าผู้เริ่ม (เช่น ผู้ใช้ขอเล่น URL ที่ prefetch ของ autoplay กำลังรออยู่)
+    จะยกลำดับความสำคัญของงานที่ยังอยู่ในคิวขึ้นตาม
+    """
+    executors["ytdlp"].escalate(key, _work_priority.get())
+    return await ytdlp_flight.do(key, run_in_thread, span_name, extract, executor=executors["ytdlp"], queue_key=key)
+
+async def _resolve_queue_entry(url_to_play: str, channel) -> dict:
+    """
+    หา URL เสียงของรายการในคิว: จากแคชเสียงในเครื่องหากมี ไม่เช่นนั้นดึงด้วย yt-dlp
+    คืนค่า {"audio_url", "title", "webpage_url" (URL ที่ใช้เล่นซ้ำได้), "id", "duration" (วินาทีหรือ None), "cached"}
+    หากเป็นเพลย์ลิสต์ จะเพิ่มเพลงที่เหลือลงคิวและคืนค่าเพลงแรก
+    """
+    if audio_cache:
+        cached = audio_cache.lookup(url_to_play)
+        if cached:
+            return {**cached, "cached": True}
+    prefetched = _prefetched_tracks.pop(url_to_play, None)
+    if prefetched and time.monotonic() - prefetched[0] < AUTOPLAY_PREFETCH_TTL:
+        return prefetched[1]
+
+    # URL เดียวกันที่กำลังถูกดึงข้อมูลอยู่ (เช่น จากหลาย guild) จะรอผลลัพธ์เดียวกัน
+    info = await _ytdlp_shared(url_to_play, "ytdlp.extract", lambda: _timed_call(
+        YTDLP_EXTRACT_LATENCY, yt_dlp.YoutubeDL(YTDL_PLAYBACK_OPTIONS).extract_info, url_to_play, download=False, labels={}))
+
+    if info.get('_type') == 'playlist' and url_to_play.startswith("ytsearch"):
+        # ผลการค้นหา (เช่น เพลงแนะนำจาก Spotify) ใช้ผลลัพธ์แรกโดยไม่ถือเป็นเพลย์ลิสต์
+        selected_info = next((entry for entry in info.get('entries') or [] if entry and entry.get('url')), None)
+        if not selected_info:
+            raise Exception("ไม่พบผลการค้นหาที่สามารถเล่นได้.")
+    elif info.get('_type') == 'playlist':
+        playlist_title = info.get('title', 'Unknown Playlist')
+        if channel is not None: # ไม่มีช่องให้แจ้งเมื่อดึงข้อมูลล่วงหน้า
+            await channel.send(f"🎶 เพิ่มเพลย์ลิสต์: **{playlist_title}** ลงในคิว...")
+        
+        # เพิ่มวิดีโอทั้งหมดในเพลย์ลิสต์ลงในคิว
+        for entry in info.get('entries', []):
+            if entry and entry.get('url'):
+                queue.append(entry['url'])
+        
+        # ดึงข้อมูลของวิดีโอแรกสุดจากเพลย์ลิสต์เพื่อเล่น
+        selected_info = info.get('entries')[0] if info.get('entries') else None
+        if not selected_info or not selected_info.get('url'):
+            raise Exception("ไม่สามารถดึงวิดีโอแรกจากเพลย์ลิสต์ได้.")
+    elif info.get('url'): 
+        selected_info = info
+    else:
+        raise Exception("ไม่พบ URL เสียงที่สามารถเล่นได้.")
+
+    # เว็บไซต์ที่ไม่ใช่ YouTube จะรู้ video ID หลังดึงข้อมูลแล้วเท่านั้น
+    if audio_cache and selected_info.get('id'):
+        cached = audio_cache.lookup(url_to_play, video_id=selected_info['id'])
+        if cached:
+            return {**cached, "cached": True}
+
+    return {
+        "audio_url": selected_info['url'],
+        "title": selected_info.get('title', 'Unknown Title'),
+        "webpage_url": selected_info.get('webpage_url') or url_to_play,
+        "id": selected_info.get('id'),
+        "duration": selected_info.get('duration'),
+        "cached": False,
+    }
+
+def _start_track(channel, track: dict, start_at: float = 0.0) -> TrackedAudioSource:
+    """
+    เริ่ม ffmpeg สำหรับ track (ผลลัพธ์ของ _resolve_queue_entry) จากวินาทีที่ start_at และตั้งเป็นเพลงที่กำลังเล่น
+    """
+    global now_playing
+    # เตรียมแหล่งเสียง FFmpeg
+    # ต้องแน่ใจว่า ffmpeg สามารถเข้าถึงได้ใน PATH หรือระบุ path เต็ม
+    # -ss ก่อน input ทำให้ ffmpeg seek ที่ต้นทางแทนการถอดรหัสทิ้งตั้งแต่ต้นเพลง
+    before_options = f"-ss {start_at:.2f}" if start_at > 0 else None
+    options = loudness_filter_options(track["id"])
+    cache_write = None
+    # เขียนลงแคชเฉพาะเมื่อสตรีมตั้งแต่ต้นเพลง (ไฟล์ที่เริ่มกลางเพลงใช้เล่นซ้ำไม่ได้)
+    if audio_cache and not track["cached"] and track["id"] and start_at == 0:
+        part_path, cache_options = audio_cache.begin_write(track["id"])
+        options = f"{cache_options} {options or ''}".strip()
+        cache_write = (part_path, track)
+    source = TrackedAudioSource(
+        discord.FFmpegPCMAudio(track["audio_url"], executable="ffmpeg", before_options=before_options, options=options),
+        volume=volume,
+        start_offset=start_at
+    )
+    source.cache_write = cache_write
+    voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(
+        _after_playback_cleanup(e, channel.id, source), bot.loop))
+    now_playing = {"url": track["webpage_url"], "title": track["title"], "duration": track.get("duration"),
+                   "track": track, "source": source, "text_channel_id": channel.id}
+    return source
+
+def parse_timestamp(text: str) -> float:
+    """แปลงเวลาในรูปแบบ "90", "1:30" หรือ "1:02:03" เป็นวินาที (ValueError หากรูปแบบไม่ถูกต้อง)"""
+    parts = text.strip().split(":")
+    if not 1 <= len(parts) <= 3:
+        raise ValueError(text)
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    if seconds < 0:
+        raise ValueError(text)
+    return seconds
+
+def current_track_progress() -> dict:
+    """ความคืบหน้าของเพลงในคิวที่กำลังเล่น (สำหรับหน้าเว็บ) ตำแหน่งนับจากเฟรมที่ส่งออกไปจริง"""
+    if not now_playing or not voice_client or not voice_client.is_connected():
+        return {"status": "idle", "is_playing": False, "is_paused": False, "queue_length": len(queue), "volume": volume}
+    duration = now_playing.get("duration")
+    return {
+        "status": "ok",
+        "is_playing": voice_client.is_playing(),
+        "is_paused": voice_client.is_paused(),
+        "title": now_playing["title"],
+        "url": now_playing["url"],
+        "progress_ms": int(now_playing["source"].position * 1000),
+        "duration_ms": int(duration * 1000) if duration else None,
+        "volume": volume,
+        "queue_length": len(queue),
+    }
+
+def seek_current_track(position: float) -> float:
+    """
+    เล่นเพลงปัจจุบันใหม่จากวินาทีที่ position (ffmpeg seek ที่ input จึงไม่ต้องถอดรหัสตั้งแต่ต้น)
+    คืนค่าตำแหน่งที่เริ่มเล่นจริง หรือ ValueError หากไม่มีเพลงหรือตำแหน่งเกินความยาวเพลง
+    """
+    if not now_playing or not voice_client or not (voice_client.is_playing() or voice_client.is_paused()):
+        raise ValueError("ไม่มีเพลงในคิวที่กำลังเล่นอยู่")
+    duration = now_playing.get("duration")
+    if duration and position >= duration:
+        raise ValueError(f"ตำแหน่งเกินความยาวเพลง ({_format_seconds(duration)})")
+    was_paused = voice_client.is_paused()
+    old_source = now_playing["source"]
+    old_source.replaced = True
+    voice_client.stop()
+    channel = bot.get_channel(now_playing["text_channel_id"])
+    _start_track(channel, now_playing["track"], position)
+    if was_paused:
+        voice_client.pause()
+    logging.info("เลื่อนไปที่ %.1f วินาทีของ %s (จาก %.1f วินาที)", position, now_playing["title"], old_source.position)
+    return position
+
+def _format_seconds(seconds: float) -> str:
+    """แสดงวินาทีในรูปแบบ m:ss หรือ h:mm:ss"""
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+PLAY_RESOLVE_ATTEMPTS = 3 # จำนวนครั้งที่ลองดึงข้อมูลเพลงถัดไปเมื่องานใน executor ถูกทิ้งจากคิว
+
+async def _play_next_in_queue(channel: discord.VoiceChannel, start_at: float = 0.0):
+    """
+    เล่นเพลงถัดไปในคิว รองรับ URL ของ YouTube/SoundCloud
+    start_at: เริ่มเล่นจากวินาทีที่กำหนด (ใช้เมื่อเล่นต่อหลังรีสตาร์ท)
+    """
     global voice_client, queue, volume
 
     if not voice_client or not voice_client.is_connected():
@@ -316,71 +1898,53 @@ async def _play_next_in_queue(channel: discord.VoiceChannel):
     if voice_client.is_playing():
         voice_client.stop()
 
+    if not queue:
+        await _take_autoplay_track()
     if not queue:
         logging.info("คิวเพลงว่างเปล่า.")
         await channel.send("✅ เล่นเพลงในคิวทั้งหมดแล้ว!")
         return
 
     url_to_play = queue.pop(0) # ดึง URL ถัดไปจากคิว
-    logging.info(f"พยายามเล่นจากคิว: {url_to_play}")
+    logging.info("พยายามเล่นจากคิว: %s", url_to_play)
+    play_started = time.perf_counter()
     
-    # ตรวจสอบว่าเป็นลิงก์ YouTube/SoundCloud หรือไม่
-    # yt-dlp รองรับหลายแพลตฟอร์มรวมถึง YouTube และ SoundCloud
-    ydl_opts = {
-        'format': 'bestaudio/best', 
-        'default_search': 'ytsearch', 
-        'source_address': '0.0.0.0', 
-        'verbose': False, 
-        'noplaylist': True # ไม่ดึงเพลย์ลิสต์ทั้งหมดโดยอัตโนมัติหากไม่ได้ระบุอย่างชัดเจน
-    }
-
     try:
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(None, lambda: yt_dlp.YoutubeDL(ydl_opts).extract_info(url_to_play, download=False))
-        
-        audio_url = None
-        title = 'Unknown Title'
-
-        if info.get('_type') == 'playlist':
-            playlist_title = info.get('title', 'Unknown Playlist')
-            await channel.send(f"🎶 เพิ่มเพลย์ลิสต์: **{playlist_title}** ลงในคิว...")
-            
-            # เพิ่มวิดีโอทั้งหมดในเพลย์ลิสต์ลงในคิว
-            for entry in info.get('entries', []):
-                if entry and entry.get('url'):
-                    queue.append(entry['url'])
-            
-            # ดึงข้อมูลของวิดีโอแรกสุดจากเพลย์ลิสต์เพื่อเล่น
-            selected_info = info.get('entries')[0] if info.get('entries') else None
-            if not selected_info or not selected_info.get('url'):
-                raise Exception("ไม่สามารถดึงวิดีโอแรกจากเพลย์ลิสต์ได้.")
-            
-            audio_url = selected_info['url']
-            title = selected_info.get('title', 'Unknown Title')
-        elif info.get('url'): 
-            audio_url = info['url']
-            title = info.get('title', 'Unknown Title')
-        else:
-            raise Exception("ไม่พบ URL เสียงที่สามารถเล่นได้.")
+        for attempt in range(PLAY_RESOLVE_ATTEMPTS):
+            try:
+                track = await _resolve_queue_entry(url_to_play, channel)
+                break
+            except ExecutorSaturated as e:
+                # ผลของ yt-dlp ที่ใช้ร่วมกับงาน prefetch (ลำดับความสำคัญต่ำ) ถูกทิ้งจากคิว: ลองใหม่ในฐานะผู้เริ่มงานเอง
+                logging.warning("ดึงข้อมูล %s ไม่ได้ในตอนนี้ (ครั้งที่ %s): %s", url_to_play, attempt + 1, e)
+                if attempt + 1 == PLAY_RESOLVE_ATTEMPTS:
+                    raise
+                await asyncio.sleep(1)
         
-        # เตรียมแหล่งเสียง FFmpeg
-        # ต้องแน่ใจว่า ffmpeg สามารถเข้าถึงได้ใน PATH หรือระบุ path เต็ม
-        source = discord.FFmpegPCMAudio(audio_url, executable="ffmpeg")
-        voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(
-            _after_playback_cleanup(e, channel.id), bot.loop))
+        _start_track(channel, track, start_at)
+        title = track["title"]
+        schedule_loudness_analysis(track["id"], track["audio_url"])
+        schedule_autoplay_refill(track)
+        PLAY_NEXT_LATENCY.observe(time.perf_counter() - play_started, status="ok")
         
         await channel.send(f"🎶 กำลังเล่น: **{title}**")
 
+    except ExecutorSaturated:
+        # ลองครบแล้วยังไม่ได้: คืนเพลงกลับหัวคิว (ไม่ทิ้งเพลงของผู้ใช้) และให้ผู้ใช้สั่งเล่นต่อเอง
+        PLAY_NEXT_LATENCY.observe(time.perf_counter() - play_started, status="error")
+        queue.insert(0, url_to_play)
+        await channel.send(f"⏳ ระบบกำลังยุ่ง ยังเล่น {url_to_play} ไม่ได้ เพลงยังอยู่ในคิว ลองสั่งเล่นอีกครั้งภายหลัง")
     except yt_dlp.utils.ExtractorError as e:
+        PLAY_NEXT_LATENCY.observe(time.perf_counter() - play_started, status="error")
         error_message = str(e)
         if "Sign in to confirm you’re not a bot" in error_message or "requires login" in error_message or "age-restricted" in error_message or "unavailable in your country" in error_message:
             await channel.send(
                 f"❌ ไม่สามารถเล่น **{url_to_play}** ได้: วิดีโอนี้อาจต้องเข้าสู่ระบบ, ถูกจำกัดอายุ, หรือไม่พร้อมใช้งานในภูมิภาคของคุณ โปรดลองใช้วิดีโอสาธารณะอื่น."
             )
-            logging.warning(f"วิดีโอ YouTube/SoundCloud ถูกจำกัด: {url_to_play}")
+            logging.warning("วิดีโอ YouTube/SoundCloud ถูกจำกัด: %s", url_to_play)
         else:
             await channel.send(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิดในการเล่นสำหรับ {url_to_play}: {e}")
-            logging.error(f"ข้อผิดพลาดในการเล่นรายการ {url_to_play}: {e}", exc_info=True)
+            logging.error("ข้อผิดพลาดในการเล่นรายการ %s: %s", url_to_play, e, exc_info=True)
         # พยายามเล่นเพลงถัดไปในคิวโดยอัตโนมัติหากปัจจุบันล้มเหลว
         if queue and voice_client and voice_client.is_connected():
             await asyncio.sleep(1) # หน่วงเวลาเล็กน้อยก่อนลองเล่นเพลงถัดไป
@@ -388,7 +1952,8 @@ async def _play_next_in_queue(channel: discord.VoiceChannel):
         elif not queue:
             await channel.send("✅ เล่นเพลงในคิวทั้งหมดแล้ว!")
     except Exception as e: 
-        logging.error(f"ข้อผิดพลาดในการเล่นรายการ {url_to_play}: {e}", exc_info=True)
+        PLAY_NEXT_LATENCY.observe(time.perf_counter() - play_started, status="error")
+        logging.error("ข้อผิดพลาดในการเล่นรายการ %s: %s", url_to_play, e, exc_info=True)
         await channel.send(f"❌ ไม่สามารถเล่น: {url_to_play} ได้ เกิดข้อผิดพลาด: {e}")
         if queue and voice_client and voice_client.is_connected():
             await asyncio.sleep(1)
@@ -396,23 +1961,958 @@ async def _play_next_in_queue(channel: discord.VoiceChannel):
         elif not queue:
             await channel.send("✅ เล่นเพลงในคิวทั้งหมดแล้ว!")
 
-async def cleanup_audio(error, filename):
-    """ล้างไฟล์เสียง TTS หลังจากเล่น"""
+# --- Autoplay (โหมดวิทยุ) ---
+# เมื่อเปิดใช้งาน จะเตรียมเพลงที่เกี่ยวข้องกับเพลงที่กำลังเล่นไว้ล่วงหน้า AUTOPLAY_BUFFER_SIZE เพลง
+# แหล่งเพลง: YouTube Mix ของเพลงปัจจุบัน หรือเพลงแนะนำจาก Spotify ของผู้ใช้ที่เปิด autoplay (กรณีไม่ใช่ YouTube)
+# เพลงใน buffer ถูกดึง URL เสียงไว้แล้วในพื้นหลัง (จำกัดจำนวนพร้อมกัน) จึงเล่นต่อได้ทันทีเมื่อคิวหมด
+AUTOPLAY_DEFAULT = os.getenv("AUTOPLAY", "0") == "1"
+AUTOPLAY_BUFFER_SIZE = int(os.getenv("AUTOPLAY_BUFFER_SIZE", "3"))
+AUTOPLAY_PREFETCH_CONCURRENCY = int(os.getenv("AUTOPLAY_PREFETCH_CONCURRENCY", "2"))
+# URL เสียงของ YouTube หมดอายุหลังจากผ่านไประยะหนึ่ง จึงไม่ใช้ผลที่ดึงไว้นานเกินนี้
+AUTOPLAY_PREFETCH_TTL = float(os.getenv("AUTOPLAY_PREFETCH_TTL", "1800"))
+AUTOPLAY_HISTORY_SIZE = 50
+
+AUTOPLAY_PREFETCH = metrics.counter(
+    "autoplay_prefetch_total", "จำนวนเพลง autoplay ที่ดึงข้อมูลล่วงหน้า แยกตามแหล่งและผลลัพธ์", ("source", "status"))
+
+autoplay_enabled = AUTOPLAY_DEFAULT
+autoplay_user_id = None # ผู้ใช้ที่เปิด autoplay (ใช้เพลงแนะนำจาก Spotify ของผู้ใช้นี้)
+_autoplay_buffer = [] # URL ที่เตรียมไว้ตามลำดับ (ข้อมูลที่ดึงแล้วอยู่ใน _prefetched_tracks)
+_autoplay_history = collections.deque(maxlen=AUTOPLAY_HISTORY_SIZE) # video ID ที่เล่นหรือเตรียมไปแล้ว (กันเพลงซ้ำ)
+_autoplay_refill_task = None
+_prefetch_semaphore = None # สร้างบน bot loop เมื่อใช้ครั้งแรก
+_prefetched_tracks = {} # Key: URL, Value: (time.monotonic() ตอนดึง, ผลลัพธ์ของ _resolve_queue_entry)
+_PREFETCHED_TRACKS_MAX_ENTRIES = 500
+
+YTDL_RELATED_OPTIONS = {
+    'extract_flat': 'in_playlist', # ต้องการเพียงรายการ video ID ไม่ต้องดึง URL เสียงของทุกเพลง
+    'quiet': True,
+    'verbose': False,
+}
+
+def set_autoplay(enabled: bool, user_id: int = None):
+    """เปิด/ปิด autoplay; เมื่อปิดจะทิ้งเพลงที่เตรียมไว้ทั้งหมด"""
+    global autoplay_enabled, autoplay_user_id
+    autoplay_enabled = enabled
+    autoplay_user_id = user_id if enabled else None
+    if not enabled:
+        if _autoplay_refill_task and not _autoplay_refill_task.done():
+            _autoplay_refill_task.cancel()
+        for url in _autoplay_buffer:
+            _prefetched_tracks.pop(url, None)
+        _autoplay_buffer.clear()
+    elif now_playing:
+        schedule_autoplay_refill(now_playing["track"])
+
+async def _youtube_related_urls(video_id: str, limit: int) -> list:
+    """เพลงที่เกี่ยวข้องจาก YouTube Mix (เพลย์ลิสต์ RD<video ID>) ของเพลงนี้"""
+    mix_url = f"https://www.youtube.com/watch?v={video_id}&list=RD{video_id}"
+    options = {**YTDL_RELATED_OPTIONS, 'playlistend': limit + AUTOPLAY_HISTORY_SIZE // 5}
+    info = await _ytdlp_shared(mix_url, "ytdlp.related", lambda: _timed_call(
+        YTDLP_EXTRACT_LATENCY, yt_dlp.YoutubeDL(options).extract_info, mix_url, download=False, labels={}))
+    return [f"https://www.youtube.com/watch?v={entry['id']}"
+            for entry in info.get('entries') or [] if entry and entry.get('id') and entry['id'] not in _autoplay_history]
+
+async def _spotify_related_urls(user_id: int, title: str, limit: int) -> list:
+    """เพลงแนะนำจาก Spotify ของผู้ใช้ โดยใช้เพลงที่ค้นหาจากชื่อเพลงปัจจุบันเป็น seed (คืนค่าเป็นคำค้น ytsearch)"""
+    sp_user = spotify_users.get(user_id)
+    if not sp_user:
+        return []
+    results = await _spotify_call(sp_user.search, q=title, type="track", limit=1)
+    seeds = [item["id"] for item in results["tracks"]["items"]]
+    if not seeds:
+        return []
+    recommendations = await _spotify_call(sp_user.recommendations, seed_tracks=seeds, limit=limit)
+    return [f"ytsearch1:{', '.join(artist['name'] for artist in item['artists'])} - {item['name']}"
+            for item in recommendations["tracks"]]
+
+async def _prefetch_track(url: str, source: str):
+    """ดึง URL เสียงของเพลงล่วงหน้า (จำกัดจำนวนพร้อมกัน) คืนค่า URL หรือ None หากล้มเหลว"""
+    global _prefetch_semaphore
+    if _prefetch_semaphore is None:
+        _prefetch_semaphore = asyncio.Semaphore(AUTOPLAY_PREFETCH_CONCURRENCY)
+    try:
+        async with _prefetch_semaphore:
+            track = await _resolve_queue_entry(url, None)
+    except Exception as e:
+        AUTOPLAY_PREFETCH.inc(source=source, status="error")
+        logging.warning("ไม่สามารถเตรียมเพลง autoplay %s: %s", url, e)
+        return None
+    if track["id"] in _autoplay_history:
+        AUTOPLAY_PREFETCH.inc(source=source, status="duplicate")
+        return None
+    AUTOPLAY_PREFETCH.inc(source=source, status="ok")
+    if track["id"]:
+        _autoplay_history.append(track["id"])
+    store_prefetched_track(url, track)
+    return url
+
+def store_prefetched_track(url: str, track: dict):
+    """เก็บผลลัพธ์ของ _resolve_queue_entry ไว้ใช้ตอนเล่น URL นี้ (ล้างรายการที่หมดอายุเมื่อเก็บไว้มากเกินไป)"""
+    now = time.monotonic()
+    if len(_prefetched_tracks) >= _PREFETCHED_TRACKS_MAX_ENTRIES:
+        for key in [key for key, (fetched_at, _) in _prefetched_tracks.items() if now - fetched_at >= AUTOPLAY_PREFETCH_TTL]:
+            _prefetched_tracks.pop(key, None)
+        while len(_prefetched_tracks) >= _PREFETCHED_TRACKS_MAX_ENTRIES: # ยังเต็มอยู่: ทิ้งรายการที่เก่าที่สุด
+            _prefetched_tracks.pop(next(iter(_prefetched_tracks)))
+    _prefetched_tracks[url] = (now, track)
+
+async def _refill_autoplay_buffer(seed: dict):
+    """เติม buffer ให้ครบ AUTOPLAY_BUFFER_SIZE จากเพลงที่เกี่ยวข้องกับ seed"""
+    needed = AUTOPLAY_BUFFER_SIZE - len(_autoplay_buffer)
+    if needed <= 0:
+        return
+    try:
+        if seed.get("id") and _YOUTUBE_ID_PATTERN.search(seed["webpage_url"] or ""):
+            source, candidates = "youtube", await _youtube_related_urls(seed["id"], needed)
+        elif autoplay_user_id:
+            source, candidates = "spotify", await _spotify_related_urls(autoplay_user_id, seed["title"], needed)
+        else:
+            return
+    except Exception as e:
+        logging.warning("ไม่สามารถหาเพลงที่เกี่ยวข้องกับ %s: %s", seed.get("title"), e)
+        return
+    candidates = [url for url in candidates if url not in _autoplay_buffer and url not in queue][:needed]
+    # ดึงพร้อมกันแต่เก็บลง buffer ตามลำดับที่แนะนำ
+    for url in await asyncio.gather(*(_prefetch_track(url, source) for url in candidates)):
+        if url and autoplay_enabled:
+            _autoplay_buffer.append(url)
+    logging.info("autoplay เตรียมเพลงไว้ %s เพลง (จาก %s)", len(_autoplay_buffer), source)
+
+def schedule_autoplay_refill(seed: dict):
+    """เริ่มเติม buffer ของ autoplay ในพื้นหลังจากเพลงที่เพิ่งเริ่มเล่น (หากเปิดใช้งานและยังไม่มีงานเติมค้างอยู่)"""
+    global _autoplay_refill_task
+    if seed.get("id"):
+        _autoplay_history.append(seed["id"])
+    if not autoplay_enabled or (_autoplay_refill_task and not _autoplay_refill_task.done()):
+        return
+    with work_priority("low"): # งานเติม buffer ใช้ลำดับความสำคัญต่ำ ไม่แย่งคิวของเพลงที่ผู้ใช้ขอ
+        _autoplay_refill_task = asyncio.create_task(_refill_autoplay_buffer(seed))
+
+async def _take_autoplay_track():
+    """ย้ายเพลงแรกใน buffer ของ autoplay เข้าคิว (รองานเติม buffer ที่กำลังทำอยู่หาก buffer ยังว่าง)"""
+    if not autoplay_enabled:
+        return
+    if not _autoplay_buffer and _autoplay_refill_task and not _autoplay_refill_task.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(_autoplay_refill_task), COMMAND_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+    if _autoplay_buffer:
+        queue.append(_autoplay_buffer.pop(0))
+
+# --- เล่นเพลงจาก Spotify ในช่องเสียง ---
+# แปลงเพลง/อัลบั้ม/เพลย์ลิสต์ของ Spotify เป็นวิดีโอ YouTube ที่ตรงกันที่สุด (ISRC, ชื่อเพลง/ศิลปิน, ความยาว)
+# ค้นหาพร้อมกันไม่เกิน SPOTIFY_RESOLVE_CONCURRENCY เพลง และดึงหน้าเพลย์ลิสต์ถัดไปเมื่อใกล้ใช้เท่านั้น
+# เพลงถูกเพิ่มเข้าคิวตามลำดับเดิมทันทีที่หาเจอ เพลงแรกจึงเริ่มเล่นได้ก่อนที่ทั้งเพลย์ลิสต์จะหาเสร็จ
+# ผลการจับคู่ถูกเก็บในไฟล์ (key เป็น ISRC หรือ Spotify track ID) การเล่นเพลงเดิมครั้งถัดไปจึงไม่ต้องค้นหาอีก
+SPOTIFY_RESOLVE_CONCURRENCY = int(os.getenv("SPOTIFY_RESOLVE_CONCURRENCY", "4"))
+SPOTIFY_VOICE_MAX_TRACKS = int(os.getenv("SPOTIFY_VOICE_MAX_TRACKS", "500")) # จำนวนเพลงสูงสุดต่อครั้ง
+SPOTIFY_VOICE_TIMEOUT = float(os.getenv("SPOTIFY_VOICE_TIMEOUT", "600")) # งบเวลาของการแปลงทั้งเพลย์ลิสต์ (วินาที)
+SPOTIFY_MATCH_CACHE_FILE = os.getenv("SPOTIFY_MATCH_CACHE_FILE", "spotify_match_cache.json")
+SPOTIFY_MATCH_CACHE_SIZE = int(os.getenv("SPOTIFY_MATCH_CACHE_SIZE", "20000"))
+SPOTIFY_MATCH_MIN_SCORE = float(os.getenv("SPOTIFY_MATCH_MIN_SCORE", "0.6")) # คะแนนต่ำกว่านี้ถือว่าหาไม่พบ
+SPOTIFY_MATCH_CANDIDATES = 5 # จำนวนผลการค้นหา YouTube ที่นำมาให้คะแนนต่อเพลง
+SPOTIFY_PROGRESS_INTERVAL = 2.0 # แก้ข้อความความคืบหน้าไม่ถี่กว่านี้ (วินาที)
+
+SPOTIFY_MATCHES = metrics.counter(
+    "spotify_youtube_matches_total", "ผลการจับคู่เพลง Spotify กับ YouTube", ("result",))
+
+_SPOTIFY_LINK_PATTERN = re.compile(
+    r"open\.spotify\.com/(?:intl-[\w-]+/)?(track|album|playlist)/([A-Za-z0-9]+)|spotify:(track|album|playlist):([A-Za-z0-9]+)")
+_PLAYLIST_ITEM_FIELDS = "items(track(id,name,artists(name),duration_ms,external_ids,is_local)),total"
+_MATCH_NOISE_PATTERN = re.compile(r"[^\w\s]", re.UNICODE)
+# คำที่บ่งว่าเป็นคนละเวอร์ชันกับต้นฉบับ (หักคะแนนหากมีในวิดีโอแต่ไม่มีในชื่อเพลงบน Spotify)
+_MATCH_VARIANT_WORDS = {"live", "cover", "karaoke", "remix", "instrumental", "sped", "slowed", "nightcore", "reverb", "8d"}
+
+_spotify_app_client = None
+_spotify_resolve_semaphore = None # สร้างบน bot loop เมื่อใช้ครั้งแรก
+_spotify_matches = None # Key: "isrc:<ISRC>" หรือ "spotify:<track ID>", Value: {"url", "title", "score"}
+_spotify_matches_dirty = False
+_queue_start_task = None
+
+def _spotify_catalog_client(user_id: int):
+    """Spotify client สำหรับอ่านข้อมูลเพลง: ของผู้ใช้หากเชื่อมโยงไว้ ไม่เช่นนั้นใช้ client credentials ของแอป"""
+    global _spotify_app_client
+    sp_user = spotify_users.get(user_id)
+    if sp_user:
+        return sp_user
+    if _spotify_app_client is None and SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET:
+        _spotify_app_client = spotipy.Spotify(auth_manager=spotipy.SpotifyClientCredentials(
+            client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET))
+    return _spotify_app_client
+
+def _load_spotify_match_cache() -> dict:
+    global _spotify_matches
+    if _spotify_matches is None:
+        try:
+            with open(SPOTIFY_MATCH_CACHE_FILE, "r", encoding="utf-8") as f:
+                _spotify_matches = json.load(f)
+        except FileNotFoundError:
+            _spotify_matches = {}
+        except (OSError, ValueError) as e:
+            logging.warning("ไม่สามารถอ่านแคชการจับคู่เพลง %s: %s", SPOTIFY_MATCH_CACHE_FILE, e)
+            _spotify_matches = {}
+    return _spotify_matches
+
+async def save_spotify_match_cache():
+    global _spotify_matches_dirty
+    if not _spotify_matches_dirty:
+        return
+    _spotify_matches_dirty = False
+    try:
+        await run_in_thread("spotify_match.save", _write_json_atomic, SPOTIFY_MATCH_CACHE_FILE, dict(_spotify_matches),
+                            executor=executors["io"], priority="low")
+    except (OSError, ExecutorSaturated) as e:
+        logging.warning("ไม่สามารถบันทึกแคชการจับคู่เพลง %s: %s", SPOTIFY_MATCH_CACHE_FILE, e)
+
+def _spotify_track_info(item) -> dict:
+    """ข้อมูลที่ใช้จับคู่ของเพลงจาก Spotify API (None สำหรับไฟล์ในเครื่อง เพลงที่ถูกลบ หรือเพลงที่เล่นไม่ได้ในภูมิภาค)"""
+    if not item or item.get("is_local") or not item.get("id") or item.get("is_playable") is False:
+        return None
+    return {
+        "spotify_id": item["id"],
+        "title": item["name"],
+        "artists": [artist["name"] for artist in item.get("artists") or []],
+        "duration": (item.get("duration_ms") or 0) / 1000 or None,
+        "isrc": (item.get("external_ids") or {}).get("isrc"),
+    }
+
+def _describe_spotify_track(track: dict) -> str:
+    return f"{', '.join(track['artists'][:2])} - {track['title']}" if track["artists"] else track["title"]
+
+def _single_spotify_track_source(item) -> tuple:
+    track = _spotify_track_info(item)
+    if track is None:
+        return (item or {}).get("name") or "เพลงนี้", 0, None
+    return _describe_spotify_track(track), 1, _iterate_tracks([track])
+
+async def _spotify_voice_source(sp, query: str):
+    """
+    คืนค่า (ชื่อที่แสดง, จำนวนเพลง, async iterator ของข้อมูลเพลงตามลำดับ) หรือ None หากไม่พบ
+    เพลงเดี่ยวที่เล่นไม่ได้ (ไฟล์ในเครื่อง ถูกลบ หรือติดภูมิภาค) คืนค่า iterator เป็น None
+    หน้าถัดไปของอัลบั้ม/เพลย์ลิสต์จะถูกดึงเมื่อ iterator ถูกอ่านถึงเท่านั้น
+    """
+    match = _SPOTIFY_LINK_PATTERN.search(query)
+    if not match:
+        results = await _spotify_call(sp.search, q=query, type="track", limit=1)
+        if not results["tracks"]["items"]:
+            return None
+        item = results["tracks"]["items"][0]
+        remember_spotify_suggestion(item)
+        return _single_spotify_track_source(item)
+
+    kind, item_id = match.group(1) or match.group(3), match.group(2) or match.group(4)
+    if kind == "track":
+        item = await _spotify_call(sp.track, item_id)
+        remember_spotify_suggestion(item)
+        return _single_spotify_track_source(item)
+
+    if kind == "album":
+        album = await _spotify_call(sp.album, item_id)
+        suggestion_index.add(f"💿 {album['name']}", query)
+        total = min(album["tracks"]["total"], SPOTIFY_VOICE_MAX_TRACKS)
+
+        async def album_tracks():
+            page, offset = album["tracks"], 0
+            while page["items"] and offset < total:
+                items = page["items"][:total - offset]
+                offset += len(items)
+                # รายการเพลงของอัลบั้มไม่มี ISRC จึงดึงข้อมูลเต็มของทั้งหน้าในคำขอเดียว
+                full = await _spotify_call(sp.tracks, [item["id"] for item in items if item.get("id")])
+                for item in full["tracks"]:
+                    track = _spotify_track_info(item)
+                    if track:
+                        yield track
+                if offset < total:
+                    page = await _spotify_call(sp.album_tracks, item_id, limit=50, offset=offset)
+        return album["name"], total, album_tracks()
+
+    # เพลย์ลิสต์: ดึงชื่อและหน้าแรกพร้อมกัน
+    playlist, first_page = await asyncio.gather(
+        _spotify_call(sp.playlist, item_id, fields="name"),
+        _spotify_call(sp.playlist_items, item_id, fields=_PLAYLIST_ITEM_FIELDS, limit=100, offset=0))
+    suggestion_index.add(f"📃 {playlist['name']}", query)
+    total = min(first_page["total"], SPOTIFY_VOICE_MAX_TRACKS)
+
+    async def playlist_tracks():
+        page, offset = first_page, 0
+        while page["items"] and offset < total:
+            items = page["items"][:total - offset]
+            offset += len(items)
+            for entry in items:
+                track = _spotify_track_info(entry.get("track"))
+                if track:
+                    yield track
+            if offset < total:
+                page = await _spotify_call(sp.playlist_items, item_id, fields=_PLAYLIST_ITEM_FIELDS, limit=100, offset=offset)
+    return playlist["name"], total, playlist_tracks()
+
+async def _iterate_tracks(tracks: list):
+    for track in tracks:
+        if track:
+            yield track
+
+def _match_tokens(text: str) -> set:
+    return set(_MATCH_NOISE_PATTERN.sub(" ", text.lower()).split())
+
+def score_youtube_candidate(track: dict, candidate: dict, via_isrc: bool = False) -> float:
+    """
+    ให้คะแนนความตรงกันของวิดีโอ YouTube กับเพลงจาก Spotify (ประมาณ 0-1):
+    คำในชื่อเพลงและชื่อศิลปินที่ปรากฏในชื่อวิดีโอ/ช่อง, ความยาวที่ต่างกัน (ยอมให้ต่าง 2 วินาที),
+    โบนัสเมื่อพบจากการค้นหาด้วย ISRC หรือเป็นช่อง "- Topic" ของค่ายเพลง และหักคะแนนเวอร์ชัน live/cover/remix
+    """
+    title_tokens = _match_tokens(track["title"])
+    artist_tokens = _match_tokens(" ".join(track["artists"]))
+    channel = candidate.get("channel") or candidate.get("uploader") or ""
+    haystack = _match_tokens(f"{candidate.get('title') or ''} {channel}")
+    title_score = len(title_tokens & haystack) / len(title_tokens) if title_tokens else 0.0
+    artist_score = len(artist_tokens & haystack) / len(artist_tokens) if artist_tokens else 0.0
+    if candidate.get("duration") and track["duration"]:
+        duration_score = max(0.0, 1.0 - max(0.0, abs(candidate["duration"] - track["duration"]) - 2.0) / 15.0)
+    else:
+        duration_score = 0.5
+    score = 0.45 * title_score + 0.2 * artist_score + 0.35 * duration_score
+    if via_isrc:
+        score += 0.2
+    if channel.endswith(" - Topic"):
+        score += 0.05
+    if (haystack - title_tokens) & _MATCH_VARIANT_WORDS:
+        score -= 0.3
+    return score
+
+async def _youtube_search(query: str) -> list:
+    """ผลการค้นหา YouTube แบบ flat (id, title, duration, channel) โดยไม่ดึง URL เสียง"""
+    info = await _ytdlp_shared(query, "ytdlp.search", lambda: _timed_call(
+        YTDLP_EXTRACT_LATENCY, yt_dlp.YoutubeDL(YTDL_RELATED_OPTIONS).extract_info, query, download=False, labels={}))
+    return [entry for entry in (info.get("entries") if "entries" in info else [info]) if entry and entry.get("id")]
+
+async def match_spotify_track(track: dict):
+    """หา URL YouTube ของเพลงจาก Spotify (จากแคชหรือค้นหาใหม่) คืนค่า {"url", "title", "score", "cached"} หรือ None"""
+    global _spotify_resolve_semaphore, _spotify_matches_dirty
+    key = f"isrc:{track['isrc']}" if track.get("isrc") else f"spotify:{track['spotify_id']}"
+    matches = _load_spotify_match_cache()
+    cached = matches.get(key)
+    if cached:
+        SPOTIFY_MATCHES.inc(result="cache_hit")
+        return {**cached, "cached": True}
+
+    if _spotify_resolve_semaphore is None:
+        _spotify_resolve_semaphore = asyncio.Semaphore(SPOTIFY_RESOLVE_CONCURRENCY)
+    searches = [(f"ytsearch{SPOTIFY_MATCH_CANDIDATES}:{_describe_spotify_track(track)}", False)]
+    if track.get("isrc"):
+        searches.append((f'ytsearch3:"{track["isrc"]}"', True))
+    async with _spotify_resolve_semaphore:
+        results = await asyncio.gather(*(_youtube_search(query) for query, _ in searches), return_exceptions=True)
+
+    best, best_score = None, 0.0
+    for (query, via_isrc), entries in zip(searches, results):
+        if isinstance(entries, BaseException):
+            logging.warning("ค้นหา YouTube ไม่สำเร็จ (%s): %s", query, entries)
+            continue
+        for entry in entries:
+            score = score_youtube_candidate(track, entry, via_isrc)
+            if score > best_score:
+                best, best_score = entry, score
+    if best is None or best_score < SPOTIFY_MATCH_MIN_SCORE:
+        SPOTIFY_MATCHES.inc(result="unmatched")
+        logging.info("ไม่พบวิดีโอที่ตรงกับ %s (คะแนนสูงสุด %.2f)", _describe_spotify_track(track), best_score)
+        return None
+
+    SPOTIFY_MATCHES.inc(result="matched")
+    match = {"url": f"https://www.youtube.com/watch?v={best['id']}", "title": best.get("title"), "score": round(best_score, 3)}
+    matches.pop(key, None)
+    matches[key] = match
+    while len(matches) > SPOTIFY_MATCH_CACHE_SIZE: # ทิ้งรายการที่เก่าที่สุด (dict เรียงตามลำดับที่เพิ่ม)
+        matches.pop(next(iter(matches)))
+    _spotify_matches_dirty = True
+    return {**match, "cached": False}
+
+def _ensure_queue_playing(channel):
+    """เริ่มเล่นคิวหากบอทอยู่ในช่องเสียงแต่ยังไม่ได้เล่นอะไร (ไม่เริ่มซ้ำระหว่างที่เพลงแรกกำลังโหลด)"""
+    global _queue_start_task
+    if not (voice_client and voice_client.is_connected()) or voice_client.is_playing() or voice_client.is_paused():
+        return
+    if now_playing is not None or (_queue_start_task and not _queue_start_task.done()):
+        return
+    _queue_start_task = asyncio.create_task(_play_next_in_queue(channel))
+
+async def queue_spotify_tracks(tracks, channel, progress=None) -> dict:
+    """
+    จับคู่เพลงจาก async iterator tracks พร้อมกัน (ล่วงหน้าไม่เกิน 2 เท่าของ SPOTIFY_RESOLVE_CONCURRENCY)
+    แล้วเพิ่มเข้าคิวตามลำดับเดิมทันทีที่เพลงลำดับถัดไปพร้อม; progress(summary) ถูกเรียกหลังแต่ละเพลง
+    """
+    summary = {"queued": 0, "cached": 0, "unmatched": [], "stopped": False}
+    window = collections.deque()
+
+    async def drain_one():
+        track, task = window.popleft()
+        try:
+            match = await task
+        except Exception as e:
+            SPOTIFY_MATCHES.inc(result="error")
+            logging.warning("จับคู่เพลง %s ไม่สำเร็จ: %s", _describe_spotify_track(track), e)
+            match = None
+        if match is None:
+            summary["unmatched"].append(_describe_spotify_track(track))
+        else:
+            queue.append(match["url"])
+            summary["queued"] += 1
+            summary["cached"] += match["cached"]
+            _ensure_queue_playing(channel)
+        if progress:
+            try:
+                await progress(summary)
+            except Exception as e:
+                # แสดงความคืบหน้าไม่ได้ (เช่น ข้อความสถานะถูกลบ) ต้องไม่หยุดการเพิ่มเพลง
+                logging.warning("ไม่สามารถอัปเดตความคืบหน้าการเพิ่มเพลงจาก Spotify: %s", e)
+
+    try:
+        async for track in tracks:
+            if not (voice_client and voice_client.is_connected()):
+                summary["stopped"] = True # บอทออกจากช่องเสียงระหว่างทาง
+                break
+            window.append((track, asyncio.ensure_future(match_spotify_track(track))))
+            while window and (len(window) >= SPOTIFY_RESOLVE_CONCURRENCY * 2 or window[0][1].done()):
+                await drain_one()
+        while window and not summary["stopped"]:
+            await drain_one()
+    finally:
+        for _, task in window:
+            task.cancel()
+        await save_spotify_match_cache()
+    return summary
+
+async def play_spotify_in_voice(interaction: discord.Interaction, query: str):
+    """/play target:voice — แปลงเพลงจาก Spotify เป็นวิดีโอ YouTube แล้วเล่นในช่องเสียงของบอท (ไม่ต้องใช้ Premium)"""
+    sp = _spotify_catalog_client(interaction.user.id)
+    if sp is None:
+        await interaction.response.send_message("❌ กรุณาเชื่อมโยงบัญชี Spotify ของคุณก่อนโดยใช้ /link_spotify", ephemeral=True)
+        return
+    if not (voice_client and voice_client.is_connected()) and not interaction.user.voice:
+        await interaction.response.send_message("❌ คุณไม่ได้อยู่ในช่องเสียง", ephemeral=True)
+        return
+
+    async def work():
+        global voice_client
+        try:
+            if not (voice_client and voice_client.is_connected()):
+                voice_client = await interaction.user.voice.channel.connect()
+            source = await _spotify_voice_source(sp, query)
+            if source is None:
+                await interaction.followup.send("❌ ไม่พบเพลงบน Spotify")
+                return
+            name, total, tracks = source
+            if tracks is None:
+                await interaction.followup.send(f"❌ เล่น **{name}** ไม่ได้: เป็นไฟล์ในเครื่อง ถูกลบ หรือไม่พร้อมใช้งานในภูมิภาคนี้")
+                return
+            status_message = await interaction.followup.send(f"🔎 กำลังหาเพลงจาก **{name}** ({total} เพลง) บน YouTube...", wait=True)
+            last_update = time.monotonic()
+
+            async def progress(summary):
+                nonlocal last_update
+                done = summary["queued"] + len(summary["unmatched"])
+                if done < total and time.monotonic() - last_update >= SPOTIFY_PROGRESS_INTERVAL:
+                    last_update = time.monotonic()
+                    await status_message.edit(content=f"🔎 **{name}**: เพิ่มเข้าคิวแล้ว {summary['queued']}/{total} เพลง...")
+
+            started = time.perf_counter()
+            summary = await queue_spotify_tracks(tracks, interaction.channel or voice_client.channel, progress)
+            lines = [f"✅ เพิ่ม {summary['queued']}/{total} เพลงจาก **{name}** ลงในคิวแล้ว"]
+            if summary["stopped"]:
+                lines[0] = f"⏹️ หยุดเพิ่มเพลงจาก **{name}** เพราะบอทออกจากช่องเสียง ({summary['queued']}/{total} เพลง)"
+            if summary["unmatched"]:
+                lines.append(f"⚠️ หาไม่พบบน YouTube {len(summary['unmatched'])} เพลง: " + ", ".join(summary["unmatched"][:5])
+                             + (" ..." if len(summary["unmatched"]) > 5 else ""))
+            await status_message.edit(content=_clip_lines(lines, 2000))
+            logging.info("%s เพิ่ม %s จาก Spotify ลงคิวเสียง: %s/%s เพลง (แคช %s, ไม่พบ %s) ใน %.1f วินาที",
+                         interaction.user.display_name, name, summary["queued"], total, summary["cached"],
+                         len(summary["unmatched"]), time.perf_counter() - started)
+        except spotipy.exceptions.SpotifyException as e:
+            if e.http_status == 401 and interaction.user.id in spotify_users:
+                await forget_spotify_user(interaction.user.id)
+                await interaction.followup.send("❌ โทเค็น Spotify หมดอายุ กรุณาเชื่อมโยงบัญชีของคุณใหม่โดยใช้ /link_spotify.")
+            else:
+                await interaction.followup.send(f"❌ ข้อผิดพลาด Spotify: {e}. โปรดลองอีกครั้ง.")
+            logging.error("ข้อผิดพลาด Spotify ขณะเพิ่มเพลงลงคิวเสียง: %s", e, exc_info=True)
+        except discord.ClientException as e:
+            await interaction.followup.send(f"❌ ไม่สามารถเชื่อมต่อช่องเสียง: {e} ได้")
+        except Exception as e:
+            await interaction.followup.send(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}")
+            logging.error("ข้อผิดพลาดที่ไม่คาดคิดขณะเพิ่มเพลงจาก Spotify ลงคิวเสียง: %s", e, exc_info=True)
+
+    await run_deferred(interaction, work, timeout=SPOTIFY_VOICE_TIMEOUT)
+
+def _after_tts_playback(error):
+    """เรียกจากเธรดเสียงของ discord.py หลังพูดจบ"""
     if error:
-        logging.error(f"ข้อผิดพลาดในการเล่น TTS: {error}")
-    if os.path.exists(filename):
-        os.remove(filename)
-        logging.info(f"ล้างไฟล์เสียง: {filename}")
+        logging.error("ข้อผิดพลาดในการเล่น TTS: %s", error)
+
+
+# --- Text-to-speech ---
+# backend แต่ละตัวแปลงข้อความเป็น discord.AudioSource ที่เล่นได้ทันที
+#   espeak: espeak-ng ในเครื่อง (ไม่ต้องใช้เครือข่าย) ได้ WAV ทาง stdout แล้วแปลงเป็น PCM 48kHz stereo ในโปรเซส
+#           ส่งเฟรม PCM ให้ voice client โดยตรง ไม่ต้องเข้ารหัส/ถอดรหัส MP3 และไม่ต้องเปิด ffmpeg
+#   gtts:   Google Translate TTS ผ่าน HTTP (ได้ MP3 ซึ่ง ffmpeg ถอดรหัสจากหน่วยความจำ ไม่เขียนไฟล์)
+# TTS_BACKEND=auto ใช้ espeak หากติดตั้งไว้ ไม่เช่นนั้นใช้ gtts และใช้ gtts เป็นตัวสำรองเมื่อ backend หลักล้มเหลว
+TTS_BACKEND = os.getenv("TTS_BACKEND", "auto").lower() # auto | espeak | gtts
+TTS_FALLBACK = os.getenv("TTS_FALLBACK", "gtts").lower() # backend สำรอง หรือ "none"
+ESPEAK_EXECUTABLE = os.getenv("ESPEAK_EXECUTABLE", "espeak-ng")
+ESPEAK_WORDS_PER_MINUTE = int(os.getenv("ESPEAK_WORDS_PER_MINUTE", "165"))
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "8"))
+
+TTS_SYNTH_LATENCY = metrics.histogram(
+    "tts_synthesis_duration_seconds", "เวลาที่ใช้สังเคราะห์เสียงพูด แยกตาม backend", ("backend", "status"),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+DISCORD_SAMPLE_RATE = 48000
+DISCORD_FRAME_BYTES = 3840 # 20ms ของ PCM 16-bit stereo 48kHz
+
+class PCMBufferSource(discord.AudioSource):
+    """เล่น PCM 16-bit stereo 48kHz จากหน่วยความจำ ทีละเฟรม 20ms"""
+    def __init__(self, pcm: bytes):
+        self._buffer = memoryview(pcm)
+        self._offset = 0
+
+    def read(self) -> bytes:
+        frame = bytes(self._buffer[self._offset:self._offset + DISCORD_FRAME_BYTES])
+        self._offset += DISCORD_FRAME_BYTES
+        if not frame:
+            return b""
+        return frame.ljust(DISCORD_FRAME_BYTES, b"\0") # เติมเฟรมสุดท้ายให้ครบ
+
+    def is_opus(self) -> bool:
+        return False
+
+def _wav_to_discord_pcm(wav: bytes) -> bytes:
+    """แปลง WAV (PCM 16-bit) เป็น PCM stereo 48kHz ที่ discord.py ต้องการ"""
+    fmt = wav.find(b"fmt ")
+    data = wav.find(b"data", fmt)
+    if wav[:4] != b"RIFF" or fmt == -1 or data == -1:
+        raise ValueError("ไม่ใช่ไฟล์ WAV")
+    channels = int.from_bytes(wav[fmt + 10:fmt + 12], "little")
+    rate = int.from_bytes(wav[fmt + 12:fmt + 16], "little")
+    bits = int.from_bytes(wav[fmt + 22:fmt + 24], "little")
+    if bits != 16 or channels not in (1, 2):
+        raise ValueError(f"ไม่รองรับ WAV {bits}-bit {channels} ช่อง")
+    # espeak-ng เขียนขนาดของ data chunk เป็นค่าสูงสุดเมื่อส่งออกทาง stdout จึงใช้ข้อมูลทั้งหมดที่เหลือ
+    pcm = wav[data + 8:]
+    pcm = pcm[:len(pcm) - len(pcm) % (2 * channels)]
+    samples = numpy.frombuffer(pcm, dtype="<i2").reshape(-1, channels).astype(numpy.float32)
+    if rate != DISCORD_SAMPLE_RATE and len(samples) > 1:
+        # resample แบบ linear interpolation (เพียงพอสำหรับเสียงพูด และไม่ต้องพึ่ง audioop ที่ถูกถอดออกใน Python 3.13)
+        positions = numpy.arange(round(len(samples) * DISCORD_SAMPLE_RATE / rate)) * (rate / DISCORD_SAMPLE_RATE)
+        source = numpy.arange(len(samples))
+        samples = numpy.column_stack([numpy.interp(positions, source, samples[:, channel]) for channel in range(channels)])
+    if channels == 1:
+        samples = numpy.repeat(samples, 2, axis=1)
+    return numpy.clip(numpy.rint(samples), -32768, 32767).astype("<i2").tobytes()
+
+class TTSBackend:
+    """อินเทอร์เฟซของ backend TTS: synthesize() คืนค่า discord.AudioSource ที่พร้อมเล่น"""
+    name = "base"
+
+    def available(self) -> bool:
+        return True
+
+    async def synthesize(self, text: str, lang: str) -> discord.AudioSource:
+        raise NotImplementedError
+
+class EspeakTTSBackend(TTSBackend):
+    """espeak-ng ในเครื่อง: ไม่ต้องใช้เครือข่าย สังเคราะห์ข้อความสั้นได้ในระดับมิลลิวินาที"""
+    name = "espeak"
+
+    def __init__(self, executable: str, words_per_minute: int):
+        self.executable = executable
+        self.words_per_minute = words_per_minute
+
+    def available(self) -> bool:
+        return shutil.which(self.executable) is not None
+
+    async def synthesize(self, text: str, lang: str) -> discord.AudioSource:
+        # ส่งข้อความทาง stdin เพื่อไม่ให้ข้อความที่ขึ้นต้นด้วย "-" ถูกตีความเป็นตัวเลือก
+        process = await asyncio.create_subprocess_exec(
+            self.executable, "--stdout", "-v", lang, "-s", str(self.words_per_minute),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            wav, stderr = await process.communicate(text.encode("utf-8"))
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # หมดเวลา (wait_for ยกเลิก communicate) หรือถูกยกเลิก: ปิดโปรเซสลูกไม่ให้ค้างอยู่
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0 or not wav:
+            raise RuntimeError(f"espeak-ng ล้มเหลว (exit {process.returncode}): {stderr.decode(errors='replace').strip()}")
+        return PCMBufferSource(_wav_to_discord_pcm(wav))
+
+class GTTSBackend(TTSBackend):
+    """Google Translate TTS (ต้องใช้เครือข่าย) ถอดรหัส MP3 จากหน่วยความจำด้วย ffmpeg"""
+    name = "gtts"
+
+    async def synthesize(self, text: str, lang: str) -> discord.AudioSource:
+        def fetch():
+            buffer = io.BytesIO()
+            gtts.gTTS(text, lang=lang).write_to_fp(buffer)
+            buffer.seek(0)
+            return buffer
+        buffer = await run_in_thread("tts.gtts", fetch, executor=executors["tts"])
+        return discord.FFmpegPCMAudio(buffer, executable="ffmpeg", pipe=True)
+
+_TTS_BACKENDS = {
+    "espeak": EspeakTTSBackend(ESPEAK_EXECUTABLE, ESPEAK_WORDS_PER_MINUTE),
+    "gtts": GTTSBackend(),
+}
+
+def _tts_backend_chain() -> list:
+    """ลำดับ backend ที่จะลอง: backend หลัก แล้วตามด้วยตัวสำรอง (ไม่ซ้ำกัน)"""
+    primary = TTS_BACKEND
+    if primary == "auto":
+        primary = "espeak" if _TTS_BACKENDS["espeak"].available() else "gtts"
+    chain = [primary]
+    if TTS_FALLBACK in _TTS_BACKENDS and TTS_FALLBACK != primary:
+        chain.append(TTS_FALLBACK)
+    return [_TTS_BACKENDS[name] for name in chain if name in _TTS_BACKENDS]
+
+async def synthesize_speech(text: str, lang: str):
+    """สังเคราะห์เสียงพูดด้วย backend แรกที่สำเร็จ คืนค่า (AudioSource, ชื่อ backend)"""
+    error = None
+    for backend in _tts_backend_chain():
+        started = time.perf_counter()
+        try:
+            source = await asyncio.wait_for(backend.synthesize(text, lang), TTS_TIMEOUT)
+        except Exception as e:
+            TTS_SYNTH_LATENCY.observe(time.perf_counter() - started, backend=backend.name, status="error")
+            logging.warning("TTS backend %s ล้มเหลว: %s", backend.name, e)
+            error = e
+            continue
+        TTS_SYNTH_LATENCY.observe(time.perf_counter() - started, backend=backend.name, status="ok")
+        return source, backend.name
+    raise error or RuntimeError("ไม่มี TTS backend ที่ใช้งานได้")
+
+
+# --- การซิงค์ Slash Commands ---
+def _command_tree_hash() -> str:
+    """คำนวณ hash ของนิยามคำสั่งทั้งหมด (ทั่วโลกและของ Guild) เพื่อใช้ตัดสินว่าต้องซิงค์ใหม่หรือไม่"""
+    guild_obj = discord.Object(id=YOUR_GUILD_ID)
+    payload = {
+        "application_id": bot.application_id,
+        "guild_id": YOUR_GUILD_ID,
+        "global": sorted((cmd.to_dict() for cmd in tree.get_commands()), key=lambda c: c["name"]),
+        "guild": sorted((cmd.to_dict() for cmd in tree.get_commands(guild=guild_obj)), key=lambda c: c["name"]),
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+async def _sync_command_tree():
+    """
+    ซิงค์คำสั่งทั่วโลกและไปยัง Guild เฉพาะ แต่จะข้ามการซิงค์หาก hash ของนิยามคำสั่ง
+    ไม่เปลี่ยนแปลงนับจากการซิงค์ที่สำเร็จครั้งล่าสุด (hash เก็บไว้ใน Firestore: bot_meta/command_sync)
+    """
+    command_hash = _command_tree_hash()
+    db = await _get_firestore_db()
+    sync_ref = db.collection('bot_meta').document('command_sync') if db is not None else None
+
+    if sync_ref is not None and not FORCE_COMMAND_SYNC:
+        try:
+            doc = await _firestore_call("read", sync_ref.get)
+            if doc.exists and doc.to_dict().get('hash') == command_hash:
+                logging.info("นิยามคำสั่งไม่เปลี่ยนแปลงตั้งแต่การซิงค์ครั้งล่าสุด ข้ามการซิงค์.")
+                return
+        except firebase_exceptions.FirebaseError as e:
+            logging.warning("ไม่สามารถอ่าน hash การซิงค์คำสั่งจาก Firestore: %s จะซิงค์ใหม่ทั้งหมด", e)
+
+    try:
+        # ซิงค์คำสั่งทั่วโลก (อาจใช้เวลานานในการอัปเดตสำหรับผู้ใช้)
+        await tree.sync() 
+        logging.info("คำสั่งทั่วโลกซิงค์แล้ว.")
+        
+        # ซิงค์คำสั่งไปยัง Guild เฉพาะ (อัปเดตทันทีสำหรับ Guild ที่ระบุ)
+        guild_obj = discord.Object(id=YOUR_GUILD_ID)
+        await tree.sync(guild=guild_obj)
+        logging.info("คำสั่งซิงค์กับ Guild: %s", YOUR_GUILD_ID)
+    except Exception as e:
+        logging.error("ไม่สามารถซิงค์คำสั่ง: %s ได้", e, exc_info=True)
+        return
+
+    # บันทึก hash หลังจากซิงค์สำเร็จเท่านั้น
+    if sync_ref is not None:
+        try:
+            await _firestore_call("write", sync_ref.set, {'hash': command_hash})
+        except firebase_exceptions.FirebaseError as e:
+            logging.warning("ไม่สามารถบันทึก hash การซิงค์คำสั่งลง Firestore: %s", e)
+
+
+# --- ปิดบอทอย่างนุ่มนวล และส่งต่อสถานะผู้เล่นให้โปรเซสใหม่ ---
+# เมื่อได้รับ SIGTERM/SIGINT: หยุดรับคำสั่งใหม่ รอ interaction ที่ค้างอยู่ บันทึกสถานะผู้เล่นและโพลล์ลง Firestore
+# รอการเขียน Firestore ที่ค้างอยู่ แล้วหยุดเสียง (ปิด ffmpeg) และตัดการเชื่อมต่อช่องเสียงก่อนปิดบอท
+# โปรเซสใหม่จะอ่านสถานะนี้ใน on_ready เพื่อกลับเข้าช่องเสียงและเล่นต่อจากตำแหน่งเดิม
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "10")) # วินาทีที่รอแต่ละขั้นตอนก่อนปิด
+STATE_RESTORE_MAX_AGE = float(os.getenv("STATE_RESTORE_MAX_AGE", "600")) # สถานะผู้เล่นที่เก่ากว่านี้จะไม่ถูกเล่นต่อ
+_state_restored = False
+_shutdown_task = None
+
+def _state_document_id() -> str:
+    """เอกสารสถานะใน collection bot_state แยกตาม worker เพราะแต่ละ worker มีผู้เล่นของตัวเอง"""
+    return f"worker_{WORKER_INDEX or 0}"
+
+def _snapshot_player_state() -> dict:
+    """เก็บสถานะผู้เล่น (ช่องเสียง, เพลงปัจจุบันพร้อมตำแหน่ง, คิว, ระดับเสียง) และผลโหวตของโพลล์"""
+    state = {
+        "saved_at": time.time(),
+        "voice_channel_id": None,
+        "text_channel_id": None,
+        "now_playing": None,
+        "queue": list(queue),
+        "volume": volume,
+        # Firestore ไม่รองรับ array ซ้อน array จึงเก็บบัตรโหวตเป็น array แบน (ดู PollBallots.to_dict)
+        "polls": {
+            str(poll_id): {
+                "channel_id": poll.get("channel_id"),
+                "question": poll["question"],
+                "options": poll["options"],
+                "mode": poll["mode"],
+                "ballots": poll["ballots"].to_dict(),
+            }
+            for poll_id, poll in active_polls.items()
+        },
+    }
+    if voice_client and voice_client.is_connected():
+        state["voice_channel_id"] = voice_client.channel.id
+    if now_playing:
+        state["text_channel_id"] = now_playing["text_channel_id"]
+        state["now_playing"] = {
+            "url": now_playing["url"],
+            "title": now_playing["title"],
+            "position": now_playing["source"].position,
+        }
+    return state
+
+async def save_player_state():
+    """บันทึกสถานะผู้เล่นและโพลล์ลง Firestore เพื่อให้โปรเซสถัดไปเล่นต่อได้"""
+    db = await _get_firestore_db()
+    if db is None:
+        logging.warning("Firestore DB is not initialized. Cannot save player state.")
+        return
+    state = _snapshot_player_state()
+    await _firestore_call("write", db.collection('bot_state').document(_state_document_id()).set, state)
+    logging.info("บันทึกสถานะผู้เล่นแล้ว: คิว %s เพลง, กำลังเล่น %s, โพลล์ %s รายการ",
+                 len(state["queue"]), (state["now_playing"] or {}).get("title"), len(state["polls"]))
+
+async def restore_player_state():
+    """
+    อ่านสถานะที่โปรเซสก่อนหน้าบันทึกไว้ (ครั้งเดียวต่อโปรเซส) แล้วลบทิ้ง
+    ลงทะเบียนปุ่มโพลล์ใหม่ กลับเข้าช่องเสียง และเล่นเพลงเดิมต่อจากตำแหน่งที่หยุดไว้
+    """
+    global _state_restored, voice_client, volume
+    if _state_restored:
+        return
+    _state_restored = True
+
+    db = await _get_firestore_db()
+    if db is None:
+        return
+    doc_ref = db.collection('bot_state').document(_state_document_id())
+    doc = await _firestore_call("read", doc_ref.get)
+    if not doc.exists:
+        return
+    state = doc.to_dict()
+    await _firestore_call("write", doc_ref.delete) # ใช้สถานะนี้เพียงครั้งเดียว
+
+    # โพลล์: คืนผลโหวตและลงทะเบียน View ใหม่ เพื่อให้ปุ่ม/เมนูบนข้อความเดิมใช้งานได้ต่อ
+    for poll_id, poll in (state.get("polls") or {}).items():
+        poll_id = int(poll_id)
+        poll_data = _new_poll(poll.get("channel_id"), poll["question"], poll["options"], poll.get("mode", "single"))
+        if "ballots" in poll:
+            poll_data["ballots"].load(poll["ballots"])
+        else: # รูปแบบเดิม: list ของ {"option", "voters"} ต่อตัวเลือก
+            for entry in poll.get("votes", []):
+                for user_id in entry["voters"]:
+                    poll_data["ballots"].cast(user_id, [poll["options"].index(entry["option"])])
+        active_polls[poll_id] = poll_data
+        bot.add_view(PollView(poll_id, poll["question"], poll["options"], poll_data["mode"]), message_id=poll_id)
+
+    age = time.time() - state.get("saved_at", 0)
+    channel = bot.get_channel(state.get("voice_channel_id") or 0)
+    if age > STATE_RESTORE_MAX_AGE or channel is None:
+        logging.info("ไม่เล่นต่อจากสถานะที่บันทึกไว้ (อายุ %.0f วินาที, ช่องเสียง %s)", age, state.get("voice_channel_id"))
+        return
+
+    volume = state.get("volume", volume)
+    resumed = state.get("now_playing")
+    queue[:0] = ([resumed["url"]] if resumed else []) + state.get("queue", [])
+    try:
+        voice_client = await channel.connect()
+    except Exception as e:
+        logging.error("ไม่สามารถกลับเข้าช่องเสียง %s: %s", channel.id, e, exc_info=True)
+        return
+    logging.info("กลับเข้าช่องเสียง %s และเล่นต่อ: %s (%.1f วินาที), คิว %s เพลง",
+                 channel.id, (resumed or {}).get("title"), (resumed or {}).get("position", 0.0), len(queue))
+    text_channel = bot.get_channel(state.get("text_channel_id") or 0) or channel
+    if queue:
+        await _play_next_in_queue(text_channel, start_at=(resumed or {}).get("position", 0.0))
+
+async def _wait_until(predicate, timeout: float) -> bool:
+    """รอจนกว่า predicate จะเป็นจริง หรือหมดเวลา (คืนค่า False หากหมดเวลา)"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+async def graceful_shutdown(reason: str):
+    """ปิดบอทตามลำดับ โดยไม่ทิ้ง interaction, การเขียน Firestore หรือ ffmpeg process ค้างไว้"""
+    global _shutting_down, voice_client
+    if _shutting_down:
+        return
+    _shutting_down = True
+    started = time.perf_counter()
+    logging.info("ได้รับ %s กำลังปิดบอท...", reason)
+
+    if not await _wait_until(lambda: _inflight_interactions == 0, SHUTDOWN_DRAIN_TIMEOUT):
+        logging.warning("หมดเวลารอ interaction ที่ค้างอยู่ %s รายการ", _inflight_interactions)
+
+    try:
+        await save_player_state()
+    except Exception as e:
+        logging.error("ไม่สามารถบันทึกสถานะผู้เล่น: %s", e, exc_info=True)
+
+    if not await _wait_until(lambda: _pending_firestore_calls == 0, SHUTDOWN_DRAIN_TIMEOUT):
+        logging.warning("หมดเวลารอการเรียก Firestore ที่ค้างอยู่ %s รายการ", _pending_firestore_calls)
+
+    # stop() เรียก cleanup ของแหล่งเสียง ซึ่งจะปิด ffmpeg child process
+    for vc in list(bot.voice_clients):
+        try:
+            vc.stop()
+            await vc.disconnect(force=True)
+        except Exception as e:
+            logging.warning("ข้อผิดพลาดในการตัดการเชื่อมต่อช่องเสียง: %s", e)
+    voice_client = None
+
+    logging.info("ปิดบอทเรียบร้อยใน %.2f วินาที", time.perf_counter() - started)
+    await bot.close()
+
+def _install_shutdown_handlers(loop: asyncio.AbstractEventLoop):
+    """ให้ SIGTERM/SIGINT เรียก graceful_shutdown แทนการหยุดทันที"""
+    def handle_signal(signal_number):
+        global _shutdown_task
+        if _shutdown_task is None:
+            _shutdown_task = loop.create_task(graceful_shutdown(signal.Signals(signal_number).name))
+
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signal_number, handle_signal, signal_number)
+        except (NotImplementedError, RuntimeError):
+            # Windows หรือไม่ได้อยู่ใน main thread: ใช้พฤติกรรมเดิมของ discord.py
+            pass
+
+
+# --- ตัดการเชื่อมต่อช่องเสียงที่ไม่ได้ใช้งาน ---
+# การเชื่อมต่อเสียงแต่ละครั้งถือ UDP socket, Opus encoder และ heartbeat ไว้ตลอด แม้คิวว่างหรือไม่มีใครอยู่ในช่องแล้ว
+# ตัวจัดการนี้ติดตาม voice state และการเล่นเพลง แล้วออกจากช่องเมื่อเกินเวลาที่กำหนด (ตั้งเป็น 0 เพื่อปิด)
+VOICE_IDLE_TIMEOUT = float(os.getenv("VOICE_IDLE_TIMEOUT", "300")) # ไม่ได้เล่นเสียง (รวมถึงหยุดชั่วคราว) นานเกินนี้จะออก
+VOICE_EMPTY_TIMEOUT = float(os.getenv("VOICE_EMPTY_TIMEOUT", "60")) # ไม่มีผู้ใช้ (ที่ไม่ใช่บอท) ในช่องนานเกินนี้จะออก
+VOICE_IDLE_CHECK_INTERVAL = float(os.getenv("VOICE_IDLE_CHECK_INTERVAL", "10"))
+
+VOICE_IDLE_DISCONNECTS = metrics.counter(
+    "voice_idle_disconnects_total", "จำนวนครั้งที่ออกจากช่องเสียงอัตโนมัติ แยกตามสาเหตุ", ("reason",))
+
+_voice_idle_since = None # time.monotonic() ที่เริ่มไม่มีเสียงเล่น หรือ None หากกำลังเล่นอยู่
+_voice_empty_since = None # time.monotonic() ที่ช่องเริ่มไม่มีผู้ใช้ หรือ None หากยังมีผู้ใช้อยู่
+
+def _refresh_voice_activity():
+    """อัปเดตเวลาที่เริ่มว่าง/ไม่มีผู้ใช้ของช่องเสียงปัจจุบัน (เรียกจาก voice state update และการตรวจเป็นระยะ)"""
+    global _voice_idle_since, _voice_empty_since
+    if not voice_client or not voice_client.is_connected():
+        _voice_idle_since = _voice_empty_since = None
+        return
+    now = time.monotonic()
+    if voice_client.is_playing():
+        _voice_idle_since = None
+    elif _voice_idle_since is None:
+        _voice_idle_since = now
+    if any(not member.bot for member in voice_client.channel.members):
+        _voice_empty_since = None
+    elif _voice_empty_since is None:
+        _voice_empty_since = now
+
+async def release_voice_session(reason: str):
+    """หยุดเสียง (ปิด ffmpeg) ออกจากช่องเสียง และคืนทรัพยากรของเซสชัน; คิวที่เหลือยังเก็บไว้ให้ /join แล้วเล่นต่อได้"""
+    global voice_client, now_playing, _voice_idle_since, _voice_empty_since
+    vc = voice_client
+    text_channel = bot.get_channel(now_playing["text_channel_id"]) if now_playing else None
+    # ล้างสถานะก่อน stop() เพื่อให้ _after_playback_cleanup ไม่เล่นเพลงถัดไป
+    voice_client = None
+    now_playing = None
+    _voice_idle_since = _voice_empty_since = None
+    if vc is None:
+        return
+    VOICE_IDLE_DISCONNECTS.inc(reason=reason)
+    logging.info("ออกจากช่องเสียง %s อัตโนมัติ (%s)", vc.channel.id, reason)
+    try:
+        vc.stop()
+        await vc.disconnect(force=True)
+    except Exception as e:
+        logging.warning("ข้อผิดพลาดในการตัดการเชื่อมต่อช่องเสียง: %s", e)
+    if text_channel:
+        message = "ไม่มีผู้ใช้อยู่ในช่องเสียง" if reason == "empty" else "ไม่ได้เล่นเพลงมาสักพัก"
+        try:
+            await text_channel.send(f"👋 ออกจากช่องเสียงแล้ว เพราะ{message}")
+        except discord.HTTPException as e:
+            logging.warning("ไม่สามารถแจ้งการออกจากช่องเสียง: %s", e)
+
+async def _voice_idle_watch():
+    """ตรวจช่องเสียงเป็นระยะ และออกเมื่อว่างหรือไม่มีผู้ใช้นานเกินเวลาที่กำหนด"""
+    while not _shutting_down:
+        await asyncio.sleep(VOICE_IDLE_CHECK_INTERVAL)
+        _refresh_voice_activity()
+        now = time.monotonic()
+        if VOICE_EMPTY_TIMEOUT and _voice_empty_since is not None and now - _voice_empty_since >= VOICE_EMPTY_TIMEOUT:
+            await release_voice_session("empty")
+        elif VOICE_IDLE_TIMEOUT and _voice_idle_since is not None and now - _voice_idle_since >= VOICE_IDLE_TIMEOUT:
+            await release_voice_session("idle")
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    """ติดตามผู้ใช้ที่เข้า/ออกช่องเสียงของบอท และกรณีบอทถูกตัดการเชื่อมต่อจากภายนอก"""
+    global voice_client, now_playing
+    if member.id == bot.user.id and after.channel is None and voice_client is not None:
+        # ถูกเตะออกหรือช่องถูกลบ: discord.py ปิดการเชื่อมต่อแล้ว เหลือเพียงล้างสถานะของเรา
+        logging.info("บอทถูกตัดการเชื่อมต่อจากช่องเสียง %s", before.channel.id if before.channel else None)
+        voice_client = None
+        now_playing = None
+    _refresh_voice_activity()
 
 
 # --- Discord Bot Events ---
+@bot.event
+async def setup_hook():
+    """
+    ถูกเรียกหลังจากเข้าสู่ระบบ แต่ก่อนเชื่อมต่อ gateway
+    เริ่มการเริ่มต้น Firebase ในพื้นหลังให้ทำงานพร้อมกับการเชื่อมต่อ gateway
+    """
+    _record_startup_phase("discord login", time.perf_counter() - _bot_run_started)
+    _start_firebase_init()
+    if loop_watchdog is not None:
+        loop_watchdog.start(asyncio.get_running_loop())
+    _install_shutdown_handlers(asyncio.get_running_loop())
+    if VOICE_IDLE_TIMEOUT or VOICE_EMPTY_TIMEOUT:
+        asyncio.get_running_loop().create_task(_voice_idle_watch())
+    if _ipc_server_enabled():
+        await start_ipc_server()
+
 @bot.event
 async def on_ready():
     """
     เหตุการณ์นี้จะถูกเรียกเมื่อบอทเชื่อมต่อกับ Discord API สำเร็จ
     """
+    _record_startup_phase("discord login + gateway ready", time.perf_counter() - _bot_run_started)
+
     # โหลด Opus สำหรับฟังก์ชันเสียง
     if not discord.opus.is_loaded():
+        started = time.perf_counter()
         try:
             # พยายามโหลดไลบรารี Opus
             # ตัวอย่าง: discord.opus.load_opus('libopus.so') # สำหรับ Linux
@@ -422,70 +2922,83 @@ async def on_ready():
             discord.opus.load_opus() 
             logging.info("Opus โหลดสำเร็จ.")
         except Exception as e:
-            logging.error(f"ไม่สามารถโหลด opus: {e} ได้ คำสั่งเสียงอาจไม่ทำงาน.")
+            logging.error("ไม่สามารถโหลด opus: %s ได้ คำสั่งเสียงอาจไม่ทำงาน.", e)
             print(f"ไม่สามารถโหลด opus: {e} ได้ โปรดตรวจสอบให้แน่ใจว่าติดตั้งและเข้าถึงได้.")
+        _record_startup_phase("opus load", time.perf_counter() - started)
 
     print(f"✅ บอทเข้าสู่ระบบในฐานะ {bot.user}")
-    logging.info(f"บอทเข้าสู่ระบบในฐานะ {bot.user}")
+    logging.info("บอทเข้าสู่ระบบในฐานะ %s", bot.user)
 
-    # ซิงค์คำสั่งทั่วโลกและไปยัง Guild เฉพาะสำหรับการอัปเดตที่รวดเร็วระหว่างการพัฒนา
-    try:
-        # ซิงค์คำสั่งทั่วโลก (อาจใช้เวลานานในการอัปเดตสำหรับผู้ใช้)
-        await tree.sync() 
-        logging.info("คำสั่งทั่วโลกซิงค์แล้ว.")
-        
-        # ซิงค์คำสั่งไปยัง Guild เฉพาะ (อัปเดตทันทีสำหรับ Guild ที่ระบุ)
-        guild_obj = discord.Object(id=YOUR_GUILD_ID)
-        await tree.sync(guild=guild_obj)
-        logging.info(f"คำสั่งซิงค์กับ Guild: {YOUR_GUILD_ID}")
-    except Exception as e:
-        logging.error(f"ไม่สามารถซิงค์คำสั่ง: {e} ได้", exc_info=True)
+    # ซิงค์คำสั่งทั่วโลกและไปยัง Guild เฉพาะ (ข้ามหากนิยามคำสั่งไม่เปลี่ยนแปลง)
+    # เมื่อรันหลาย worker ให้ worker 0 ซิงค์เพียงตัวเดียว เพื่อไม่ให้ชน rate limit
+    if not WORKER_INDEX:
+        started = time.perf_counter()
+        await _sync_command_tree()
+        _record_startup_phase("command tree sync", time.perf_counter() - started)
 
     # โหลดข้อมูลผู้ใช้ทั้งหมดจาก Firestore เมื่อบอทเริ่มต้น
+    started = time.perf_counter()
     await load_all_user_data_from_firestore()
+    _record_startup_phase("load user data", time.perf_counter() - started)
     
     bot_ready.set() # ตั้งค่า Event เพื่อส่งสัญญาณว่าบอทพร้อมใช้งาน
     logging.info("บอทพร้อมใช้งานเต็มที่แล้ว.")
+    _log_startup_report()
+
+    # เล่นต่อจากสถานะที่โปรเซสก่อนหน้าบันทึกไว้ตอนปิด (ถ้ามี)
+    try:
+        await restore_player_state()
+    except Exception as e:
+        logging.error("ไม่สามารถคืนสถานะผู้เล่น: %s", e, exc_info=True)
 
 # --- Discord Slash Commands ---
 
 @tree.command(name="join", description="เข้าร่วมช่องเสียงของคุณ")
 async def join(interaction: discord.Interaction):
     """คำสั่งสำหรับบอทเข้าร่วมช่องเสียงที่ผู้ใช้กำลังอยู่"""
-    global voice_client
-    if interaction.user.voice:
-        channel = interaction.user.voice.channel
-        if voice_client and voice_client.is_connected():
-            if voice_client.channel.id == channel.id:
-                await interaction.response.send_message(f"✅ อยู่ใน **{channel.name}** แล้ว", ephemeral=True)
-            else:
+    if not interaction.user.voice:
+        await interaction.response.send_message("❌ คุณไม่ได้อยู่ในช่องเสียง", ephemeral=True)
+        return
+    channel = interaction.user.voice.channel
+    if voice_client and voice_client.is_connected() and voice_client.channel.id == channel.id:
+        await interaction.response.send_message(f"✅ อยู่ใน **{channel.name}** แล้ว", ephemeral=True)
+        return
+
+    # การเชื่อมต่อช่องเสียงอาจใช้เวลาหลายวินาที จึง defer ก่อนเสมอ
+    async def work():
+        global voice_client
+        try:
+            if voice_client and voice_client.is_connected():
                 await voice_client.move_to(channel)
-                await interaction.response.send_message(f"✅ ย้ายไปยัง **{channel.name}** แล้ว", ephemeral=True)
-        else:
-            try:
+                await interaction.followup.send(f"✅ ย้ายไปยัง **{channel.name}** แล้ว", ephemeral=True)
+            else:
                 voice_client = await channel.connect()
-                await interaction.response.send_message(f"✅ เข้าร่วม **{channel.name}** แล้ว", ephemeral=True)
-            except discord.ClientException as e:
-                logging.error(f"ไม่สามารถเชื่อมต่อช่องเสียง: {e} ได้")
-                await interaction.response.send_message(f"❌ ไม่สามารถเชื่อมต่อช่องเสียง: {e} ได้", ephemeral=True)
-            except Exception as e:
-                logging.error(f"เกิดข้อผิดพลาดที่ไม่คาดคิดขณะเข้าร่วมช่องเสียง: {e}")
-                await interaction.response.send_message(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}", ephemeral=True)
-    else:
-        await interaction.response.send_message("❌ คุณไม่ได้อยู่ในช่องเสียง", ephemeral=True)
+                await interaction.followup.send(f"✅ เข้าร่วม **{channel.name}** แล้ว", ephemeral=True)
+        except discord.ClientException as e:
+            logging.error("ไม่สามารถเชื่อมต่อช่องเสียง: %s ได้", e)
+            await interaction.followup.send(f"❌ ไม่สามารถเชื่อมต่อช่องเสียง: {e} ได้", ephemeral=True)
+        except Exception as e:
+            logging.error("เกิดข้อผิดพลาดที่ไม่คาดคิดขณะเข้าร่วมช่องเสียง: %s", e)
+            await interaction.followup.send(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}", ephemeral=True)
+
+    await run_deferred(interaction, work, ephemeral=True)
 
 @tree.command(name="leave", description="ออกจากช่องเสียง")
 async def leave(interaction: discord.Interaction):
     """คำสั่งสำหรับบอทออกจากช่องเสียง"""
-    global voice_client
-    if voice_client and voice_client.is_connected():
+    if not (voice_client and voice_client.is_connected()):
+        await interaction.response.send_message("❌ ไม่ได้อยู่ในช่องเสียง", ephemeral=True)
+        return
+
+    async def work():
+        global voice_client
         if voice_client.is_playing():
             voice_client.stop()
         await voice_client.disconnect()
         voice_client = None
-        await interaction.response.send_message("✅ ออกจากช่องเสียงแล้ว", ephemeral=True)
-    else:
-        await interaction.response.send_message("❌ ไม่ได้อยู่ในช่องเสียง", ephemeral=True)
+        await interaction.followup.send("✅ ออกจากช่องเสียงแล้ว", ephemeral=True)
+
+    await run_deferred(interaction, work, ephemeral=True)
 
 @tree.command(name="link_spotify", description="เชื่อมโยงบัญชี Spotify ของคุณ")
 async def link_spotify(interaction: discord.Interaction):
@@ -499,12 +3012,23 @@ async def link_spotify(interaction: discord.Interaction):
 
 @tree.command(name="play", description="เล่นเพลงจาก Spotify")
 @app_commands.describe(query="ชื่อเพลง, ศิลปิน, หรือลิงก์ Spotify (เพลง, เพลย์ลิสต์, อัลบั้ม)")
-async def play(interaction: discord.Interaction, query: str):
+@app_commands.describe(target="เล่นบนอุปกรณ์ Spotify ของคุณ (ต้องใช้ Premium) หรือในช่องเสียงของบอท")
+@app_commands.choices(target=[
+    app_commands.Choice(name="อุปกรณ์ Spotify ของฉัน", value="spotify"),
+    app_commands.Choice(name="ช่องเสียงของบอท", value="voice"),
+])
+async def play(interaction: discord.Interaction, query: str, target: str = "spotify"):
     """
     คำสั่งสำหรับเล่นเพลง, เพลย์ลิสต์ หรืออัลบั้มจาก Spotify
     รองรับการค้นหาด้วยชื่อหรือลิงก์ Spotify โดยตรง
+    target=voice จะหาเพลงเดียวกันบน YouTube แล้วเล่นในช่องเสียงของบอทแทน
     """
-    sp_user = get_user_spotify_client(interaction.user.id)
+    if target == "voice":
+        await play_spotify_in_voice(interaction, query)
+        return
+
+    # ไม่ตรวจสอบโทเค็นล่วงหน้า (เสียเวลาหนึ่ง round trip) โทเค็นที่หมดอายุจะถูกจัดการจาก 401 ด้านล่าง
+    sp_user = spotify_users.get(interaction.user.id)
     if not sp_user:
         await interaction.response.send_message(
             "❌ กรุณาเชื่อมโยงบัญชี Spotify ของคุณก่อนโดยใช้ /link_spotify", 
@@ -512,75 +3036,218 @@ async def play(interaction: discord.Interaction, query: str):
         )
         return
 
-    await interaction.response.defer() # หน่วงการตอบสนองเนื่องจากการเรียก Spotify API อาจใช้เวลา
-
-    try:
-        track_uris = []
-        context_uri = None
-        response_msg = "🎶"
-
-        # ตรวจสอบว่าเป็นลิงก์ Spotify (เพลง, เพลย์ลิสต์, หรืออัลบั้ม) หรือไม่
-        if "spotify.com/track/" in query:
-            track_id = query.split('/')[-1].split('?')[0]
-            track_uri = f"spotify:track:{track_id}"
-            track = await asyncio.to_thread(sp_user.track, track_uri)
-            track_uris.append(track_uri)
-            response_msg += f" กำลังเล่น: **{track['name']}** โดย **{track['artists'][0]['name']}**"
-        elif "spotify.com/playlist/" in query:
-            playlist_id = query.split('/')[-1].split('?')[0]
-            context_uri = f"spotify:playlist:{playlist_id}"
-            playlist = await asyncio.to_thread(sp_user.playlist, playlist_id)
-            response_msg += f" กำลังเล่นเพลย์ลิสต์: **{playlist['name']}**"
-        elif "spotify.com/album/" in query:
-            album_id = query.split('/')[-1].split('?')[0]
-            context_uri = f"spotify:album:{album_id}"
-            album = await asyncio.to_thread(sp_user.album, album_id)
-            response_msg += f" กำลังเล่นอัลบั้ม: **{album['name']}**"
-        else:  # ค้นหาด้วยชื่อถ้าไม่ใช่ลิงก์โดยตรง
-            results = await asyncio.to_thread(sp_user.search, q=query, type='track', limit=1)
-            if not results['tracks']['items']:
-                await interaction.followup.send("❌ ไม่พบเพลงบน Spotify")
-                return
-            track = results['tracks']['items'][0]
-            track_uris.append(track['uri'])
-            response_msg += f" กำลังเล่น: **{track['name']}** โดย **{track['artists'][0]['name']}**"
-
-        # ดึงอุปกรณ์ที่ใช้งานอยู่เพื่อเล่นเพลง
-        devices = await asyncio.to_thread(sp_user.devices)
-        active_device_id = None
-        for device in devices['devices']:
-            if device['is_active']:
-                active_device_id = device['id']
-                break
-        
-        if not active_device_id:
-            await interaction.followup.send("❌ ไม่พบ Spotify client ที่ใช้งานอยู่ กรุณาเปิดแอป Spotify ของคุณและเล่นเพลงอะไรก็ได้ที่นั่นก่อน หรือเลือกอุปกรณ์สำหรับเล่นใน Spotify.")
+    await run_deferred(interaction, lambda: _play_spotify(interaction, sp_user, query))
+
+# --- Autocomplete ของ /play ---
+# ตอบจากดัชนี prefix ในหน่วยความจำ (เพลงที่เคยเล่นและผลการค้นหาที่เคยดึงมา) ก่อนเสมอ
+# การค้นหาบน Spotify จะเกิดเมื่อผู้ใช้หยุดพิมพ์ครบ AUTOCOMPLETE_DEBOUNCE เท่านั้น และรอไม่เกินงบเวลา
+# หากค้นหาไม่ทันจะตอบจากดัชนีไปก่อน ผลการค้นหาที่มาถึงทีหลังถูกเก็บลงดัชนีให้การพิมพ์ครั้งถัดไป
+AUTOCOMPLETE_INDEX_SIZE = int(os.getenv("AUTOCOMPLETE_INDEX_SIZE", "5000"))
+AUTOCOMPLETE_DEBOUNCE = float(os.getenv("AUTOCOMPLETE_DEBOUNCE", "0.35"))
+AUTOCOMPLETE_BUDGET = float(os.getenv("AUTOCOMPLETE_BUDGET", "2.0")) # นับจากเวลาที่ Discord สร้าง interaction (deadline 3 วินาที)
+AUTOCOMPLETE_MIN_REMOTE_CHARS = 3
+AUTOCOMPLETE_SEARCH_TTL = 600.0 # ไม่ค้นหาคำเดิมซ้ำภายในเวลานี้ (ผลลัพธ์อยู่ในดัชนีแล้ว)
+AUTOCOMPLETE_MAX_CHOICES = 25 # ข้อจำกัดของ Discord
+
+AUTOCOMPLETE_REMOTE_SEARCHES = metrics.counter(
+    "autocomplete_remote_searches_total", "การค้นหา Spotify จาก autocomplete แยกตามผลลัพธ์", ("result",))
+
+class PrefixIndex:
+    """ดัชนี prefix ของชื่อ (รายการ key ที่เรียงไว้ + bisect) ค้นหาได้จากต้นคำใดก็ได้ในชื่อ จำกัดขนาดแบบ LRU"""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict() # Key: value, Value: label
+        self._keys = [] # [(key ที่ normalize แล้ว, value)] เรียงตาม key
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.casefold().split())
+
+    def _keys_for(self, label: str) -> set:
+        words = self.normalize(label).split(" ")
+        return {" ".join(words[i:]) for i in range(len(words))}
+
+    def add(self, label: str, value: str):
+        if value in self._entries:
+            self._entries.move_to_end(value)
             return
+        self._entries[value] = label
+        for key in self._keys_for(label):
+            bisect.insort(self._keys, (key, value))
+        while len(self._entries) > self.max_entries:
+            old_value, old_label = self._entries.popitem(last=False)
+            for key in self._keys_for(old_label):
+                position = bisect.bisect_left(self._keys, (key, old_value))
+                if position < len(self._keys) and self._keys[position] == (key, old_value):
+                    del self._keys[position]
+
+    def search(self, prefix: str, limit: int) -> list:
+        """คืนค่า [(label, value)] ที่มีคำขึ้นต้นด้วย prefix (prefix ว่าง = รายการล่าสุด)"""
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return [(self._entries[value], value) for value in reversed(self._entries)][:limit]
+        results = []
+        seen = set()
+        position = bisect.bisect_left(self._keys, (prefix,))
+        while position < len(self._keys) and len(results) < limit:
+            key, value = self._keys[position]
+            if not key.startswith(prefix):
+                break
+            if value not in seen:
+                seen.add(value)
+                results.append((self._entries[value], value))
+            position += 1
+        return results
+
+suggestion_index = PrefixIndex(AUTOCOMPLETE_INDEX_SIZE)
+autocomplete_flight = SingleFlight("autocomplete_search") # คำค้นเดียวกันจากหลายผู้ใช้ค้นหาครั้งเดียว
+_autocomplete_searched = collections.OrderedDict() # Key: คำค้นที่ normalize แล้ว, Value: เวลาหมดอายุ
+_autocomplete_latest = {} # Key: user ID, Value: token ของคำขอ autocomplete ล่าสุด (ใช้ debounce)
+
+def remember_spotify_suggestion(track: dict):
+    """เพิ่มเพลงของ Spotify ลงดัชนี autocomplete (ค่าที่เลือกเป็นลิงก์เพลง จึงเล่นได้โดยไม่ต้องค้นหาซ้ำ)"""
+    url = (track.get("external_urls") or {}).get("spotify")
+    if not url:
+        return
+    artists = ", ".join(artist["name"] for artist in track.get("artists") or [])
+    suggestion_index.add(f"{track['name']} — {artists}" if artists else track["name"], url)
 
-        # เริ่มเล่นเพลงบนอุปกรณ์ที่ใช้งานอยู่
-        if context_uri: # สำหรับเพลย์ลิสต์และอัลบั้ม
-            await asyncio.to_thread(sp_user.start_playback, device_id=active_device_id, context_uri=context_uri)
-        else: # สำหรับเพลงเดี่ยว
-            await asyncio.to_thread(sp_user.start_playback, device_id=active_device_id, uris=track_uris)
-        
+async def _autocomplete_remote_search(sp_user, query: str):
+    try:
+        with work_priority("low"):
+            results = await _spotify_call(sp_user.search, q=query, type="track", limit=10)
+    except ExecutorSaturated:
+        AUTOCOMPLETE_REMOTE_SEARCHES.inc(result="shed")
+        return
+    except spotipy.exceptions.SpotifyException as e:
+        AUTOCOMPLETE_REMOTE_SEARCHES.inc(result="error")
+        logging.debug("ค้นหา autocomplete ไม่สำเร็จ: %s", e)
+        return
+    AUTOCOMPLETE_REMOTE_SEARCHES.inc(result="ok")
+    for track in results["tracks"]["items"]:
+        remember_spotify_suggestion(track)
+    _autocomplete_searched[query] = time.monotonic() + AUTOCOMPLETE_SEARCH_TTL
+    while len(_autocomplete_searched) > AUTOCOMPLETE_INDEX_SIZE:
+        _autocomplete_searched.popitem(last=False)
+
+def _autocomplete_choices(current: str) -> list:
+    # Discord จำกัดชื่อและค่าของตัวเลือกไว้ที่ 100 ตัวอักษร
+    return [app_commands.Choice(name=label[:100], value=value)
+            for label, value in suggestion_index.search(current, AUTOCOMPLETE_MAX_CHOICES) if len(value) <= 100]
+
+@play.autocomplete("query")
+async def play_query_autocomplete(interaction: discord.Interaction, current: str) -> list:
+    """ตัวเลือกของ query ใน /play: ตอบจากดัชนีทันที และค้นหา Spotify (แบบ debounce) เมื่อจำเป็น"""
+    query = PrefixIndex.normalize(current)
+    sp_user = spotify_users.get(interaction.user.id)
+    searched_until = _autocomplete_searched.get(query)
+    if (not sp_user or len(query) < AUTOCOMPLETE_MIN_REMOTE_CHARS or query.startswith("http")
+            or (searched_until and searched_until > time.monotonic())):
+        return _autocomplete_choices(current)
+
+    # รอให้ผู้ใช้หยุดพิมพ์ก่อน หากมีคำขอใหม่กว่าจากผู้ใช้คนเดิม คำขอนี้ตอบจากดัชนีเท่านั้น
+    token = object()
+    _autocomplete_latest[interaction.user.id] = token
+    await asyncio.sleep(AUTOCOMPLETE_DEBOUNCE)
+    if _autocomplete_latest.get(interaction.user.id) is not token:
+        AUTOCOMPLETE_REMOTE_SEARCHES.inc(result="debounced")
+        return _autocomplete_choices(current)
+    del _autocomplete_latest[interaction.user.id]
+
+    remaining = AUTOCOMPLETE_BUDGET - (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    search = asyncio.ensure_future(autocomplete_flight.do(query, _autocomplete_remote_search, sp_user, query))
+    try:
+        # shield: หากหมดงบ การค้นหายังทำต่อและเก็บผลลงดัชนีสำหรับการพิมพ์ครั้งถัดไป
+        await asyncio.wait_for(asyncio.shield(search), max(remaining, 0.0))
+    except asyncio.TimeoutError:
+        AUTOCOMPLETE_REMOTE_SEARCHES.inc(result="late")
+    return _autocomplete_choices(current)
+
+async def _resolve_spotify_query(sp_user, query: str):
+    """แปลง query เป็น (track_uris, context_uri, ข้อความตอบกลับ) หรือ None หากค้นหาไม่พบ"""
+    track_uris = []
+    context_uri = None
+    response_msg = "🎶"
+
+    # ตรวจสอบว่าเป็นลิงก์ Spotify (เพลง, เพลย์ลิสต์, หรืออัลบั้ม) หรือไม่
+    if "spotify.com/track/" in query:
+        track_id = query.split('/')[-1].split('?')[0]
+        track_uri = f"spotify:track:{track_id}"
+        track = await _spotify_call(sp_user.track, track_uri)
+        track_uris.append(track_uri)
+        remember_spotify_suggestion(track)
+        response_msg += f" กำลังเล่น: **{track['name']}** โดย **{track['artists'][0]['name']}**"
+    elif "spotify.com/playlist/" in query:
+        playlist_id = query.split('/')[-1].split('?')[0]
+        context_uri = f"spotify:playlist:{playlist_id}"
+        playlist = await _spotify_call(sp_user.playlist, playlist_id)
+        suggestion_index.add(f"📃 {playlist['name']}", query)
+        response_msg += f" กำลังเล่นเพลย์ลิสต์: **{playlist['name']}**"
+    elif "spotify.com/album/" in query:
+        album_id = query.split('/')[-1].split('?')[0]
+        context_uri = f"spotify:album:{album_id}"
+        album = await _spotify_call(sp_user.album, album_id)
+        suggestion_index.add(f"💿 {album['name']}", query)
+        response_msg += f" กำลังเล่นอัลบั้ม: **{album['name']}**"
+    else:  # ค้นหาด้วยชื่อถ้าไม่ใช่ลิงก์โดยตรง
+        results = await _spotify_call(sp_user.search, q=query, type='track', limit=1)
+        if not results['tracks']['items']:
+            return None
+        track = results['tracks']['items'][0]
+        track_uris.append(track['uri'])
+        remember_spotify_suggestion(track)
+        response_msg += f" กำลังเล่น: **{track['name']}** โดย **{track['artists'][0]['name']}**"
+    return track_uris, context_uri, response_msg
+
+async def _start_spotify_playback(sp_user, query: str) -> str:
+    """ค้นหาเพลงและดึงอุปกรณ์พร้อมกัน แล้วสั่งเล่น คืนค่าข้อความที่จะตอบผู้ใช้"""
+    # การค้นหาเพลงและการดึงอุปกรณ์ไม่ขึ้นต่อกัน จึงเรียกพร้อมกันเพื่อลดเวลารอ
+    resolved, devices = await asyncio.gather(
+        _resolve_spotify_query(sp_user, query),
+        _spotify_call(sp_user.devices)
+    )
+    if resolved is None:
+        return "❌ ไม่พบเพลงบน Spotify"
+    track_uris, context_uri, response_msg = resolved
+
+    # หาอุปกรณ์ที่ใช้งานอยู่เพื่อเล่นเพลง
+    active_device_id = None
+    for device in devices['devices']:
+        if device['is_active']:
+            active_device_id = device['id']
+            break
+    
+    if not active_device_id:
+        return "❌ ไม่พบ Spotify client ที่ใช้งานอยู่ กรุณาเปิดแอป Spotify ของคุณและเล่นเพลงอะไรก็ได้ที่นั่นก่อน หรือเลือกอุปกรณ์สำหรับเล่นใน Spotify."
+
+    # เริ่มเล่นเพลงบนอุปกรณ์ที่ใช้งานอยู่
+    if context_uri: # สำหรับเพลย์ลิสต์และอัลบั้ม
+        await _spotify_call(sp_user.start_playback, device_id=active_device_id, context_uri=context_uri)
+    else: # สำหรับเพลงเดี่ยว
+        await _spotify_call(sp_user.start_playback, device_id=active_device_id, uris=track_uris)
+    return response_msg
+
+async def _play_spotify(interaction: discord.Interaction, sp_user, query: str):
+    """งานของ /play หลัง defer: /play ที่ซ้ำกันของผู้ใช้คนเดิมระหว่างที่ตัวแรกยังไม่เสร็จจะใช้ผลลัพธ์ร่วมกัน"""
+    try:
+        response_msg = await play_flight.do(
+            (interaction.user.id, query.strip().lower()), _start_spotify_playback, sp_user, query)
         await interaction.followup.send(response_msg)
 
     except spotipy.exceptions.SpotifyException as e:
         if e.http_status == 401:
             await interaction.followup.send("❌ โทเค็น Spotify หมดอายุ กรุณาเชื่อมโยงบัญชีของคุณใหม่โดยใช้ /link_spotify.")
-            if interaction.user.id in spotify_users:
-                del spotify_users[interaction.user.id]
-                await update_user_data_in_firestore(interaction.user.id, spotify_token_info=firestore.DELETE_FIELD) 
+            await forget_spotify_user(interaction.user.id)
         elif e.http_status == 404 and "Device not found" in str(e):
             await interaction.followup.send("❌ ไม่พบ Spotify client ที่ใช้งานอยู่ กรุณาเปิดแอป Spotify ของคุณ.")
         elif e.http_status == 403: # ข้อผิดพลาด Forbidden มักเกี่ยวข้องกับ Premium หรือข้อจำกัดการเล่น
             await interaction.followup.send("❌ ข้อผิดพลาดในการเล่น Spotify: คุณอาจต้องมีบัญชี Spotify Premium หรือมีข้อจำกัดในการเล่น.")
         else:
             await interaction.followup.send(f"❌ ข้อผิดพลาด Spotify: {e}. โปรดลองอีกครั้ง.")
-        logging.error(f"ข้อผิดพลาด Spotify สำหรับผู้ใช้ {interaction.user.id}: {e}", exc_info=True)
+        logging.error("ข้อผิดพลาด Spotify สำหรับผู้ใช้ %s: %s", interaction.user.id, e, exc_info=True)
     except Exception as e:
         await interaction.followup.send(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}")
-        logging.error(f"ข้อผิดพลาดที่ไม่คาดคิดในคำสั่ง play: {e}", exc_info=True)
+        logging.error("ข้อผิดพลาดที่ไม่คาดคิดในคำสั่ง play: %s", e, exc_info=True)
 
 @tree.command(name="random_name", description="สุ่มเลือกชื่อจากรายการที่ให้มา")
 @app_commands.describe(names="ชื่อหรือรายการที่คั่นด้วยเครื่องหมายจุลภาค (เช่น John, Doe, Alice)")
@@ -595,45 +3262,242 @@ async def random_name(interaction: discord.Interaction, names: str):
 
         selected_name = random.choice(name_list)
         await interaction.response.send_message(f"✨ ชื่อที่ถูกสุ่มเลือกคือ: **{selected_name}**")
-        logging.info(f"{interaction.user.display_name} สุ่มชื่อ: '{names}' และได้ '{selected_name}'")
+        logging.info("%s สุ่มชื่อ: '%s' และได้ '%s'", interaction.user.display_name, names, selected_name)
 
     except Exception as e:
-        logging.error(f"ข้อผิดพลาดในคำสั่ง random_name: {e}", exc_info=True)
+        logging.error("ข้อผิดพลาดในคำสั่ง random_name: %s", e, exc_info=True)
         await interaction.response.send_message(f"❌ เกิดข้อผิดพลาดในการสุ่มชื่อ: {e}", ephemeral=True)
 
+# --- ตั้งค่าระบบโพลล์ ---
+POLL_BUTTON_LIMIT = 24 # โพลล์แบบเลือกเดียวที่มีตัวเลือกไม่เกินนี้ใช้ปุ่ม (Discord จำกัด 5 แถว x 5 ปุ่ม รวมปุ่มแสดงผลลัพธ์)
+POLL_SELECT_CHUNK = 25 # Discord จำกัดตัวเลือกต่อเมนูไว้ที่ 25
+POLL_MAX_OPTIONS = 100 # เมนูเลือก 4 แถว x 25 ตัวเลือก (แถวสุดท้ายเหลือไว้สำหรับปุ่ม)
+POLL_MAX_RANKS = int(os.getenv("POLL_MAX_RANKS", "10")) # จำนวนอันดับสูงสุดต่อบัตรในโพลล์แบบจัดอันดับ
+POLL_REFRESH_INTERVAL = float(os.getenv("POLL_REFRESH_INTERVAL", "1.0")) # รวบการแก้ไขข้อความผลโหวตที่เกิดภายในช่วงนี้ (วินาที) เป็นครั้งเดียว
+POLL_RESULTS_SHOWN = 20 # โพลล์ที่มีตัวเลือกมากกว่านี้จะแสดงเฉพาะตัวเลือกที่ได้คะแนนสูงสุด
+POLL_MODES = {
+    "single": "เลือกได้หนึ่งตัวเลือก",
+    "multi": "เลือกได้หลายตัวเลือก",
+    "ranked": "จัดอันดับ (Instant-runoff)",
+}
+_poll_refresh_tasks = {} # poll_id -> Task ที่รอแก้ไขข้อความผลโหวต
+
+
+class PollBallots:
+    """
+    บัตรโหวตของโพลล์หนึ่งโพลล์ในรูปแบบ array ขนาดกะทัดรัด (แทน set ของ user ID ต่อตัวเลือก)
+    ผู้โหวตแต่ละคนมีหนึ่งแถวกว้าง width ช่อง เก็บดัชนีตัวเลือกเรียงตามลำดับความชอบ (-1 = ช่องว่าง)
+    counts ถูกปรับทีละบัตรเมื่อมีการโหวต จึงไม่ต้องนับใหม่ทั้งโพลล์ทุกครั้ง
+    """
+    def __init__(self, option_count: int, width: int, ranked: bool = False):
+        self.option_count = option_count
+        self.width = width
+        self.ranked = ranked
+        self.voters = array.array("q") # user ID ตามลำดับแถว
+        self.choices = array.array("h") # len(voters) * width ช่อง
+        self.counts = [0] * option_count # คะแนนต่อตัวเลือก (แบบจัดอันดับนับเฉพาะอันดับแรก)
+        self.voter_count = 0 # จำนวนบัตรที่ไม่ว่าง
+        self._rows = {} # user_id -> แถว
+
+    @classmethod
+    def for_mode(cls, option_count: int, mode: str):
+        if mode == "ranked":
+            return cls(option_count, min(option_count, POLL_MAX_RANKS), ranked=True)
+        return cls(option_count, option_count if mode == "multi" else 1)
+
+    def ballot(self, user_id) -> list:
+        """บัตรปัจจุบันของผู้ใช้ (list ของดัชนีตัวเลือก) หรือ list ว่าง"""
+        row = self._rows.get(user_id)
+        if row is None:
+            return []
+        start = row * self.width
+        return [choice for choice in self.choices[start:start + self.width] if choice >= 0]
+
+    def cast(self, user_id, ballot) -> list:
+        """แทนที่บัตรของผู้ใช้ด้วย ballot (ตัดตัวซ้ำและส่วนที่เกิน width) และคืนบัตรเดิม"""
+        ballot = list(dict.fromkeys(ballot))[:self.width]
+        previous = self.ballot(user_id)
+        row = self._rows.get(user_id)
+        if row is None:
+            if not ballot:
+                return previous
+            row = self._rows[user_id] = len(self.voters)
+            self.voters.append(user_id)
+            self.choices.extend([-1] * self.width)
+        for choice in previous[:1] if self.ranked else previous:
+            self.counts[choice] -= 1
+        for choice in ballot[:1] if self.ranked else ballot:
+            self.counts[choice] += 1
+        self.voter_count += bool(ballot) - bool(previous)
+        start = row * self.width
+        self.choices[start:start + self.width] = array.array("h", ballot + [-1] * (self.width - len(ballot)))
+        return previous
+
+    def instant_runoff(self):
+        """
+        นับคะแนนแบบ Instant-runoff บนเมทริกซ์บัตรทั้งหมดด้วย numpy:
+        แต่ละรอบ bincount อันดับแรกที่ยังไม่ถูกตัดของทุกบัตร แล้วตัดตัวเลือกที่ได้คะแนนต่ำสุด (รวมที่เสมอกัน)
+        พร้อมกันในรอบเดียว เฉพาะบัตรที่อันดับแรกถูกตัดเท่านั้นที่ต้องหาอันดับถัดไปใหม่
+        คืน (ดัชนีผู้ชนะ หรือ None หากไม่มีบัตร/เสมอกันทั้งหมด, list คะแนนของแต่ละรอบ)
+        """
+        n = self.option_count
+        if not self.voter_count:
+            return None, []
+        ballots = numpy.array(self.choices, dtype=numpy.intp).reshape(-1, self.width)
+        ballots[ballots < 0] = n # ช่องว่างชี้ไปยังตัวเลือกสมมติที่ถูกตัดไว้แล้วเสมอ
+        eliminated = numpy.zeros(n + 1, dtype=bool)
+        eliminated[n] = True
+
+        def first_live(rows):
+            live = ~eliminated[rows]
+            return numpy.where(live.any(axis=1), rows[numpy.arange(len(rows)), live.argmax(axis=1)], n)
+
+        tops = first_live(ballots) # อันดับแรกปัจจุบันของแต่ละบัตร (n = บัตรที่ใช้หมดแล้ว)
+        rounds = []
+        while True:
+            counts = numpy.bincount(tops, minlength=n + 1)[:n]
+            rounds.append(counts.tolist())
+            remaining = numpy.flatnonzero(~eliminated[:n])
+            total = int(counts.sum())
+            if not total:
+                return None, rounds
+            leader = remaining[counts[remaining].argmax()]
+            if counts[leader] * 2 > total or len(remaining) == 1:
+                return int(leader), rounds
+            lowest = remaining[counts[remaining] == counts[remaining].min()]
+            if len(lowest) == len(remaining):
+                return None, rounds # ตัวเลือกที่เหลือทั้งหมดได้คะแนนเท่ากัน
+            eliminated[lowest] = True
+            moved = numpy.flatnonzero(eliminated[tops] & (tops != n))
+            tops[moved] = first_live(ballots[moved])
+
+    def to_dict(self) -> dict:
+        return {"width": self.width, "voters": self.voters.tolist(), "choices": self.choices.tolist()}
+
+    def load(self, data: dict):
+        """โหลดบัตรจาก to_dict() (width เดิมอาจต่างจากปัจจุบันได้ หากเปลี่ยน POLL_MAX_RANKS)"""
+        width = data["width"]
+        choices = data["choices"]
+        for row, user_id in enumerate(data["voters"]):
+            ballot = [choice for choice in choices[row * width:(row + 1) * width] if 0 <= choice < self.option_count]
+            self.cast(user_id, ballot)
+
+
+def _new_poll(channel_id, question: str, options: list, mode: str = "single") -> dict:
+    return {
+        "channel_id": channel_id,
+        "question": question,
+        "options": options,
+        "mode": mode,
+        "ballots": PollBallots.for_mode(len(options), mode),
+    }
+
+def _poll_uses_buttons(mode: str, options: list) -> bool:
+    return mode == "single" and len(options) <= POLL_BUTTON_LIMIT
+
+def _poll_result_lines(poll_data: dict) -> list:
+    """บรรทัดผลโหวตของโพลล์ (โพลล์ขนาดใหญ่แสดงเฉพาะตัวเลือกที่ได้คะแนนสูงสุด ยกเว้นแบบจัดอันดับที่ต้องเห็นหมายเลขครบ)"""
+    options = poll_data["options"]
+    ballots = poll_data["ballots"]
+    counts = ballots.counts
+    if _poll_uses_buttons(poll_data["mode"], options):
+        return [f"**{option}**: {counts[i]} โหวต" for i, option in enumerate(options)]
+
+    unit = "อันดับแรก" if ballots.ranked else "โหวต"
+    shown = range(len(options))
+    if not ballots.ranked and len(options) > POLL_RESULTS_SHOWN:
+        shown = sorted(shown, key=lambda i: -counts[i])[:POLL_RESULTS_SHOWN]
+    lines = [f"`{i + 1}.` **{options[i]}**: {counts[i]} {unit}" for i in shown]
+    if len(shown) < len(options):
+        lines.append(f"…และอีก {len(options) - len(shown)} ตัวเลือก")
+    if ballots.ranked and ballots.voter_count:
+        with POLL_TALLY_LATENCY.time(mode="ranked"):
+            winner, rounds = ballots.instant_runoff()
+        if winner is None:
+            lines.insert(0, f"🤝 ยังไม่มีผู้ชนะ (เสมอกันหลังนับ {len(rounds)} รอบ)\n")
+        else:
+            lines.insert(0, f"🏆 ผู้ชนะ: **{options[winner]}** (นับ {len(rounds)} รอบ)\n")
+    return lines
+
+def _clip_lines(lines: list, limit: int) -> str:
+    """รวมบรรทัดให้ไม่เกินความยาวที่ Discord กำหนด"""
+    text = ""
+    for line in lines:
+        if len(text) + len(line) + 2 > limit:
+            return text + "…"
+        text += line + "\n"
+    return text
+
+
 # --- คลาสระบบโพลล์ (Poll System Class) ---
+class PollRankingModal(discord.ui.Modal):
+    """ฟอร์มให้ผู้ใช้พิมพ์หมายเลขตัวเลือกเรียงตามลำดับความชอบ สำหรับโพลล์แบบจัดอันดับ"""
+    def __init__(self, view: "PollView", current: list):
+        super().__init__(title="จัดอันดับตัวเลือก")
+        self.poll_view = view
+        self.ranking = discord.ui.TextInput(
+            label="หมายเลขตัวเลือก เรียงจากชอบมากไปน้อย",
+            placeholder=f"เช่น 3, 1, 7 (สูงสุด {active_polls[view.poll_id]['ballots'].width} อันดับ)",
+            default=", ".join(str(choice + 1) for choice in current) or None,
+            max_length=400,
+        )
+        self.add_item(self.ranking)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        with _track_inflight_interaction(), COMPONENT_LATENCY.time(component="poll_rank", status="ok"):
+            await self.poll_view._record_ranking(interaction, self.ranking.value)
+
+
 class PollView(discord.ui.View):
     """
-    View สำหรับจัดการการโต้ตอบปุ่มของระบบโพลล์
+    View สำหรับจัดการการโต้ตอบของระบบโพลล์
+    โพลล์แบบเลือกเดียวที่มีไม่เกิน 24 ตัวเลือกใช้ปุ่ม, โพลล์ที่ใหญ่กว่าหรือเลือกได้หลายตัวใช้เมนูเลือก,
+    ส่วนโพลล์แบบจัดอันดับใช้ปุ่มเปิดฟอร์มกรอกลำดับ
     """
-    def __init__(self, poll_id, question, options):
+    def __init__(self, poll_id, question, options, mode="single"):
         super().__init__(timeout=None) # คงโพลล์ให้ทำงานไปเรื่อยๆ จนกว่าจะถูกลบหรือหมดอายุโดย Discord
         self.poll_id = poll_id
         self.question = question
         self.options = options
+        self.mode = mode
         
         # เริ่มต้นโครงสร้างข้อมูลโหวตสำหรับโพลล์นี้ หากยังไม่มี
         if poll_id not in active_polls:
-            active_polls[poll_id] = {
-                "question": question,
-                "options": options,
-                "votes": {option: set() for option in options} # ใช้ set เพื่อเก็บ user ID ป้องกันการโหวตซ้ำ
-            }
+            active_polls[poll_id] = _new_poll(None, question, options, mode)
         
-        # เพิ่มปุ่มสำหรับแต่ละตัวเลือกแบบไดนามิก
-        for i, option in enumerate(options):
-            button = discord.ui.Button(label=option, custom_id=f"poll_{poll_id}_{i}", style=discord.ButtonStyle.primary)
-            button.callback = self._button_callback # กำหนด callback เฉพาะสำหรับปุ่มนี้
-            self.add_item(button)
+        if _poll_uses_buttons(mode, options):
+            # เพิ่มปุ่มสำหรับแต่ละตัวเลือกแบบไดนามิก
+            for i, option in enumerate(options):
+                button = discord.ui.Button(label=option, custom_id=f"poll_{poll_id}_{i}", style=discord.ButtonStyle.primary)
+                button.callback = self._button_callback # กำหนด callback เฉพาะสำหรับปุ่มนี้
+                self.add_item(button)
+        elif mode == "ranked":
+            rank_button = discord.ui.Button(label="🗳️ จัดอันดับ", custom_id=f"poll_rank_{poll_id}", style=discord.ButtonStyle.primary)
+            rank_button.callback = self._rank_button_callback
+            self.add_item(rank_button)
+        else:
+            # เมนูละไม่เกิน 25 ตัวเลือก ค่าของแต่ละตัวเลือกคือดัชนีในโพลล์
+            for chunk, start in enumerate(range(0, len(options), POLL_SELECT_CHUNK)):
+                chunk_options = options[start:start + POLL_SELECT_CHUNK]
+                select = discord.ui.Select(
+                    custom_id=f"poll_select_{poll_id}_{chunk}",
+                    placeholder=f"ตัวเลือกที่ {start + 1}-{start + len(chunk_options)}",
+                    min_values=0 if mode == "multi" else 1,
+                    max_values=len(chunk_options) if mode == "multi" else 1,
+                    options=[discord.SelectOption(label=f"{start + i + 1}. {option}"[:100], value=str(start + i))
+                             for i, option in enumerate(chunk_options)],
+                )
+                select.callback = self._select_callback
+                self.add_item(select)
 
         # เพิ่มปุ่ม "แสดงผลลัพธ์"
         show_results_button_item = discord.ui.Button(label="แสดงผลลัพธ์", style=discord.ButtonStyle.secondary, custom_id=f"poll_show_results_{poll_id}")
-        show_results_button_item.callback = self.show_results_button 
+        show_results_button_item.callback = self._show_results_callback
         self.add_item(show_results_button_item)
 
     async def on_timeout(self):
         """เหตุการณ์นี้จะถูกเรียกเมื่อ View หมดเวลา (ถ้ามีการตั้ง timeout)"""
-        logging.info(f"Poll {self.poll_id} หมดเวลา.")
+        logging.info("Poll %s หมดเวลา.", self.poll_id)
         # สำหรับโพลล์ที่ไม่สิ้นสุด อาจไม่ถึงตรงนี้เว้นแต่จะหยุดอย่างชัดเจน
         # คุณอาจต้องการปิดใช้งานปุ่มหรือลบข้อมูลโพลล์ที่นี่
         # self.clear_items()
@@ -642,14 +3506,9 @@ class PollView(discord.ui.View):
         #     del active_polls[self.poll_id]
 
     # Callback สำหรับปุ่ม "แสดงผลลัพธ์"
-    @discord.ui.button(label="แสดงผลลัพธ์", style=discord.ButtonStyle.secondary, custom_id="show_results_placeholder") # custom_id ที่นี่เป็นเพียง placeholder
-    async def show_results_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+    # ปุ่มถูกเพิ่มใน __init__ ด้วย custom_id ของโพลล์ (ไม่ใช้ @discord.ui.button เพื่อไม่ให้มีปุ่มซ้ำกินที่ในตาราง 5x5)
+    async def _show_results_callback(self, interaction: discord.Interaction):
         """จัดการการคลิกปุ่ม 'แสดงผลลัพธ์'"""
-        expected_custom_id = f"poll_show_results_{self.poll_id}"
-        if button.custom_id != expected_custom_id:
-            await interaction.response.send_message("❌ ปุ่ม 'แสดงผลลัพธ์' นี้ไม่ได้เชื่อมโยงกับโพลล์ที่ใช้งานอยู่.", ephemeral=True)
-            return
-
         # อัปเดตข้อความโพลล์เพื่อแสดงผลลัพธ์ล่าสุด
         await self.update_poll_message(interaction.message)
         await interaction.response.defer() # ยืนยันการกดปุ่มโดยไม่ต้องส่งข้อความใหม่
@@ -661,38 +3520,53 @@ class PollView(discord.ui.View):
 
     async def on_error(self, interaction: discord.Interaction, error: Exception, item: discord.ui.Item):
         """จัดการข้อผิดพลาดที่เกิดขึ้นระหว่างการโต้ตอบปุ่ม"""
-        logging.error(f"ข้อผิดพลาดในการโต้ตอบโพลล์: {error}", exc_info=True)
+        logging.error("ข้อผิดพลาดในการโต้ตอบโพลล์: %s", error, exc_info=True)
         try:
             await interaction.followup.send(f"❌ เกิดข้อผิดพลาดขณะประมวลผลการโหวตของคุณ: {error}", ephemeral=True)
         except discord.errors.NotFound:
-            logging.warning(f"ไม่สามารถส่งข้อความแสดงข้อผิดพลาดไปยัง webhook (Unknown Webhook) สำหรับการโต้ตอบ {interaction.id}. ข้อผิดพลาดดั้งเดิม: {error}")
+            logging.warning("ไม่สามารถส่งข้อความแสดงข้อผิดพลาดไปยัง webhook (Unknown Webhook) สำหรับการโต้ตอบ %s. ข้อผิดพลาดดั้งเดิม: %s", interaction.id, error)
         except Exception as e:
-            logging.error(f"ไม่สามารถส่งข้อความแสดงข้อผิดพลาดใน on_error. ข้อผิดพลาดรอง: {e}", exc_info=True)
+            logging.error("ไม่สามารถส่งข้อความแสดงข้อผิดพลาดใน on_error. ข้อผิดพลาดรอง: %s", e, exc_info=True)
 
 
     async def update_poll_message(self, message: discord.Message):
         """อัปเดตข้อความโพลล์พร้อมจำนวนคะแนนโหวตปัจจุบัน"""
         poll_data = active_polls.get(message.id)
         if not poll_data:
-            logging.warning(f"พยายามอัปเดตโพลล์ที่ไม่มีอยู่: {message.id}")
+            logging.warning("พยายามอัปเดตโพลล์ที่ไม่มีอยู่: %s", message.id)
             return
 
         embed = discord.Embed(
             title=f"📊 โพลล์: {poll_data['question']}",
             color=discord.Color.purple()
         )
+        embed.description = _clip_lines(_poll_result_lines(poll_data), 4096) or "ยังไม่มีคะแนนโหวต."
+        embed.set_footer(text=f"Poll ID: {message.id} • {POLL_MODES[poll_data['mode']]} • ผู้โหวต {poll_data['ballots'].voter_count} คน")
+        
+        await message.edit(embed=embed, view=self)
+
+    def schedule_refresh(self, message: discord.Message):
+        """รวบการอัปเดตข้อความผลโหวตที่เกิดถี่ๆ ให้เหลือหนึ่งครั้งต่อ POLL_REFRESH_INTERVAL"""
+        if message is None or message.id in _poll_refresh_tasks:
+            return
+
+        async def refresh():
+            await asyncio.sleep(POLL_REFRESH_INTERVAL)
+            _poll_refresh_tasks.pop(message.id, None) # โหวตที่เข้ามาระหว่างแก้ไขข้อความจะนัดรอบใหม่
+            try:
+                await self.update_poll_message(message)
+            except discord.HTTPException as e:
+                logging.warning("อัปเดตข้อความโพลล์ %s ไม่สำเร็จ: %s", message.id, e)
 
-        results_text = ""
-        for option, voters in poll_data['votes'].items():
-            results_text += f"**{option}**: {len(voters)} โหวต\n"
-        
-        embed.description = results_text if results_text else "ยังไม่มีคะแนนโหวต."
-        embed.set_footer(text=f"Poll ID: {message.id}")
-        
-        await message.edit(embed=embed, view=self)
+        _poll_refresh_tasks[message.id] = asyncio.create_task(refresh())
 
     async def _button_callback(self, interaction: discord.Interaction): 
         """Callback สำหรับปุ่มตัวเลือกโพลล์"""
+        with _track_inflight_interaction(), COMPONENT_LATENCY.time(component="poll_vote", status="ok"):
+            await self._handle_vote(interaction)
+
+    async def _handle_vote(self, interaction: discord.Interaction):
+        """บันทึกการโหวตจากปุ่มตัวเลือก และอัปเดตข้อความโพลล์"""
         custom_id = interaction.data['custom_id'] 
         parts = custom_id.split('_')
         if len(parts) != 3 or parts[0] != "poll":
@@ -710,54 +3584,115 @@ class PollView(discord.ui.View):
         
         selected_option = poll_data['options'][option_index]
 
-        # ลบการโหวตก่อนหน้าของผู้ใช้จากตัวเลือกใดๆ (หากผู้ใช้สามารถโหวตได้เพียงตัวเลือกเดียว)
-        user_changed_vote = False
-        for option_key, voters_set in poll_data['votes'].items():
-            if user_id in voters_set and option_key != selected_option:
-                voters_set.remove(user_id)
-                user_changed_vote = True
-                logging.info(f"ผู้ใช้ {user_id} ลบการโหวตจาก {option_key} ในโพลล์ {poll_id}")
-                break
-        
-        # เพิ่มการโหวตใหม่
-        if user_id not in poll_data['votes'][selected_option]:
-            poll_data['votes'][selected_option].add(user_id)
-            logging.info(f"ผู้ใช้ {user_id} โหวตให้ {selected_option} ในโพลล์ {poll_id}")
+        # โพลล์แบบปุ่มเลือกได้ตัวเลือกเดียว: บัตรใหม่แทนที่บัตรเดิมของผู้ใช้
+        previous = poll_data['ballots'].cast(user_id, [option_index])
+        if previous != [option_index]:
+            logging.info("ผู้ใช้ %s โหวตให้ %s ในโพลล์ %s (เดิม: %s)", user_id, selected_option, poll_id, previous)
             status_message = f"✅ คุณได้โหวตให้: **{selected_option}**"
         else:
             status_message = f"✅ คุณยังคงโหวตให้: **{selected_option}**"
-            logging.info(f"ผู้ใช้ {user_id} ยืนยันการโหวตสำหรับ {selected_option} ในโพลล์ {poll_id}")
+            logging.info("ผู้ใช้ %s ยืนยันการโหวตสำหรับ %s ในโพลล์ %s", user_id, selected_option, poll_id)
 
-        await self.update_poll_message(interaction.message)
+        self.schedule_refresh(interaction.message)
+        await interaction.response.send_message(status_message, ephemeral=True)
+
+    async def _select_callback(self, interaction: discord.Interaction):
+        """Callback สำหรับเมนูเลือกของโพลล์ขนาดใหญ่/เลือกได้หลายตัวเลือก"""
+        with _track_inflight_interaction(), COMPONENT_LATENCY.time(component="poll_select", status="ok"):
+            poll_data = active_polls.get(self.poll_id)
+            if not poll_data:
+                await interaction.response.send_message("❌ โพลล์นี้ไม่ทำงานแล้ว.", ephemeral=True)
+                return
+
+            chunk = int(interaction.data['custom_id'].rsplit('_', 1)[1])
+            start = chunk * POLL_SELECT_CHUNK
+            end = min(start + POLL_SELECT_CHUNK, len(poll_data['options']))
+            picked = [int(value) for value in interaction.data.get('values', []) if start <= int(value) < end]
+            ballots = poll_data['ballots']
+            if poll_data['mode'] == "multi":
+                # เมนูแต่ละอันแทนที่เฉพาะตัวเลือกในช่วงของตัวเอง ตัวเลือกจากเมนูอื่นยังคงอยู่
+                ballot = sorted([i for i in ballots.ballot(interaction.user.id) if not start <= i < end] + picked)
+            else:
+                ballot = picked[:1] or ballots.ballot(interaction.user.id)
+            ballots.cast(interaction.user.id, ballot)
+            logging.info("ผู้ใช้ %s เลือก %s ในโพลล์ %s", interaction.user.id, ballot, self.poll_id)
+
+            if ballot:
+                chosen = ", ".join(poll_data['options'][i] for i in ballot)
+                status_message = _clip_lines([f"✅ ตัวเลือกของคุณ: **{chosen}**"], 2000)
+            else:
+                status_message = "✅ ล้างการโหวตของคุณแล้ว"
+            self.schedule_refresh(interaction.message)
+            await interaction.response.send_message(status_message, ephemeral=True)
+
+    async def _rank_button_callback(self, interaction: discord.Interaction):
+        """เปิดฟอร์มจัดอันดับ โดยใส่ลำดับเดิมของผู้ใช้ไว้ให้แก้ไข"""
+        poll_data = active_polls.get(self.poll_id)
+        if not poll_data:
+            await interaction.response.send_message("❌ โพลล์นี้ไม่ทำงานแล้ว.", ephemeral=True)
+            return
+        await interaction.response.send_modal(PollRankingModal(self, poll_data['ballots'].ballot(interaction.user.id)))
+
+    async def _record_ranking(self, interaction: discord.Interaction, text: str):
+        """บันทึกบัตรแบบจัดอันดับจากหมายเลขตัวเลือก (เริ่มที่ 1) ที่ผู้ใช้กรอก"""
+        poll_data = active_polls.get(self.poll_id)
+        if not poll_data:
+            await interaction.response.send_message("❌ โพลล์นี้ไม่ทำงานแล้ว.", ephemeral=True)
+            return
+
+        options = poll_data['options']
+        ranking = [int(number) - 1 for number in re.findall(r"\d+", text)]
+        invalid = [index + 1 for index in ranking if not 0 <= index < len(options)]
+        if invalid:
+            await interaction.response.send_message(
+                f"❌ ไม่มีตัวเลือกหมายเลข {', '.join(map(str, invalid))} (มีทั้งหมด {len(options)} ตัวเลือก)", ephemeral=True)
+            return
+
+        ballots = poll_data['ballots']
+        ballots.cast(interaction.user.id, ranking)
+        ballot = ballots.ballot(interaction.user.id)
+        logging.info("ผู้ใช้ %s จัดอันดับ %s ในโพลล์ %s", interaction.user.id, ballot, self.poll_id)
+
+        if ballot:
+            status_message = _clip_lines(["✅ บันทึกอันดับของคุณแล้ว:"] + [f"{rank}. {options[i]}" for rank, i in enumerate(ballot, 1)], 2000)
+        else:
+            status_message = "✅ ล้างการโหวตของคุณแล้ว"
+        self.schedule_refresh(interaction.message)
         await interaction.response.send_message(status_message, ephemeral=True)
 
 
 @tree.command(name="poll", description="สร้างโพลล์ด้วยตัวเลือก")
 @app_commands.describe(question="คำถามสำหรับโพลล์")
 @app_commands.describe(options="ตัวเลือกสำหรับโพลล์ (คั่นด้วยจุลภาค เช่น ตัวเลือก A, ตัวเลือก B)")
-async def create_poll(interaction: discord.Interaction, question: str, options: str):
-    """คำสั่งสำหรับสร้างโพลล์ใหม่พร้อมปุ่มโหวต"""
+@app_commands.describe(mode="รูปแบบการโหวต (ค่าเริ่มต้น: เลือกได้หนึ่งตัวเลือก)")
+@app_commands.choices(mode=[app_commands.Choice(name=label, value=value) for value, label in POLL_MODES.items()])
+async def create_poll(interaction: discord.Interaction, question: str, options: str, mode: str = "single"):
+    """คำสั่งสำหรับสร้างโพลล์ใหม่: ปุ่มโหวตสำหรับโพลล์เล็ก, เมนูเลือกหรือฟอร์มจัดอันดับสำหรับโพลล์ใหญ่"""
     option_list = [opt.strip() for opt in options.split(',') if opt.strip()]
 
     if not option_list:
         await interaction.response.send_message("❌ โปรดระบุตัวเลือกอย่างน้อยหนึ่งตัวเลือกสำหรับโพลล์", ephemeral=True)
         return
     
-    if len(option_list) > 25: # Discord จำกัดปุ่มไว้ที่ 5 แถว แถวละ 5 ปุ่ม (รวม 25 ปุ่ม)
-        await interaction.response.send_message("❌ รองรับสูงสุด 25 ตัวเลือกสำหรับโพลล์เท่านั้น", ephemeral=True)
+    if len(option_list) > POLL_MAX_OPTIONS:
+        await interaction.response.send_message(f"❌ รองรับสูงสุด {POLL_MAX_OPTIONS} ตัวเลือกสำหรับโพลล์เท่านั้น", ephemeral=True)
         return
 
+    if _poll_uses_buttons(mode, option_list):
+        instructions = "คลิกปุ่มด้านล่างเพื่อโหวต!"
+    elif mode == "ranked":
+        instructions = f"กด **🗳️ จัดอันดับ** แล้วใส่หมายเลขตัวเลือกเรียงจากชอบมากไปน้อย (สูงสุด {min(len(option_list), POLL_MAX_RANKS)} อันดับ)"
+    else:
+        instructions = "เลือกจากเมนูด้านล่างเพื่อโหวต!"
     embed = discord.Embed(
         title=f"📊 โพลล์: {question}",
-        description="คลิกปุ่มด้านล่างเพื่อโหวต!",
+        description=instructions,
         color=discord.Color.blue()
     )
-    embed.set_footer(text=f"โพลล์สร้างโดย: {interaction.user.display_name}")
+    embed.set_footer(text=f"โพลล์สร้างโดย: {interaction.user.display_name} • {POLL_MODES[mode]}")
 
-    initial_results_text = ""
-    for option in option_list:
-        initial_results_text += f"**{option}**: 0 โหวต\n"
-    embed.add_field(name="ผลโหวตเบื้องต้น", value=initial_results_text, inline=False)
+    poll_data = _new_poll(None, question, option_list, mode)
+    embed.add_field(name="ผลโหวตเบื้องต้น", value=_clip_lines(_poll_result_lines(poll_data), 1024), inline=False)
 
     await interaction.response.defer(ephemeral=False)
 
@@ -765,173 +3700,1127 @@ async def create_poll(interaction: discord.Interaction, question: str, options:
     message = await interaction.followup.send(embed=embed)
     
     # เก็บข้อมูลโพลล์ทันทีที่ Message ID พร้อมใช้งาน
-    active_polls[message.id] = {
-        "question": question,
-        "options": option_list,
-        "votes": {option: set() for option in option_list}
-    }
+    poll_data["channel_id"] = message.channel.id
+    active_polls[message.id] = poll_data
 
     # สร้าง Instance ของ PollView และแนบไปกับข้อความ
-    poll_view = PollView(message.id, question, option_list)
+    poll_view = PollView(message.id, question, option_list, mode)
     await message.edit(view=poll_view) 
-    logging.info(f"โพลล์สร้างโดย {interaction.user.display_name}: ID {message.id}, คำถาม: {question}, ตัวเลือก: {options}")
+    logging.info("โพลล์สร้างโดย %s: ID %s, คำถาม: %s, รูปแบบ: %s, ตัวเลือก %s รายการ",
+                 interaction.user.display_name, message.id, question, mode, len(option_list))
 
 
-@tree.command(name="pause", description="หยุดเล่น Spotify ชั่วคราว")
-async def pause_spotify(interaction: discord.Interaction):
-    """คำสั่งสำหรับหยุดเล่นเพลง Spotify ชั่วคราว"""
-    sp_user = get_user_spotify_client(interaction.user.id)
+async def _spotify_playback_command(interaction: discord.Interaction, method_name: str, success_message: str, error_text: str):
+    """ใช้ร่วมกันโดย /pause /resume /skip /previous: defer ทันทีแล้วเรียกเมธอดควบคุมการเล่นของ Spotify"""
+    sp_user = spotify_users.get(interaction.user.id)
     if not sp_user:
         await interaction.response.send_message("❌ กรุณาเชื่อมโยงบัญชี Spotify ของคุณก่อนโดยใช้ /link_spotify", ephemeral=True)
         return
-    
-    try:
-        await asyncio.to_thread(sp_user.pause_playback)
-        await interaction.response.send_message("⏸️ หยุดเล่น Spotify ชั่วคราว", ephemeral=True)
-    except spotipy.exceptions.SpotifyException as e:
-        await interaction.response.send_message(f"❌ ข้อผิดพลาดในการหยุดเล่น Spotify: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดในการหยุดเล่น Spotify สำหรับผู้ใช้ {interaction.user.id}: {e}", exc_info=True)
-    except Exception as e:
-        await interaction.response.send_message(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดที่ไม่คาดคิดในคำสั่ง pause: {e}", exc_info=True)
+
+    async def work():
+        try:
+            await spotify_control_flight.do((interaction.user.id, method_name), _spotify_call, getattr(sp_user, method_name))
+            await interaction.followup.send(success_message, ephemeral=True)
+        except spotipy.exceptions.SpotifyException as e:
+            if e.http_status == 401:
+                await forget_spotify_user(interaction.user.id)
+                await interaction.followup.send("❌ โทเค็น Spotify หมดอายุ กรุณาเชื่อมโยงบัญชีของคุณใหม่โดยใช้ /link_spotify.", ephemeral=True)
+            else:
+                await interaction.followup.send(f"❌ {error_text}: {e}", ephemeral=True)
+            logging.error("%s สำหรับผู้ใช้ %s: %s", error_text, interaction.user.id, e, exc_info=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}", ephemeral=True)
+            logging.error("ข้อผิดพลาดที่ไม่คาดคิดในคำสั่ง %s: %s", interaction.command.name if interaction.command else method_name, e, exc_info=True)
+
+    await run_deferred(interaction, work, ephemeral=True)
+
+@tree.command(name="pause", description="หยุดเล่น Spotify ชั่วคราว")
+async def pause_spotify(interaction: discord.Interaction):
+    """คำสั่งสำหรับหยุดเล่นเพลง Spotify ชั่วคราว"""
+    await _spotify_playback_command(interaction, "pause_playback", "⏸️ หยุดเล่น Spotify ชั่วคราว", "ข้อผิดพลาดในการหยุดเล่น Spotify")
 
 @tree.command(name="resume", description="เล่น Spotify ต่อ")
 async def resume_spotify(interaction: discord.Interaction):
     """คำสั่งสำหรับเล่นเพลง Spotify ต่อจากที่หยุดไว้"""
-    sp_user = get_user_spotify_client(interaction.user.id)
-    if not sp_user:
-        await interaction.response.send_message("❌ กรุณาเชื่อมโยงบัญชี Spotify ของคุณก่อนโดยใช้ /link_spotify", ephemeral=True)
-        return
-    
-    try:
-        await asyncio.to_thread(sp_user.start_playback)
-        await interaction.response.send_message("▶️ เล่น Spotify ต่อ", ephemeral=True)
-    except spotipy.exceptions.SpotifyException as e:
-        await interaction.response.send_message(f"❌ ข้อผิดพลาดในการเล่น Spotify ต่อ: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดในการเล่น Spotify ต่อสำหรับผู้ใช้ {interaction.user.id}: {e}", exc_info=True)
-    except Exception as e:
-        await interaction.response.send_message(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดที่ไม่คาดคิดในคำสั่ง resume: {e}", exc_info=True)
+    await _spotify_playback_command(interaction, "start_playback", "▶️ เล่น Spotify ต่อ", "ข้อผิดพลาดในการเล่น Spotify ต่อ")
 
 @tree.command(name="skip", description="ข้ามเพลงปัจจุบัน")
 async def skip_spotify(interaction: discord.Interaction):
     """คำสั่งสำหรับข้ามเพลง Spotify ปัจจุบัน"""
-    sp_user = get_user_spotify_client(interaction.user.id)
-    if not sp_user:
-        await interaction.response.send_message("❌ กรุณาเชื่อมโยงบัญชี Spotify ของคุณก่อนโดยใช้ /link_spotify", ephemeral=True)
-        return
-    
-    try:
-        await asyncio.to_thread(sp_user.next_track)
-        await interaction.response.send_message("⏭️ ข้ามเพลงแล้ว", ephemeral=True)
-    except spotipy.exceptions.SpotifyException as e:
-        await interaction.response.send_message(f"❌ ข้อผิดพลาดในการข้าม Spotify: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดในการข้าม Spotify สำหรับผู้ใช้ {interaction.user.id}: {e}", exc_info=True)
-    except Exception as e:
-        await interaction.response.send_message(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดที่ไม่คาดคิดในคำสั่ง skip: {e}", exc_info=True)
+    await _spotify_playback_command(interaction, "next_track", "⏭️ ข้ามเพลงแล้ว", "ข้อผิดพลาดในการข้าม Spotify")
 
 @tree.command(name="previous", description="เล่นเพลงก่อนหน้าบน Spotify")
 async def previous_spotify(interaction: discord.Interaction):
     """คำสั่งสำหรับเล่นเพลงก่อนหน้าบน Spotify"""
-    sp_user = get_user_spotify_client(interaction.user.id)
-    if not sp_user:
-        await interaction.response.send_message("❌ กรุณาเชื่อมโยงบัญชี Spotify ของคุณก่อนโดยใช้ /link_spotify", ephemeral=True)
+    await _spotify_playback_command(interaction, "previous_track", "⏮️ เล่นเพลงก่อนหน้าแล้ว", "ข้อผิดพลาดในการเล่นเพลงก่อนหน้าบน Spotify")
+
+@tree.command(name="autoplay", description="เปิด/ปิดการเล่นเพลงที่เกี่ยวข้องต่ออัตโนมัติเมื่อคิวหมด")
+@app_commands.describe(enabled="เปิด (True) หรือปิด (False)")
+async def autoplay(interaction: discord.Interaction, enabled: bool):
+    """คำสั่งสำหรับเปิด/ปิดโหมด autoplay ของคิว (YouTube/SoundCloud)"""
+    set_autoplay(enabled, interaction.user.id)
+    if enabled:
+        await interaction.response.send_message("📻 เปิด autoplay แล้ว: เมื่อคิวหมดจะเล่นเพลงที่เกี่ยวข้องต่อ")
+    else:
+        await interaction.response.send_message("⏹️ ปิด autoplay แล้ว")
+
+@tree.command(name="seek", description="เลื่อนไปยังตำแหน่งในเพลงที่กำลังเล่นจากคิว")
+@app_commands.describe(position="ตำแหน่ง เช่น 90, 1:30 หรือ 1:02:03")
+async def seek(interaction: discord.Interaction, position: str):
+    """คำสั่งสำหรับเลื่อนตำแหน่งเพลงในคิว (YouTube/SoundCloud) ที่กำลังเล่น"""
+    try:
+        target = parse_timestamp(position)
+    except ValueError:
+        await interaction.response.send_message("❌ รูปแบบเวลาไม่ถูกต้อง (ตัวอย่าง: 90, 1:30)", ephemeral=True)
         return
-    
     try:
-        await asyncio.to_thread(sp_user.previous_track)
-        await interaction.response.send_message("⏮️ เล่นเพลงก่อนหน้าแล้ว", ephemeral=True)
-    except spotipy.exceptions.SpotifyException as e:
-        await interaction.response.send_message(f"❌ ข้อผิดพลาดในการเล่นเพลงก่อนหน้าบน Spotify: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดในการเล่นเพลงก่อนหน้าบน Spotify สำหรับผู้ใช้ {interaction.user.id}: {e}", exc_info=True)
-    except Exception as e:
-        await interaction.response.send_message(f"❌ เกิดข้อผิดพลาดที่ไม่คาดคิด: {e}", ephemeral=True)
-        logging.error(f"ข้อผิดพลาดที่ไม่คาดคิดในคำสั่ง previous: {e}", exc_info=True)
+        seek_current_track(target)
+    except ValueError as e:
+        await interaction.response.send_message(f"❌ {e}", ephemeral=True)
+        return
+    duration = now_playing.get("duration")
+    total = f" / {_format_seconds(duration)}" if duration else ""
+    await interaction.response.send_message(f"⏩ เลื่อนไปที่ **{_format_seconds(target)}**{total}")
 
 @tree.command(name="speak", description="ให้บอทพูดในช่องเสียง")
 @app_commands.describe(message="ข้อความที่จะให้บอทพูด")
 @app_commands.describe(lang="ภาษา (เช่น 'en', 'th')")
 async def speak(interaction: discord.Interaction, message: str, lang: str = 'en'):
     """คำสั่งสำหรับให้บอทพูดข้อความที่ระบุในช่องเสียง (TTS)"""
-    global voice_client
     if not voice_client or not voice_client.is_connected():
         await interaction.response.send_message("❌ บอทไม่ได้อยู่ในช่องเสียง. ใช้ /join ก่อน", ephemeral=True)
         return
-    
-    await interaction.response.defer() 
-    try:
-        tts_filename = f"tts_discord_{interaction.id}.mp3"
-        await asyncio.to_thread(gTTS(message, lang=lang).save, tts_filename) 
-        
-        source = discord.FFmpegPCMAudio(tts_filename, executable="ffmpeg")
-        voice_client.play(source, after=lambda e: asyncio.create_task(cleanup_audio(e, tts_filename))) 
-        
-        await interaction.followup.send(f"🗣️ กำลังพูด: **{message}** (ภาษา: {lang})")
 
-    except Exception as e:
-        await interaction.followup.send(f"❌ เกิดข้อผิดพลาดในการพูด: {e}")
-        logging.error(f"ข้อผิดพลาด TTS: {e}", exc_info=True)
+    async def work():
+        try:
+            source, backend_name = await synthesize_speech(message, lang)
+            voice_client.play(source, after=_after_tts_playback)
+            logging.info("TTS (%s): %s", backend_name, message)
+
+            await interaction.followup.send(f"🗣️ กำลังพูด: **{message}** (ภาษา: {lang})")
+
+        except Exception as e:
+            await interaction.followup.send(f"❌ เกิดข้อผิดพลาดในการพูด: {e}")
+            logging.error("ข้อผิดพลาด TTS: %s", e, exc_info=True)
+
+    await run_deferred(interaction, work)
+
+# --- ส่ง DM จำนวนมาก ---
+# user.send() สร้าง DM channel ใหม่ทุกครั้งที่ยังไม่มีใน cache และยิงตรงไปที่ rate limit ของ Discord
+# DMDispatcher เก็บ DM channel ไว้ใช้ซ้ำ จำกัดจำนวนที่ส่งพร้อมกัน และจำกัดอัตราแยกตาม route
+# (สร้าง DM channel / ส่งข้อความ) ด้วย token bucket เพื่อไม่ให้ชน rate limit ระดับ global
+DM_CONCURRENCY = int(os.getenv("DM_CONCURRENCY", "5"))
+DM_SEND_RATE = float(os.getenv("DM_SEND_RATE", "4")) # ข้อความต่อวินาที
+DM_CREATE_RATE = float(os.getenv("DM_CREATE_RATE", "2")) # DM channel ใหม่ต่อวินาที
+DM_CHANNEL_CACHE_SIZE = int(os.getenv("DM_CHANNEL_CACHE_SIZE", "5000"))
+WAKE_BULK_MAX_TARGETS = int(os.getenv("WAKE_BULK_MAX_TARGETS", "250"))
+WAKE_BULK_TIMEOUT = float(os.getenv("WAKE_BULK_TIMEOUT", "600")) # interaction token ใช้ได้ 15 นาที
+WAKE_PROGRESS_INTERVAL = 2.0 # แก้ข้อความความคืบหน้าไม่บ่อยกว่านี้ (วินาที)
+
+DM_SENDS = metrics.counter("dm_send_total", "จำนวน DM ที่ส่งผ่าน DMDispatcher แยกตามผลลัพธ์", ("status",))
+DM_RATE_LIMIT_WAIT = metrics.histogram(
+    "dm_rate_limit_wait_seconds", "เวลาที่รอ token bucket ก่อนเรียก Discord แยกตาม route", ("route",),
+    buckets=(0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+class TokenBucket:
+    """จำกัดอัตราแบบ token bucket: เติม rate token ต่อวินาที สะสมได้ไม่เกิน burst"""
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None # สร้างบน event loop เมื่อใช้ครั้งแรก
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class DMDispatcher:
+    """ส่ง DM ถึงผู้ใช้หลายคน โดยใช้ DM channel ที่ cache ไว้ และจำกัดทั้งจำนวนพร้อมกันและอัตราต่อ route"""
+    def __init__(self, concurrency: int, send_rate: float, create_rate: float, cache_size: int):
+        self.concurrency = concurrency
+        self.cache_size = cache_size
+        self._buckets = {"send": TokenBucket(send_rate), "create_dm": TokenBucket(create_rate)}
+        self._channels = collections.OrderedDict() # Key: user ID, Value: DMChannel (LRU)
+        self._semaphore = None
+
+    async def _throttle(self, route: str):
+        started = time.perf_counter()
+        await self._buckets[route].acquire()
+        DM_RATE_LIMIT_WAIT.observe(time.perf_counter() - started, route=route)
+
+    async def _dm_channel(self, user: discord.abc.User) -> discord.DMChannel:
+        channel = self._channels.get(user.id) or user.dm_channel
+        if channel is None:
+            await self._throttle("create_dm")
+            channel = await user.create_dm()
+        self._channels[user.id] = channel
+        self._channels.move_to_end(user.id)
+        while len(self._channels) > self.cache_size:
+            self._channels.popitem(last=False)
+        return channel
+
+    async def send(self, user: discord.abc.User, content: str):
+        """ส่ง DM หนึ่งข้อความ (ส่งต่อ discord.Forbidden / HTTPException ให้ผู้เรียก)"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            try:
+                channel = await self._dm_channel(user)
+                await self._throttle("send")
+                await channel.send(content)
+            except discord.Forbidden:
+                DM_SENDS.inc(status="forbidden")
+                raise
+            except Exception:
+                DM_SENDS.inc(status="error")
+                raise
+        DM_SENDS.inc(status="ok")
+
+    async def send_many(self, users: list, content: str, progress=None) -> dict:
+        """
+        ส่ง DM ถึงผู้ใช้ทุกคนพร้อมกัน (ภายใต้ข้อจำกัดของ dispatcher)
+        progress: coroutine function (done, total) ที่ถูกเรียกเมื่อส่งเสร็จแต่ละคน
+        คืนค่า {"sent": [user], "forbidden": [user], "failed": [(user, error)]}
+        """
+        summary = {"sent": [], "forbidden": [], "failed": []}
+
+        async def deliver(user):
+            try:
+                await self.send(user, content)
+                summary["sent"].append(user)
+            except discord.Forbidden:
+                summary["forbidden"].append(user)
+            except Exception as e:
+                summary["failed"].append((user, e))
+                logging.warning("ไม่สามารถส่ง DM ถึง %s: %s", user.id, e)
+            if progress is not None:
+                try:
+                    await progress(len(summary["sent"]) + len(summary["forbidden"]) + len(summary["failed"]), len(users))
+                except Exception as e:
+                    # การแสดงความคืบหน้าล้มเหลว (เช่น แก้ไขข้อความสถานะไม่ได้) ต้องไม่หยุดการส่งและสรุปผล
+                    logging.warning("ไม่สามารถอัปเดตความคืบหน้าการส่ง DM: %s", e)
+
+        await asyncio.gather(*(deliver(user) for user in users))
+        return summary
+
+dm_dispatcher = DMDispatcher(DM_CONCURRENCY, DM_SEND_RATE, DM_CREATE_RATE, DM_CHANNEL_CACHE_SIZE)
 
 @tree.command(name="wake", description="ปลุกผู้ใช้ด้วย DM")
 @app_commands.describe(user="เลือกผู้ใช้")
 async def wake(interaction: discord.Interaction, user: discord.User):
     """คำสั่งสำหรับส่งข้อความ DM ไปปลุกผู้ใช้"""
+    async def work():
+        try:
+            await dm_dispatcher.send(user, f"⏰ คุณถูก {interaction.user.display_name} ปลุก! ตื่นนน!")
+            await interaction.followup.send(f"✅ ปลุก {user.name} แล้ว", ephemeral=True)
+            logging.info("%s ปลุก %s.", interaction.user.display_name, user.name)
+        except discord.Forbidden:
+            await interaction.followup.send(f"❌ ไม่สามารถส่ง DM ถึง {user.name} ได้ (อาจจะปิด DM หรือเป็นบอท)", ephemeral=True)
+            logging.warning("ไม่สามารถส่ง DM ไปยัง %s (Forbidden).", user.name)
+        except Exception as e:
+            await interaction.followup.send(f"❌ เกิดข้อผิดพลาดในการส่ง DM: {e}", ephemeral=True)
+            logging.error("ไม่สามารถปลุกผู้ใช้: %s ได้", e, exc_info=True)
+
+    await run_deferred(interaction, work, ephemeral=True)
+
+def _format_wake_summary(target_name: str, summary: dict, total: int) -> str:
+    """สรุปผลการปลุกหลายคนในข้อความเดียว"""
+    lines = [f"⏰ ปลุก {target_name}: ส่งสำเร็จ {len(summary['sent'])}/{total} คน"]
+    if summary["forbidden"]:
+        names = ", ".join(user.display_name for user in summary["forbidden"][:20])
+        more = f" และอีก {len(summary['forbidden']) - 20} คน" if len(summary["forbidden"]) > 20 else ""
+        lines.append(f"🔒 ปิด DM ({len(summary['forbidden'])}): {names}{more}")
+    if summary["failed"]:
+        errors = collections.Counter(type(error).__name__ for _, error in summary["failed"])
+        lines.append(f"❌ ล้มเหลว ({len(summary['failed'])}): " + ", ".join(f"{name} x{count}" for name, count in errors.items()))
+    return "\n".join(lines)
+
+@tree.command(name="wake_group", description="ปลุกทุกคนในยศหรือช่องเสียงด้วย DM")
+@app_commands.describe(role="ปลุกสมาชิกทุกคนที่มียศนี้", channel="ปลุกทุกคนที่อยู่ในช่องเสียงนี้")
+@app_commands.guild_only()
+@app_commands.default_permissions(mention_everyone=True)
+async def wake_group(interaction: discord.Interaction, role: discord.Role = None, channel: discord.VoiceChannel = None):
+    """คำสั่งสำหรับส่ง DM ปลุกสมาชิกทั้งยศหรือทั้งช่องเสียงพร้อมกัน พร้อมรายงานความคืบหน้าและสรุปผล"""
+    if (role is None) == (channel is None):
+        await interaction.response.send_message("❌ โปรดเลือกยศหรือช่องเสียงอย่างใดอย่างหนึ่ง", ephemeral=True)
+        return
+    target = role or channel
+    users = [member for member in target.members if not member.bot and member.id != interaction.user.id]
+    if not users:
+        await interaction.response.send_message(f"❌ ไม่มีใครให้ปลุกใน {target.name}", ephemeral=True)
+        return
+    if len(users) > WAKE_BULK_MAX_TARGETS:
+        await interaction.response.send_message(
+            f"❌ {target.name} มีสมาชิก {len(users)} คน เกินกว่าที่ปลุกพร้อมกันได้ ({WAKE_BULK_MAX_TARGETS} คน)", ephemeral=True)
+        return
+
+    async def work():
+        status_message = await interaction.followup.send(f"⏳ กำลังปลุก {len(users)} คนใน {target.name}...", ephemeral=True, wait=True)
+        last_update = time.monotonic()
+
+        async def progress(done, total):
+            nonlocal last_update
+            # แก้ข้อความเป็นระยะเท่านั้น การแก้ทุกครั้งจะแย่ง rate limit กับการส่ง DM
+            if done < total and time.monotonic() - last_update >= WAKE_PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await status_message.edit(content=f"⏳ กำลังปลุก {target.name}: {done}/{total}")
+
+        started = time.perf_counter()
+        summary = await dm_dispatcher.send_many(
+            users, f"⏰ คุณถูก {interaction.user.display_name} ปลุก (ผ่าน {target.name})! ตื่นนน!", progress)
+        await status_message.edit(content=_format_wake_summary(target.name, summary, len(users)))
+        logging.info("%s ปลุก %s คนใน %s: สำเร็จ %s, ปิด DM %s, ล้มเหลว %s (%.1f วินาที)",
+                     interaction.user.display_name, len(users), target.name, len(summary["sent"]),
+                     len(summary["forbidden"]), len(summary["failed"]), time.perf_counter() - started)
+
+    await run_deferred(interaction, work, ephemeral=True, timeout=WAKE_BULK_TIMEOUT)
+
+# --- คำสั่งควบคุมผู้เล่นจากเว็บ (รันในโปรเซสเดียวกัน หรือส่งผ่าน IPC ไปยัง worker ที่ดูแล guild) ---
+# Key: ชื่อคำสั่ง, Value: coroutine function ที่คืนค่า {"status": หมวดของ flash, "message": str, ...}
+_control_handlers = {}
+
+def control_op(name: str):
+    """ลงทะเบียน coroutine function เป็นคำสั่งควบคุมที่เว็บเรียกได้ผ่าน dispatch_control"""
+    def decorator(function):
+        _control_handlers[name] = function
+        return function
+    return decorator
+
+async def _handle_control(op: str, payload: dict) -> dict:
+    """รันคำสั่งควบคุมบน event loop ของบอทในโปรเซสนี้"""
+    handler = _control_handlers.get(op)
+    if handler is None:
+        return {"status": "error", "message": f"Unknown control command: {op}"}
+    return await handler(**payload)
+
+@control_op("queue_add")
+async def _control_queue_add(url: str):
+    queue.append(url)
+    logging.info("Added to queue from web: %s", url)
+    return {"status": "info", "message": f"Added to queue: {url}"}
+
+# การเพิ่มหลายเพลงพร้อมกัน: เพิ่มเข้าคิวตามลำดับทันที แล้วดึงข้อมูลทุกเพลงพร้อมกัน (จำกัดจำนวน)
+# รอผลไม่เกิน BULK_ENQUEUE_BUDGET (ต้องน้อยกว่า IPC_TIMEOUT) เพลงที่ดึงไม่สำเร็จจะถูกนำออกจากคิว
+# เพลงที่ยังดึงไม่เสร็จยังคงอยู่ในคิวและดึงต่อในพื้นหลัง ผลลัพธ์ถูกเก็บไว้ใช้ตอนเล่นจึงไม่ต้องดึงซ้ำ
+BULK_ENQUEUE_MAX = int(os.getenv("BULK_ENQUEUE_MAX", "50"))
+BULK_ENQUEUE_CONCURRENCY = int(os.getenv("BULK_ENQUEUE_CONCURRENCY", "4"))
+BULK_ENQUEUE_BUDGET = float(os.getenv("BULK_ENQUEUE_BUDGET", str(max(IPC_TIMEOUT - 2, 1))))
+_bulk_resolve_semaphore = None
+
+async def _resolve_bulk_entry(url: str) -> dict:
+    global _bulk_resolve_semaphore
+    if _bulk_resolve_semaphore is None:
+        _bulk_resolve_semaphore = asyncio.Semaphore(BULK_ENQUEUE_CONCURRENCY)
+    async with _bulk_resolve_semaphore:
+        track = await _resolve_queue_entry(url, None)
+    store_prefetched_track(url, track)
+    return track
+
+@control_op("queue_add_bulk")
+async def _control_queue_add_bulk(urls: list):
+    queue.extend(urls)
+    tasks = {url: asyncio.ensure_future(_resolve_bulk_entry(url)) for url in urls}
+    done, pending = await asyncio.wait(tasks.values(), timeout=BULK_ENQUEUE_BUDGET)
+    failed = []
+    for url, task in tasks.items():
+        if task in done and task.exception() is not None:
+            failed.append({"url": url, "error": str(task.exception())[:200]})
+            # นำออกเฉพาะรายการที่เพิ่งเพิ่ม (ตัวท้ายสุด) ไม่กระทบ URL เดียวกันที่อยู่ในคิวก่อนหน้า
+            for position in range(len(queue) - 1, -1, -1):
+                if queue[position] == url:
+                    del queue[position]
+                    break
+    added = len(urls) - len(failed)
+    logging.info("Bulk add from web: %s added, %s failed, %s still resolving", added, len(failed), len(pending))
+    message = f"Added {added} of {len(urls)} tracks to queue."
+    if failed:
+        message += f" {len(failed)} could not be resolved."
+    return {"status": "warning" if failed else "info", "message": message,
+            "added": added, "failed": failed, "pending": len(pending)}
+
+@control_op("play")
+async def _control_play():
+    if not bot_ready.is_set():
+        return {"status": "warning", "message": "Bot is not ready yet. Please wait a moment."}
+
+    # ตรวจสอบว่าบอทอยู่ในช่องเสียงและไม่ได้กำลังเล่นอยู่
+    if voice_client and not voice_client.is_playing():
+        if voice_client.channel: # ตรวจสอบว่า channel object มีอยู่จริง
+            asyncio.create_task(_play_next_in_queue(bot.get_channel(voice_client.channel.id)))
+            logging.info("Triggered play via web.")
+            return {"status": "info", "message": "Attempting to play next in queue."}
+        return {"status": "error", "message": "Bot is in a voice channel but channel object is unavailable."}
+    return {"status": "warning", "message": "Bot is not in a voice channel or is already playing."}
+
+@control_op("pause")
+async def _control_pause():
+    if voice_client and voice_client.is_playing():
+        voice_client.pause()
+        logging.info("Paused via web.")
+        return {"status": "info", "message": "Playback paused."}
+    return {"status": "warning", "message": "Nothing to pause."}
+
+@control_op("resume")
+async def _control_resume():
+    if voice_client and voice_client.is_paused():
+        voice_client.resume()
+        logging.info("Resumed via web.")
+        return {"status": "info", "message": "Playback resumed."}
+    return {"status": "warning", "message": "Nothing to resume."}
+
+@control_op("stop")
+async def _control_stop():
+    queue.clear() 
+    if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+        voice_client.stop() 
+        logging.info("Stopped via web and cleared queue.")
+        return {"status": "info", "message": "Playback stopped and queue cleared."}
+    return {"status": "warning", "message": "Nothing to stop."}
+
+@control_op("volume_step")
+async def _control_volume_step(step: float):
+    global volume
+    volume = min(max(volume + step, 0.1), 2.0) # ระดับเสียง 10% ถึง 200% เพื่อไม่ให้เงียบสนิท
+    if voice_client and voice_client.source: 
+        voice_client.source.volume = volume
+    direction = "increased" if step > 0 else "decreased"
+    logging.info("Volume %s: %s", "up" if step > 0 else "down", volume)
+    return {"status": "info", "message": f"Volume {direction} to {volume*100:.0f}%"}
+
+@control_op("seek")
+async def _control_seek(position: float):
+    try:
+        seek_current_track(position)
+    except ValueError as e:
+        return {"status": "warning", "message": str(e)}
+    return {"status": "info", "message": f"Seeked to {_format_seconds(position)}."}
+
+@control_op("now_playing")
+async def _control_now_playing():
+    return current_track_progress()
+
+def _stable_progress(position: float, is_playing: bool) -> dict:
+    """
+    ตำแหน่งการเล่นในรูปที่ไม่เปลี่ยนทุกครั้งที่ poll: ระหว่างเล่นส่งเวลาที่เริ่มเพลง (epoch ms ปัดเป็นวินาที)
+    ให้ client คำนวณตำแหน่งเอง ส่วนตอนหยุดชั่วคราวส่งตำแหน่งตรงๆ ทำให้ snapshot เดิมได้ ETag เดิม
+    """
+    if is_playing:
+        return {"started_at_ms": round(time.time() - position) * 1000}
+    return {"progress_ms": int(position * 1000)}
+
+def player_state_snapshot() -> dict:
+    """สถานะของผู้เล่นคิว (YouTube/SoundCloud) สำหรับ /api/state"""
+    snapshot = {
+        "is_playing": False,
+        "is_paused": False,
+        "volume": volume,
+        "queue": queue[:STATE_QUEUE_LIMIT],
+        "queue_length": len(queue),
+        "autoplay": autoplay_enabled,
+    }
+    if now_playing and voice_client and voice_client.is_connected():
+        duration = now_playing.get("duration")
+        snapshot.update({
+            "is_playing": voice_client.is_playing(),
+            "is_paused": voice_client.is_paused(),
+            "title": now_playing["title"],
+            "url": now_playing["url"],
+            "duration_ms": int(duration * 1000) if duration else None,
+            **_stable_progress(now_playing["source"].position, voice_client.is_playing()),
+        })
+    return snapshot
+
+async def _spotify_playback_snapshot(user_id: int):
+    """สถานะการเล่น Spotify ของผู้ใช้ (None หากไม่ได้เชื่อมโยง หรือดึงข้อมูลไม่ได้)"""
+    sp_user = spotify_users.get(user_id) if user_id else None
+    if not sp_user:
+        return None
+    try:
+        playback = await spotify_control_flight.do((user_id, "current_playback"), _spotify_call, sp_user.current_playback)
+    except spotipy.exceptions.SpotifyException as e:
+        if e.http_status == 401:
+            await forget_spotify_user(user_id)
+        else:
+            logging.warning("ไม่สามารถดึงสถานะ Spotify ของผู้ใช้ %s: %s", user_id, e)
+        return None
+    if not playback or not playback.get("item"):
+        return {"is_playing": False}
+    item = playback["item"]
+    images = (item.get("album") or {}).get("images") or item.get("images") or []
+    return {
+        "is_playing": playback.get("is_playing", False),
+        "title": item.get("name"),
+        "artist": ", ".join(artist["name"] for artist in item.get("artists") or []),
+        "album_cover_url": images[0]["url"] if images else None,
+        "duration_ms": item.get("duration_ms"),
+        "device": (playback.get("device") or {}).get("name"),
+        **_stable_progress((playback.get("progress_ms") or 0) / 1000, playback.get("is_playing", False)),
+    }
+
+@control_op("state")
+async def _control_state(user_id: int = None):
+    spotify_state = await _spotify_playback_snapshot(user_id)
+    return {"status": "ok", "player": player_state_snapshot(), "spotify": spotify_state}
+
+async def _control_spotify_action(user_id: int, method_name: str, success_message: str, action_text: str):
+    """เรียกเมธอดควบคุมการเล่นของ Spotify ให้ผู้ใช้ที่เชื่อมโยงแล้ว (ใช้โดย spotify_skip/spotify_previous)"""
+    sp_user = spotify_users.get(user_id)
+    if not sp_user:
+        return {"status": "error", "message": "Your Spotify is not linked or token expired. Please re-link."}
+    try:
+        # การกดซ้ำระหว่างที่คำสั่งเดิมยังไม่เสร็จ (จากเว็บหรือ Slash Command) จะไม่ส่งคำสั่งซ้ำไปยัง Spotify
+        await spotify_control_flight.do((user_id, method_name), _spotify_call, getattr(sp_user, method_name))
+        logging.info("%s via web.", success_message)
+        return {"status": "info", "message": f"{success_message}."}
+    except spotipy.exceptions.SpotifyException as e:
+        if e.http_status == 401:
+            await forget_spotify_user(user_id)
+            return {"status": "error", "message": "Your Spotify is not linked or token expired. Please re-link."}
+        logging.error("Error %s via web for user %s: %s", action_text, user_id, e, exc_info=True)
+        return {"status": "error", "message": f"Error {action_text}: {e}"}
+
+@control_op("spotify_skip")
+async def _control_spotify_skip(user_id: int):
+    return await _control_spotify_action(user_id, "next_track", "Spotify track skipped", "skipping Spotify track")
+
+@control_op("spotify_previous")
+async def _control_spotify_previous(user_id: int):
+    return await _control_spotify_action(
+        user_id, "previous_track", "Spotify track changed to previous", "going to previous Spotify track")
+
+@control_op("spotify_link_status")
+async def _control_spotify_link_status(user_id: int):
+    return {"status": "info", "message": "", "linked": await _check_spotify_link_status(user_id)}
+
+@control_op("spotify_linked")
+async def _control_spotify_linked(user_id: int, token_info: dict):
+    """สร้าง Spotify client จากโทเค็นที่ได้จาก OAuth callback ของเว็บ (ซึ่งอาจอยู่คนละโปรเซส)"""
+    auth_manager = spotipy.SpotifyOAuth(
+        client_id=SPOTIPY_CLIENT_ID,
+        client_secret=SPOTIPY_CLIENT_SECRET,
+        redirect_uri=SPOTIPY_REDIRECT_URI,
+        scope=SPOTIPY_SCOPES,
+    )
+    auth_manager.set_cached_token(token_info)
+    spotify_users[user_id] = spotipy.Spotify(auth_manager=auth_manager) # เก็บ Spotify client ในแคช
+    return {"status": "success", "message": "Spotify linked successfully!"}
+
+
+# --- IPC ระหว่างเว็บกับ worker process ---
+# โปรโตคอล: JSON หนึ่งบรรทัดต่อหนึ่ง request/response ผ่าน TCP (IPC_HOST:IPC_BASE_PORT + worker index)
+_web_loop = None # event loop พื้นหลังสำหรับงาน async ของเว็บ เมื่อบอทไม่ได้อยู่ในโปรเซสนี้
+_web_loop_lock = threading.Lock()
+
+def _bot_runs_here() -> bool:
+    """บอท (และสถานะผู้เล่น) อยู่ในโปรเซสเดียวกับเว็บหรือไม่"""
+    return not (IS_SUPERVISOR or IS_WEB_ONLY)
+
+def _ipc_server_enabled() -> bool:
+    """โปรเซสบอทนี้ต้องเปิด IPC server ให้เว็บที่รันแยกโปรเซสหรือไม่"""
+    return IS_WORKER or RUN_MODE == "bot"
+
+def _get_async_loop() -> asyncio.AbstractEventLoop:
+    """loop สำหรับรันงาน async จากเธรดของ Flask: bot.loop หากบอทอยู่ในโปรเซสนี้ ไม่เช่นนั้นใช้ loop พื้นหลังของเว็บ"""
+    global _web_loop
+    if _bot_runs_here():
+        return bot.loop
+    with _web_loop_lock:
+        if _web_loop is None:
+            _web_loop = asyncio.new_event_loop()
+            threading.Thread(target=_web_loop.run_forever, name="web-async-loop", daemon=True).start()
+    return _web_loop
+
+def _run_async(coro, timeout: float = None):
+    """รัน coroutine จากเธรดของ Flask และรอผลลัพธ์"""
+    return asyncio.run_coroutine_threadsafe(tracer.wrap_coroutine("bot_loop", coro), _get_async_loop()).result(timeout)
+
+def _ipc_request(worker_index: int, op: str, payload: dict, timeout: float = IPC_TIMEOUT) -> dict:
+    """ส่งคำสั่งไปยัง worker ผ่าน IPC และรอผลลัพธ์ (เรียกจากเธรดของ Flask)"""
+    message = {"secret": IPC_SECRET, "op": op, "payload": payload}
+    span = _current_span.get()
+    if span is not None:
+        message["trace"] = {"traceparent": span.traceparent, "sent_ns": time.time_ns()}
+    message = json.dumps(message, default=str).encode('utf-8') + b"\n"
+    with socket.create_connection((IPC_HOST, IPC_BASE_PORT + worker_index), timeout=timeout) as connection:
+        connection.sendall(message)
+        with connection.makefile("rb") as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError(f"worker {worker_index} ปิดการเชื่อมต่อก่อนตอบกลับ")
+    response = json.loads(line)
+    if not response.get("ok"):
+        raise RuntimeError(response.get("error", "unknown IPC error"))
+    return response["result"]
+
+# คำสั่งที่ผลลัพธ์ของคำขอซ้ำที่มาพร้อมกันใช้ร่วมกันได้ (ตรวจสอบสถานะ หรือการกดปุ่มซ้ำของผู้ใช้คนเดิม)
+_COALESCED_CONTROL_OPS = {"spotify_link_status", "spotify_skip", "spotify_previous"}
+
+def dispatch_control(op: str, guild_id: int = None, **payload) -> dict:
+    """
+    ส่งคำสั่งควบคุมไปยังโปรเซสที่ดูแล guild นี้ (หรือรันในโปรเซสนี้หากบอทอยู่ที่นี่)
+    คืนค่า dict ที่มี status และ message เสมอ แม้ว่าการส่งจะล้มเหลว
+    """
+    if op in _COALESCED_CONTROL_OPS:
+        key = (op, guild_id, tuple(sorted(payload.items())))
+        return control_dispatch_flight.do_sync(key, _dispatch_control, op, guild_id, payload)
+    return _dispatch_control(op, guild_id, payload)
+
+def _dispatch_control(op: str, guild_id: int, payload: dict) -> dict:
+    with tracer.span(f"control {op}", guild_id=guild_id or 0):
+        return _dispatch_control_traced(op, guild_id, payload)
+
+def _dispatch_control_traced(op: str, guild_id: int, payload: dict) -> dict:
+    try:
+        if _bot_runs_here():
+            return _run_async(_handle_control(op, payload), timeout=IPC_TIMEOUT)
+        return _ipc_request(_worker_for_guild(guild_id), op, payload)
+    except OSError as e:
+        logging.warning("ไม่สามารถเชื่อมต่อกับบอทเพื่อรันคำสั่ง %s: %s", op, e)
+        return {"status": "error", "message": "Bot is unavailable right now. Please try again shortly."}
+    except Exception as e:
+        logging.error("ไม่สามารถรันคำสั่งควบคุม %s: %s", op, e, exc_info=True)
+        return {"status": "error", "message": f"An unexpected error occurred: {e}"}
+
+def broadcast_control(op: str, **payload) -> list:
+    """ส่งคำสั่งไปยังทุก worker (เช่น แจ้งว่าผู้ใช้เชื่อมโยง Spotify แล้ว) และคืนค่าผลลัพธ์ของแต่ละตัว"""
+    if _bot_runs_here():
+        return [dispatch_control(op, **payload)]
+    results = []
+    for worker_index in range(SHARD_PROCESSES):
+        try:
+            results.append(_ipc_request(worker_index, op, payload))
+        except Exception as e:
+            logging.error("ไม่สามารถส่งคำสั่ง %s ไปยัง worker %s: %s", op, worker_index, e)
+            results.append({"status": "error", "message": f"Worker {worker_index} is unavailable: {e}"})
+    return results
+
+async def _handle_ipc_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """รับคำสั่งจากเว็บ (บรรทัดละหนึ่งคำสั่ง) และรันบน event loop ของ worker นี้"""
+    try:
+        while line := await reader.readline():
+            try:
+                message = json.loads(line)
+                if IPC_SECRET and not hmac.compare_digest(str(message.get("secret", "")), IPC_SECRET):
+                    response = {"ok": False, "error": "unauthorized"}
+                else:
+                    trace = message.get("trace") or {}
+                    with tracer.span(f"ipc {message['op']}", parent=parse_traceparent(trace.get("traceparent")),
+                                     queued_since_ns=trace.get("sent_ns"), worker=WORKER_INDEX or 0):
+                        result = await _handle_control(message["op"], message.get("payload") or {})
+                    response = {"ok": True, "result": result}
+            except Exception as e:
+                logging.error("ข้อผิดพลาดในการประมวลผลคำสั่ง IPC: %s", e, exc_info=True)
+                response = {"ok": False, "error": str(e)}
+            writer.write(json.dumps(response, default=str).encode('utf-8') + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+def _ipc_secret_problem():
+    """ข้อความข้อผิดพลาดหากการตั้งค่านี้ต้องมี IPC_SECRET แต่ไม่ได้ตั้งไว้ (None = ใช้ได้)"""
+    if IPC_SECRET or IS_WEB_ONLY:
+        return None
+    if RUN_MODE == "bot":
+        # เว็บที่รันแยกต้องใช้ secret เดียวกัน จึงสุ่มค่าเองไม่ได้
+        return "RUN_MODE=bot ต้องตั้ง IPC_SECRET ให้ตรงกับเว็บที่รันแยก"
+    if (IS_SUPERVISOR or _ipc_server_enabled()) and IPC_BIND_HOST not in ("127.0.0.1", "localhost", "::1"):
+        return f"IPC server ที่ bind ที่ {IPC_BIND_HOST} (นอก loopback) ต้องตั้ง IPC_SECRET"
+    return None
+
+async def start_ipc_server():
+    """เปิด IPC server ของโปรเซสบอทนี้บน IPC_BASE_PORT + WORKER_INDEX (0 เมื่อไม่ได้ใช้ sharding)"""
+    worker_index = WORKER_INDEX or 0
+    port = IPC_BASE_PORT + worker_index
+    problem = _ipc_secret_problem()
+    if problem:
+        raise RuntimeError(problem) # ไม่เปิดพอร์ตควบคุมบอทโดยไม่มีการยืนยันตัวตน
+    server = await asyncio.start_server(_handle_ipc_connection, IPC_BIND_HOST, port)
+    logging.info("Worker %s (shards %s) รับคำสั่ง IPC ที่ %s:%s",
+                 worker_index, _worker_shard_ids(worker_index) if SHARD_COUNT else "all", IPC_BIND_HOST, port)
+    return server
+
+
+# --- เซสชันเว็บ ---
+# แคชผลการค้นหาเซสชันจาก Firestore สำหรับ web worker ที่ไม่ได้รับ callback การล็อกอินของเซสชันนั้นเอง
+_session_lookup_cache = collections.OrderedDict()  # Key: Flask Session ID, Value: (Discord User ID หรือ None, เวลาที่หมดอายุ) (LRU)
+_SESSION_CACHE_MAX_ENTRIES = 10000
+_session_lookup_lock = threading.Lock() # เธรดของ Flask ใช้แคชร่วมกัน
+
+async def _find_session_user_in_firestore(session_id: str):
+    """ค้นหา Discord user ID ที่มี Flask session ID นี้ใน Firestore"""
+    db = await _get_firestore_db()
+    if db is None:
+        return None
+    query = db.collection('users').where('flask_sessions', 'array_contains', session_id).limit(1)
+    docs = await _firestore_call("session_lookup", query.get)
+    return int(docs[0].id) if docs else None
+
+def get_web_session_user(session_id: str):
+    """
+    คืนค่า Discord user ID ที่ล็อกอินด้วยเซสชันเว็บนี้ (หรือ None)
+    ดูจากหน่วยความจำของโปรเซสก่อน หากไม่พบจะค้นหาใน Firestore ซึ่งเป็นที่เก็บกลางของทุก web worker
+    และแคชผลลัพธ์ไว้ SESSION_CACHE_TTL วินาที (SESSION_NEGATIVE_CACHE_TTL หากไม่พบผู้ใช้)
+    """
+    if not session_id:
+        return None
+    user_id = web_logged_in_users.get(session_id)
+    if user_id:
+        return user_id
+
+    now = time.monotonic()
+    with _session_lookup_lock:
+        cached = _session_lookup_cache.get(session_id)
+        if cached and cached[1] > now:
+            _session_lookup_cache.move_to_end(session_id)
+            return cached[0]
+
     try:
-        await user.send(f"⏰ คุณถูก {interaction.user.display_name} ปลุก! ตื่นนน!")
-        await interaction.response.send_message(f"✅ ปลุก {user.name} แล้ว", ephemeral=True)
-        logging.info(f"{interaction.user.display_name} ปลุก {user.name}.")
-    except discord.Forbidden:
-        await interaction.response.send_message(f"❌ ไม่สามารถส่ง DM ถึง {user.name} ได้ (อาจจะปิด DM หรือเป็นบอท)", ephemeral=True)
-        logging.warning(f"ไม่สามารถส่ง DM ไปยัง {user.name} (Forbidden).")
+        user_id = _run_async(
+            firestore_read_flight.do(("session", session_id), _find_session_user_in_firestore, session_id),
+            timeout=IPC_TIMEOUT
+        )
     except Exception as e:
-        await interaction.response.send_message(f"❌ เกิดข้อผิดพลาดในการส่ง DM: {e}", ephemeral=True)
-        logging.error(f"ไม่สามารถปลุกผู้ใช้: {e} ได้", exc_info=True)
+        logging.error("ไม่สามารถค้นหาเซสชันเว็บใน Firestore: %s", e)
+        return None
+
+    with _session_lookup_lock:
+        _session_lookup_cache[session_id] = (user_id, now + (SESSION_CACHE_TTL if user_id else SESSION_NEGATIVE_CACHE_TTL))
+        _session_lookup_cache.move_to_end(session_id)
+        while len(_session_lookup_cache) > _SESSION_CACHE_MAX_ENTRIES:
+            _session_lookup_cache.popitem(last=False)
+    return user_id
 
 
 # --- Flask Routes (Web Interface) ---
+@app.before_request
+def _start_request_timer():
+    """เริ่มจับเวลาของ request สำหรับ metrics และเริ่ม trace (ต่อจาก traceparent ของผู้เรียกหากมี)"""
+    g.request_started = time.perf_counter()
+    if tracer.enabled:
+        g.trace_span = tracer.start(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+                                    parent=parse_traceparent(request.headers.get("traceparent")), root=True)
+
+@app.after_request
+def _record_request_latency(response):
+    """บันทึกเวลาที่ใช้ตอบ request ลง metrics แยกตาม endpoint, method และ status code"""
+    started = g.pop("request_started", None)
+    if started is not None:
+        HTTP_REQUEST_LATENCY.observe(
+            time.perf_counter() - started,
+            endpoint=request.endpoint or "unknown",
+            method=request.method,
+            status=response.status_code
+        )
+    span = g.get("trace_span", (None, None))[0]
+    if span is not None:
+        span.attributes["http.status_code"] = response.status_code
+        response.headers["traceparent"] = span.traceparent
+    return response
+
+@app.teardown_request
+def _finish_request_span(error=None):
+    span, token = g.pop("trace_span", (None, None))
+    tracer.finish(span, token, error)
+
+# --- ไฟล์ static และหน้าเว็บที่เตรียมไว้ล่วงหน้า ---
+# โหลดไฟล์ใน static/ ครั้งเดียว: คำนวณ hash ของเนื้อหา และบีบอัด gzip/brotli ไว้ในหน่วยความจำ
+# url_for('static', ...) จะเติม ?v=<hash> ให้อัตโนมัติ URL ที่มี hash ตรงจึงแคชได้ถาวร (immutable)
+# ส่วน URL ที่ไม่มี hash ยังตรวจสอบซ้ำด้วย ETag ได้ ไม่ต้องดาวน์โหลดใหม่ถ้าไฟล์ไม่เปลี่ยน
+STATIC_ASSET_CACHE = os.getenv("STATIC_ASSET_CACHE", "1") == "1"
+STATIC_COMPRESS_MIN_BYTES = 512 # ไฟล์ที่เล็กกว่านี้ไม่คุ้มที่จะบีบอัด
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "256"))
+
+STATIC_ASSET_BYTES = metrics.counter(
+    "static_asset_bytes_total", "จำนวนไบต์ของไฟล์ static ที่ส่งออก แยกตาม encoding", ("encoding",))
+TEMPLATE_RENDERS = metrics.counter(
+    "template_render_total", "การแสดงผล template แยกตามผลการค้นหาแคช (hit/miss/bypass)", ("template", "result"))
+
+class StaticAssets:
+    """ไฟล์ static ที่โหลดเข้าหน่วยความจำพร้อม hash ของเนื้อหาและเวอร์ชันที่บีบอัดแล้ว"""
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._assets = None # Key: path ภายใน static/, Value: {"hash", "mimetype", "bodies": {encoding: bytes}}
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        if self._assets is None:
+            with self._lock:
+                if self._assets is None:
+                    started = time.perf_counter()
+                    self._assets = self._build()
+                    logging.info("เตรียมไฟล์ static %s ไฟล์ใน %.0f ms",
+                                 len(self._assets), (time.perf_counter() - started) * 1000)
+        return self._assets
+
+    def _build(self) -> dict:
+        import gzip
+        import mimetypes
+        try:
+            import brotli
+        except ImportError:
+            brotli = None # brotli เป็นตัวเลือก หากไม่ได้ติดตั้งจะใช้เพียง gzip
+        assets = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                with open(full_path, "rb") as f:
+                    body = f.read()
+                bodies = {"identity": body}
+                if len(body) >= STATIC_COMPRESS_MIN_BYTES:
+                    compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+                    if brotli is not None:
+                        compressed["br"] = brotli.compress(body, quality=11)
+                    # เก็บเฉพาะเวอร์ชันที่เล็กกว่าต้นฉบับจริง
+                    bodies.update({encoding: data for encoding, data in compressed.items() if len(data) < len(body)})
+                relative = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                assets[relative] = {
+                    "hash": hashlib.sha256(body).hexdigest()[:16],
+                    "mimetype": mimetypes.guess_type(name)[0] or "application/octet-stream",
+                    "bodies": bodies,
+                }
+        return assets
+
+    def version(self, filename: str):
+        asset = self.load().get(filename)
+        return asset["hash"] if asset else None
+
+    def response(self, filename: str):
+        """สร้าง Response ของไฟล์ตาม Accept-Encoding หรือ None หากไม่รู้จักไฟล์นี้"""
+        asset = self.load().get(filename)
+        if asset is None:
+            return None
+        # เลือก encoding ที่เล็กที่สุดที่ client รับได้ (br < gzip < identity)
+        encoding = next((candidate for candidate in ("br", "gzip")
+                         if candidate in asset["bodies"] and request.accept_encodings[candidate]), "identity")
+        etag = asset["hash"] if encoding == "identity" else f"{asset['hash']}-{encoding}"
+        if request.args.get("v") == asset["hash"]:
+            cache_control = "public, max-age=31536000, immutable"
+        else:
+            cache_control = "no-cache" # ไม่มี hash ใน URL: ต้องตรวจสอบกับ ETag ทุกครั้ง
+        headers = {"Cache-Control": cache_control, "ETag": f'"{etag}"', "Vary": "Accept-Encoding"}
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        body = asset["bodies"][encoding]
+        STATIC_ASSET_BYTES.inc(len(body), encoding=encoding)
+        return Response(body, mimetype=asset["mimetype"], headers=headers)
+
+static_assets = StaticAssets(app.static_folder)
+
+def serve_static_asset(filename):
+    """แทนที่ view ของ endpoint 'static' ของ Flask ด้วยไฟล์ที่เตรียมไว้ในหน่วยความจำ"""
+    response = static_assets.response(filename)
+    if response is None:
+        return app.send_static_file(filename) # ไฟล์ที่เพิ่มหลังเริ่มโปรเซส
+    return response
+
+@app.url_defaults
+def _add_static_version(endpoint, values):
+    """เติม ?v=<hash ของเนื้อหา> ให้ URL ของไฟล์ static เพื่อให้แคชแบบ immutable ได้"""
+    if endpoint == "static" and "v" not in values:
+        version = static_assets.version(values.get("filename", ""))
+        if version:
+            values["v"] = version
+
+if STATIC_ASSET_CACHE:
+    app.view_functions["static"] = serve_static_asset
+
+_template_cache = collections.OrderedDict() # Key: (template, ตัวแปรที่ใช้แสดงผล), Value: HTML (LRU)
+
+def render_cached_template(template_name: str, **context) -> str:
+    """
+    render_template ที่แคชผลลัพธ์ตามชื่อ template และค่าของตัวแปร (เช่น สถานะการเชื่อมโยงของผู้ใช้)
+    ตัวแปรจึงควรมีค่าที่เป็นไปได้ไม่กี่แบบ ข้อมูลเฉพาะผู้ใช้ให้หน้าเว็บดึงผ่าน API แทน
+    ไม่ใช้แคชเมื่อมีข้อความ flash ค้างอยู่ เพราะหน้าเว็บจะแสดงข้อความเหล่านั้น
+    """
+    if not STATIC_ASSET_CACHE or session.get("_flashes"):
+        TEMPLATE_RENDERS.inc(template=template_name, result="bypass")
+        return render_template(template_name, **context)
+    key = (template_name, tuple(sorted(context.items())))
+    html = _template_cache.get(key)
+    if html is not None:
+        _template_cache.move_to_end(key)
+        TEMPLATE_RENDERS.inc(template=template_name, result="hit")
+        return html
+    TEMPLATE_RENDERS.inc(template=template_name, result="miss")
+    html = render_template(template_name, **context)
+    _template_cache[key] = html
+    while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+        _template_cache.popitem(last=False)
+    return html
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Metrics ของบอทและเว็บในรูปแบบ Prometheus text exposition"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+# --- เครื่องมือดีบักประสิทธิภาพ (เฉพาะผู้ดูแล) ---
+# /debug/profile สุ่มเก็บ stack ของทุกเธรด (event loop, เธรดเสียง, Flask) แบบ wall-clock
+# /debug/heap เปรียบเทียบ snapshot ของ tracemalloc ก่อน/หลังช่วงเวลาที่กำหนด
+# ไม่มีเธรดหรือ tracemalloc ทำงานค้างไว้ระหว่างที่ไม่มีการเรียก จึงแทบไม่มี overhead ตามปกติ
+# ผลลัพธ์แบบ folded stacks ใช้กับ flamegraph.pl, speedscope หรือ inferno ได้โดยตรง
+DEBUG_ADMIN_TOKEN = os.getenv("DEBUG_ADMIN_TOKEN") # ไม่ตั้งค่า = ปิด endpoint ดีบักทั้งหมด
+DEBUG_CAPTURE_MAX_SECONDS = float(os.getenv("DEBUG_CAPTURE_MAX_SECONDS", "60"))
+DEBUG_PROFILE_INTERVAL = float(os.getenv("DEBUG_PROFILE_INTERVAL", "0.005")) # ระยะห่างระหว่างการสุ่ม stack (วินาที)
+DEBUG_TRACEMALLOC_FRAMES = int(os.getenv("DEBUG_TRACEMALLOC_FRAMES", "16")) # ความลึกของ traceback ที่ tracemalloc เก็บ
+
+DEBUG_CAPTURES = metrics.counter("debug_captures_total", "จำนวนการเก็บ profile/heap snapshot แยกตามชนิดและผลลัพธ์", ("kind", "status"))
+
+_debug_capture_lock = threading.Lock() # เก็บได้ทีละหนึ่งรายการต่อโปรเซส
+
+def _folded_frame(filename: str, lineno: int, name: str = None) -> str:
+    # ; คั่น frame ในรูปแบบ folded จึงต้องไม่ปรากฏในชื่อ frame
+    location = f"{os.path.basename(filename)}:{lineno}"
+    return (f"{name} ({location})" if name else location).replace(";", ":")
+
+def capture_cpu_profile(seconds: float, interval: float = DEBUG_PROFILE_INTERVAL):
+    """
+    สุ่มเก็บ stack ของทุกเธรดในโปรเซสนี้ทุก interval วินาทีเป็นเวลา seconds วินาที
+    คืนค่า (folded stacks: "ชื่อเธรด;frame;...;frame จำนวนครั้ง" ต่อบรรทัด, จำนวนรอบที่สุ่ม)
+    """
+    if not _debug_capture_lock.acquire(blocking=False):
+        raise RuntimeError("มีการเก็บ profile/heap อื่นกำลังทำงานอยู่")
+    try:
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_folded_frame(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+                    frame = frame.f_back
+                frames.append(names.get(ident, f"thread-{ident}").replace(";", ":"))
+                stacks[";".join(reversed(frames))] += 1
+            samples += 1
+            time.sleep(interval)
+    finally:
+        _debug_capture_lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()), samples
+
+def capture_heap_diff(seconds: float, top: int = 25, folded: bool = False) -> str:
+    """
+    เปรียบเทียบหน่วยความจำที่จัดสรรด้วย tracemalloc ระหว่างต้นและท้ายช่วงเวลา seconds วินาที
+    เปิด tracemalloc เฉพาะระหว่างเก็บ (หากยังไม่ได้เปิดไว้) แล้วปิดทันทีเมื่อเสร็จ
+    คืนค่ารายงาน top-N ตามขนาดที่เพิ่มขึ้น หรือ folded stacks (น้ำหนักเป็นไบต์) เมื่อ folded=True
+    """
+    if not _debug_capture_lock.acquire(blocking=False):
+        raise RuntimeError("มีการเก็บ profile/heap อื่นกำลังทำงานอยู่")
+    started_here = not tracemalloc.is_tracing()
+    try:
+        if started_here:
+            tracemalloc.start(DEBUG_TRACEMALLOC_FRAMES)
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+        _debug_capture_lock.release()
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*")]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "traceback")
+    stats.sort(key=lambda stat: stat.size_diff, reverse=True)
+    if folded:
+        return "".join(
+            ";".join(_folded_frame(frame.filename, frame.lineno) for frame in stat.traceback) + f" {stat.size_diff}\n"
+            for stat in stats if stat.size_diff > 0)
+
+    lines = [f"tracemalloc diff ช่วง {seconds:g} วินาที: เพิ่มขึ้นรวม {sum(stat.size_diff for stat in stats) / 1024:+.1f} KiB"]
+    for rank, stat in enumerate(stats[:top], 1):
+        lines.append(f"\n#{rank}: {stat.size_diff / 1024:+.1f} KiB ({stat.count_diff:+d} blocks), คงอยู่ {stat.size / 1024:.1f} KiB")
+        lines.extend("    " + line for line in stat.traceback.format(limit=DEBUG_TRACEMALLOC_FRAMES, most_recent_first=True))
+    return "\n".join(lines) + "\n"
+
+@control_op("debug_profile")
+async def _control_debug_profile(seconds: float, interval: float):
+    try:
+        body, samples = await asyncio.to_thread(capture_cpu_profile, seconds, interval)
+    except RuntimeError as e:
+        return {"status": "busy", "message": str(e)}
+    return {"status": "ok", "body": body, "samples": samples}
+
+@control_op("debug_heap")
+async def _control_debug_heap(seconds: float, top: int, folded: bool):
+    try:
+        body = await asyncio.to_thread(capture_heap_diff, seconds, top, folded)
+    except RuntimeError as e:
+        return {"status": "busy", "message": str(e)}
+    return {"status": "ok", "body": body}
+
+def debug_admin_required(view):
+    """อนุญาตเฉพาะคำขอที่แนบ DEBUG_ADMIN_TOKEN (Authorization: Bearer ... หรือ X-Debug-Token); ตอบ 404 เมื่อปิดใช้งาน"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_ADMIN_TOKEN:
+            return Response("Not Found", status=404, mimetype="text/plain")
+        authorization = request.headers.get("Authorization", "")
+        token = authorization[7:] if authorization.startswith("Bearer ") else request.headers.get("X-Debug-Token", "")
+        if not hmac.compare_digest(token.encode(), DEBUG_ADMIN_TOKEN.encode()):
+            return Response("Unauthorized", status=401, mimetype="text/plain", headers={"WWW-Authenticate": "Bearer"})
+        return view(*args, **kwargs)
+    return wrapper
+
+def _run_debug_capture(kind: str, op: str, local_capture, payload: dict, filename: str):
+    """
+    เก็บข้อมูลในโปรเซสนี้ หรือใน worker ที่ระบุด้วย ?worker= (เมื่อบอทรันแยกโปรเซส)
+    แล้วส่งกลับเป็นไฟล์ให้ดาวน์โหลด
+    """
+    worker = request.args.get("worker", type=int)
+    headers = {}
+    try:
+        if worker is None or _bot_runs_here():
+            body, samples = local_capture()
+            process = "local"
+        else:
+            result = _ipc_request(worker, op, payload, timeout=payload["seconds"] + IPC_TIMEOUT)
+            if result.get("status") != "ok":
+                raise RuntimeError(result.get("message", "unknown error"))
+            body, samples = result["body"], result.get("samples")
+            process = f"worker{worker}"
+    except RuntimeError as e:
+        DEBUG_CAPTURES.inc(kind=kind, status="busy")
+        return Response(f"{e}\n", status=409, mimetype="text/plain")
+    except OSError as e:
+        DEBUG_CAPTURES.inc(kind=kind, status="error")
+        return Response(f"worker {worker} is unavailable: {e}\n", status=502, mimetype="text/plain")
+    if samples is not None:
+        headers["X-Profile-Samples"] = str(samples)
+    DEBUG_CAPTURES.inc(kind=kind, status="ok")
+    headers["Content-Disposition"] = f'attachment; filename="{filename.format(process=process, time=int(time.time()))}"'
+    headers["Cache-Control"] = "no-store"
+    return Response(body, mimetype="text/plain; charset=utf-8", headers=headers)
+
+@app.route("/debug/profile")
+@debug_admin_required
+def debug_profile():
+    """CPU profile แบบสุ่มเก็บ stack ของทุกเธรด: ?seconds=10&interval_ms=5[&worker=N] คืนไฟล์ folded stacks"""
+    seconds = min(max(request.args.get("seconds", 10.0, type=float), 0.1), DEBUG_CAPTURE_MAX_SECONDS)
+    interval = max(request.args.get("interval_ms", DEBUG_PROFILE_INTERVAL * 1000, type=float), 1.0) / 1000
+    return _run_debug_capture(
+        "cpu", "debug_profile", lambda: capture_cpu_profile(seconds, interval),
+        {"seconds": seconds, "interval": interval}, "cpu-{process}-{time}.folded")
+
+@app.route("/debug/heap")
+@debug_admin_required
+def debug_heap():
+    """ผลต่างการจัดสรรหน่วยความจำ: ?seconds=10&top=25[&format=folded][&worker=N]"""
+    seconds = min(max(request.args.get("seconds", 10.0, type=float), 0.1), DEBUG_CAPTURE_MAX_SECONDS)
+    top = min(max(request.args.get("top", 25, type=int), 1), 500)
+    folded = request.args.get("format") == "folded"
+    return _run_debug_capture(
+        "heap", "debug_heap", lambda: (capture_heap_diff(seconds, top, folded), None),
+        {"seconds": seconds, "top": top, "folded": folded},
+        "heap-{process}-{time}." + ("folded" if folded else "txt"))
+
 @app.route("/")
-async def index(): 
+def index(): 
     """หน้าแรกของเว็บอินเตอร์เฟซ แสดงสถานะการเชื่อมต่อ Discord และ Spotify"""
     current_session_id = session.get('session_id')
-    if not current_session_id:
+    if current_session_id:
+        discord_user_id = get_web_session_user(current_session_id)
+    else:
+        # เซสชันใหม่ ยังไม่มีทางผูกกับผู้ใช้ จึงไม่ต้องค้นหา
         current_session_id = os.urandom(16).hex()
         session['session_id'] = current_session_id
+        discord_user_id = None
 
-    discord_user_id = web_logged_in_users.get(current_session_id)
     is_discord_linked = bool(discord_user_id) 
 
     is_spotify_linked = False
 
-    # ตรวจสอบสถานะการเชื่อมโยง Spotify หากเชื่อมโยง Discord แล้ว
+    # ตรวจสอบสถานะการเชื่อมโยง Spotify หากเชื่อมโยง Discord แล้ว (ถามโปรเซสที่ถือ Spotify client ของผู้ใช้)
     if discord_user_id:
-        try:
-            is_spotify_linked = await _check_spotify_link_status(discord_user_id)
-        except Exception as e:
-            logging.error(f"ข้อผิดพลาดในการตรวจสอบสถานะการเชื่อมโยง Spotify สำหรับผู้ใช้เว็บ {discord_user_id}: {e}")
-            is_spotify_linked = False 
+        result = dispatch_control("spotify_link_status", _control_guild_id(), user_id=discord_user_id)
+        is_spotify_linked = result.get("linked", False)
 
-    return render_template(
+    # HTML ขึ้นกับสถานะการเชื่อมโยงเท่านั้น (แคชได้ร่วมกันทุกผู้ใช้) ID ของผู้ใช้ถูกดึงโดย JS จาก /api/discord_user_id
+    return render_cached_template(
         "index.html",
         is_discord_linked=is_discord_linked,
-        discord_user_id=discord_user_id,
         is_spotify_linked=is_spotify_linked
     )
 
+# --- Snapshot สถานะสำหรับหน้าเว็บ ---
+# ทุกแท็บของผู้ใช้ poll /api/state: snapshot ถูกสร้างใหม่ไม่เกินหนึ่งครั้งต่อ STATE_SNAPSHOT_INTERVAL ต่อ (guild, ผู้ใช้)
+# และใช้ร่วมกันทุกแท็บ ETag คือ hash ของเนื้อหา poll ที่ไม่มีอะไรเปลี่ยนจึงได้ 304 โดยไม่มี body
+STATE_SNAPSHOT_INTERVAL = float(os.getenv("STATE_SNAPSHOT_INTERVAL", "2"))
+STATE_QUEUE_LIMIT = 50 # จำนวนรายการในคิวที่ส่งให้หน้าเว็บ
+_STATE_SNAPSHOT_MAX_ENTRIES = 1024
+
+STATE_API_RESPONSES = metrics.counter(
+    "web_state_responses_total", "การตอบ /api/state แยกตามผลลัพธ์ (snapshot ใหม่/ใช้ซ้ำ, 200/304)", ("snapshot", "status"))
+
+state_snapshot_flight = SingleFlight("web_state") # แท็บที่ poll พร้อมกันรอ snapshot เดียวกัน
+_state_snapshots = {} # Key: (guild_id, discord_user_id), Value: {"expires", "body", "etag"}
+
+def _refresh_state_snapshot(guild_id: int, user_id) -> dict:
+    result = dispatch_control("state", guild_id, user_id=user_id)
+    if result.get("status") == "error":
+        return {"expires": 0.0, "error": result}
+    result.pop("status", None)
+    digest = hashlib.sha256(json.dumps(result, sort_keys=True, separators=(",", ":")).encode()).hexdigest()[:16]
+    result["version"] = digest
+    now = time.monotonic()
+    snapshot = {"expires": now + STATE_SNAPSHOT_INTERVAL, "body": json.dumps(result, separators=(",", ":")), "etag": digest}
+    if len(_state_snapshots) >= _STATE_SNAPSHOT_MAX_ENTRIES:
+        for key in [key for key, entry in _state_snapshots.items() if entry["expires"] <= now]:
+            _state_snapshots.pop(key, None)
+    _state_snapshots[(guild_id, user_id)] = snapshot
+    return snapshot
+
+def get_state_snapshot(guild_id: int, user_id):
+    """คืนค่า (snapshot, สร้างใหม่หรือไม่) ของสถานะผู้เล่นและ Spotify ของผู้ใช้"""
+    snapshot = _state_snapshots.get((guild_id, user_id))
+    if snapshot and snapshot["expires"] > time.monotonic():
+        return snapshot, False
+    return state_snapshot_flight.do_sync((guild_id, user_id), _refresh_state_snapshot, guild_id, user_id), True
+
+@app.route("/api/state")
+def state_api():
+    """สถานะผู้เล่นคิวและ Spotify ของผู้ใช้ในคำขอเดียว รองรับ If-None-Match (304 เมื่อไม่มีอะไรเปลี่ยน)"""
+    current_session_id = session.get('session_id')
+    discord_user_id = get_web_session_user(current_session_id) if current_session_id else None
+    snapshot, refreshed = get_state_snapshot(_control_guild_id(), discord_user_id)
+    snapshot_label = "refreshed" if refreshed else "shared"
+    if "error" in snapshot:
+        STATE_API_RESPONSES.inc(snapshot=snapshot_label, status="503")
+        return jsonify(snapshot["error"]), 503
+    # client ใช้เวลาของเซิร์ฟเวอร์คำนวณตำแหน่งจาก started_at_ms (ไม่รวมอยู่ใน body เพื่อไม่ให้ ETag เปลี่ยน)
+    headers = {"ETag": f'"{snapshot["etag"]}"', "Cache-Control": "no-cache",
+               "X-Server-Time-Ms": str(int(time.time() * 1000))}
+    if snapshot["etag"] in request.if_none_match:
+        STATE_API_RESPONSES.inc(snapshot=snapshot_label, status="304")
+        return Response(status=304, headers=headers)
+    STATE_API_RESPONSES.inc(snapshot=snapshot_label, status="200")
+    return Response(snapshot["body"], mimetype="application/json", headers=headers)
+
 @app.route("/api/auth_status")
-async def get_auth_status():
+def get_auth_status():
     """API endpoint เพื่อดึงสถานะการเชื่อมโยง Discord และ Spotify"""
     current_session_id = session.get('session_id')
-    discord_user_id = web_logged_in_users.get(current_session_id)
+    discord_user_id = get_web_session_user(current_session_id)
     is_discord_linked = bool(discord_user_id)
     is_spotify_linked = False
 
     if is_discord_linked:
-        try:
-            is_spotify_linked = await _check_spotify_link_status(discord_user_id)
-        except Exception as e:
-            logging.error(f"ข้อผิดพลาดในการตรวจสอบสถานะ Spotify สำหรับ API: {e}")
-            is_spotify_linked = False
+        result = dispatch_control("spotify_link_status", _control_guild_id(), user_id=discord_user_id)
+        is_spotify_linked = result.get("linked", False)
 
     return jsonify({
         "is_discord_linked": is_discord_linked,
@@ -942,7 +4831,7 @@ async def get_auth_status():
 def get_discord_user_id_api():
     """API endpoint เพื่อดึง Discord User ID สำหรับเซสชันปัจจุบัน"""
     current_session_id = session.get('session_id')
-    discord_user_id = web_logged_in_users.get(current_session_id)
+    discord_user_id = get_web_session_user(current_session_id)
     return jsonify({"discord_user_id": discord_user_id})
 
 
@@ -974,12 +4863,8 @@ def discord_callback():
         return redirect(url_for("index"))
 
     try:
-        # รันฟังก์ชัน async ในเธรดแยกโดยใช้ asyncio.run_coroutine_threadsafe
-        future = asyncio.run_coroutine_threadsafe(
-            _fetch_discord_token_and_user(code),
-            bot.loop
-        )
-        token_info, user_data = future.result(timeout=10) # รอผลลัพธ์สูงสุด 10 วินาที
+        # รันฟังก์ชัน async บน event loop ของบอท (หรือ loop พื้นหลังของเว็บในโหมด supervisor)
+        token_info, user_data = _run_async(_fetch_discord_token_and_user(code), timeout=10) # รอผลลัพธ์สูงสุด 10 วินาที
         
         discord_user_id = int(user_data["id"])
         discord_username = user_data["username"]
@@ -989,10 +4874,7 @@ def discord_callback():
             session['session_id'] = current_session_id
 
         # เพิ่ม Flask session ID เข้าไปใน Firestore ของผู้ใช้
-        asyncio.run_coroutine_threadsafe(
-            update_user_data_in_firestore(discord_user_id, flask_session_to_add=current_session_id),
-            bot.loop
-        ).result()
+        _run_async(update_user_data_in_firestore(discord_user_id, flask_session_to_add=current_session_id))
 
         # อัปเดต web_logged_in_users ในหน่วยความจำ
         web_logged_in_users[current_session_id] = discord_user_id
@@ -1002,25 +4884,28 @@ def discord_callback():
 
     except Exception as e:
         flash(f"❌ Error during Discord login: {e}", "error")
-        logging.error(f"Discord OAuth error: {e}", exc_info=True)
+        logging.error("Discord OAuth error: %s", e, exc_info=True)
     
     return redirect(url_for("index")) 
 
+@app.route("/login/spotify")
 @app.route("/login/spotify/<int:discord_user_id_param>")
-def login_spotify_web(discord_user_id_param: int):
+def login_spotify_web(discord_user_id_param: int = None):
     """
     Redirect ไปยังหน้า Spotify OAuth เพื่อเข้าสู่ระบบ Spotify
-    มีการตรวจสอบว่า Discord User ID ที่ส่งมาตรงกับที่เข้าสู่ระบบปัจจุบันหรือไม่
+    มีการตรวจสอบว่า Discord User ID ที่ส่งมาตรงกับที่เข้าสู่ระบบปัจจุบันหรือไม่ (ไม่ระบุ = ผู้ใช้ที่เข้าสู่ระบบอยู่)
     """
     current_session_id = session.get('session_id')
-    logged_in_discord_user_id = web_logged_in_users.get(current_session_id)
+    logged_in_discord_user_id = get_web_session_user(current_session_id)
+    if discord_user_id_param is None:
+        discord_user_id_param = logged_in_discord_user_id
 
     # ป้องกันการเชื่อมโยง Spotify ให้กับ Discord User ID ที่ไม่ตรงกับที่เข้าสู่ระบบ
-    if logged_in_discord_user_id != discord_user_id_param:
+    if not logged_in_discord_user_id or logged_in_discord_user_id != discord_user_id_param:
         flash("❌ Discord User ID mismatch. Please login with Discord again.", "error")
         return redirect(url_for("index"))
 
-    auth_manager = SpotifyOAuth(
+    auth_manager = spotipy.SpotifyOAuth(
         client_id=SPOTIPY_CLIENT_ID,
         client_secret=SPOTIPY_CLIENT_SECRET,
         redirect_uri=SPOTIPY_REDIRECT_URI,
@@ -1049,205 +4934,263 @@ def spotify_callback():
         return redirect(url_for("index"))
 
     try:
-        auth_manager = SpotifyOAuth(
+        auth_manager = spotipy.SpotifyOAuth(
             client_id=SPOTIPY_CLIENT_ID,
             client_secret=SPOTIPY_CLIENT_SECRET,
             redirect_uri=SPOTIPY_REDIRECT_URI,
             scope=SPOTIPY_SCOPES,
         )
 
-        future = asyncio.run_coroutine_threadsafe(
-            asyncio.to_thread(auth_manager.get_access_token, code),
-            bot.loop
-        )
-        token_info = future.result(timeout=10)
+        token_info = _run_async(run_in_thread("spotify.get_access_token", auth_manager.get_access_token, code,
+                                              executor=executors["spotify"], priority="high"), timeout=10)
 
-        sp_user = spotipy.Spotify(auth_manager=auth_manager)
-        spotify_users[discord_user_id] = sp_user # เก็บ Spotify client ในแคช
+        # แจ้งทุกโปรเซสของบอทให้สร้าง Spotify client จากโทเค็นนี้
+        broadcast_control("spotify_linked", user_id=discord_user_id, token_info=token_info)
 
         # บันทึก Spotify token info ลง Firestore
-        asyncio.run_coroutine_threadsafe(
-            update_user_data_in_firestore(discord_user_id, spotify_token_info=token_info),
-            bot.loop
-        ).result() # รอให้การอัปเดต Firestore เสร็จสมบูรณ์
+        _run_async(update_user_data_in_firestore(discord_user_id, spotify_token_info=token_info)) # รอให้การอัปเดต Firestore เสร็จสมบูรณ์
 
         flash("✅ Spotify linked successfully!", "success")
         
     except Exception as e:
         flash(f"❌ Error linking Spotify: {e}. Please ensure your redirect URI is correct in Spotify Developer Dashboard.", "error")
-        logging.error(f"Spotify callback error for user {discord_user_id}: {e}", exc_info=True)
+        logging.error("Spotify callback error for user %s: %s", discord_user_id, e, exc_info=True)
     
     return redirect(url_for("index"))
 
 # --- Flask routes for controlling bot from web ---
+def _control_guild_id() -> int:
+    """guild ที่เว็บจะควบคุม: ระบุได้ด้วย ?guild_id= หากไม่ระบุจะใช้ GUILD_ID หลัก"""
+    return request.args.get("guild_id", type=int) or YOUR_GUILD_ID
+
+def _flash_control_result(result: dict):
+    """แสดงผลลัพธ์ของคำสั่งควบคุมให้ผู้ใช้เว็บ"""
+    if result.get("message"):
+        flash(result["message"], result.get("status", "info"))
+
 @app.route("/web_control/add", methods=["POST"])
 def add_web_queue():
     """เพิ่ม URL เพลงลงในคิวของบอท Discord (สำหรับ YouTube/SoundCloud)"""
     url = request.form.get("url")
     if url:
-        queue.append(url)
-        flash(f"Added to queue: {url}", "info")
-        logging.info(f"Added to queue from web: {url}")
+        _flash_control_result(dispatch_control("queue_add", _control_guild_id(), url=url))
     else:
         flash("No URL provided to add to queue.", "error")
     return redirect(url_for("index"))
 
+def _parse_bulk_urls(raw_urls) -> tuple:
+    """ตรวจสอบรายการ URL: คืนค่า (URL ที่ถูกต้องโดยไม่ซ้ำตามลำดับเดิม, [{"url", "error"}])"""
+    valid, invalid = [], []
+    for url in raw_urls:
+        url = str(url).strip()
+        if not url:
+            continue
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc:
+            invalid.append({"url": url, "error": "Not an http(s) URL"})
+        elif url not in valid:
+            valid.append(url)
+    return valid, invalid
+
+@app.route("/web_control/add_bulk", methods=["POST"])
+def add_bulk_web_queue():
+    """
+    เพิ่มหลาย URL ลงคิวในคำขอเดียว: JSON {"urls": [...]} (ตอบกลับเป็น JSON)
+    หรือฟอร์มที่มีช่อง urls (หนึ่ง URL ต่อบรรทัด) แล้วกลับไปหน้าแรก
+    """
+    if request.is_json:
+        raw_urls = (request.get_json(silent=True) or {}).get("urls") or []
+    else:
+        raw_urls = (request.form.get("urls") or "").splitlines()
+    if not isinstance(raw_urls, list):
+        raw_urls = []
+    urls, invalid = _parse_bulk_urls(raw_urls)
+    status_code = 200 # คำขอที่ถูกปฏิเสธก่อนส่งให้บอทได้ 4xx ส่วนผลจากบอท (รวมถึง error) ได้ 200
+    if len(urls) > BULK_ENQUEUE_MAX:
+        result = {"status": "error", "message": f"Too many URLs ({len(urls)}); the limit is {BULK_ENQUEUE_MAX}."}
+        status_code = 413
+    elif not urls:
+        result = {"status": "error", "message": "No valid URLs provided to add to queue."}
+        status_code = 400
+    else:
+        result = dispatch_control("queue_add_bulk", _control_guild_id(), urls=urls)
+    result["invalid"] = invalid
+    if request.is_json:
+        return jsonify(result), status_code
+    _flash_control_result(result)
+    return redirect(url_for("index"))
+
 @app.route("/web_control/play")
 def play_web_control():
     """สั่งให้บอทเริ่มเล่นเพลงถัดไปในคิว (สำหรับ YouTube/SoundCloud)"""
-    if not bot_ready.is_set():
-        flash("Bot is not ready yet. Please wait a moment.", "warning")
-        return redirect("/")
-
-    # ตรวจสอบว่าบอทอยู่ในช่องเสียงและไม่ได้กำลังเล่นอยู่
-    if voice_client and not voice_client.is_playing():
-        if voice_client.channel: # ตรวจสอบว่า channel object มีอยู่จริง
-            asyncio.run_coroutine_threadsafe(
-                _play_next_in_queue(bot.get_channel(voice_client.channel.id)),
-                bot.loop
-            )
-            flash("Attempting to play next in queue.", "info")
-            logging.info("Triggered play via web.")
-        else:
-            flash("Bot is in a voice channel but channel object is unavailable.", "error")
-    else:
-        flash("Bot is not in a voice channel or is already playing.", "warning")
+    _flash_control_result(dispatch_control("play", _control_guild_id()))
     return redirect("/")
 
 @app.route("/web_control/pause")
 def pause_web_control():
     """สั่งให้บอทหยุดเล่นเพลงชั่วคราว (สำหรับ YouTube/SoundCloud)"""
-    if voice_client and voice_client.is_playing():
-        voice_client.pause()
-        flash("Playback paused.", "info")
-        logging.info("Paused via web.")
-    else:
-        flash("Nothing to pause.", "warning")
+    _flash_control_result(dispatch_control("pause", _control_guild_id()))
     return redirect("/")
 
 @app.route("/web_control/resume")
 def resume_web_control():
     """สั่งให้บอทเล่นเพลงต่อจากที่หยุดไว้ (สำหรับ YouTube/SoundCloud)"""
-    if voice_client and voice_client.is_paused():
-        voice_client.resume()
-        flash("Playback resumed.", "info")
-        logging.info("Resumed via web.")
-    else:
-        flash("Nothing to resume.", "warning")
+    _flash_control_result(dispatch_control("resume", _control_guild_id()))
     return redirect("/")
 
 @app.route("/web_control/stop")
 def stop_web_control():
     """สั่งให้บอทหยุดเล่นเพลงและล้างคิวทั้งหมด (สำหรับ YouTube/SoundCloud)"""
-    global queue
-    queue.clear() 
-    if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
-        voice_client.stop() 
-        flash("Playback stopped and queue cleared.", "info")
-        logging.info("Stopped via web and cleared queue.")
-    else:
-        flash("Nothing to stop.", "warning")
+    _flash_control_result(dispatch_control("stop", _control_guild_id()))
     return redirect("/")
 
 @app.route("/web_control/skip")
 def skip_web_control():
     """สั่งให้ Spotify ข้ามเพลงปัจจุบัน"""
     current_session_id = session.get('session_id')
-    discord_user_id = web_logged_in_users.get(current_session_id)
+    discord_user_id = get_web_session_user(current_session_id)
     
     if not discord_user_id:
         flash("Please login with Discord first to control Spotify playback.", "error")
         return redirect("/")
 
-    sp_user = get_user_spotify_client(discord_user_id)
-    if not sp_user:
-        flash("Your Spotify is not linked or token expired. Please re-link.", "error")
-        return redirect("/")
-
-    try:
-        # ดำเนินการเรียก Spotify API ใน bot's event loop
-        asyncio.run_coroutine_threadsafe(
-            asyncio.to_thread(sp_user.next_track),
-            bot.loop
-        ).result()
-        flash("Spotify track skipped.", "info")
-        logging.info("Spotify track skipped via web.")
-    except spotipy.exceptions.SpotifyException as e:
-        flash(f"Error skipping Spotify track: {e}", "error")
-        logging.error(f"Error skipping Spotify track via web for user {discord_user_id}: {e}", exc_info=True)
-    except Exception as e:
-        flash(f"An unexpected error occurred while skipping: {e}", "error")
-        logging.error(f"Unexpected error skipping Spotify track via web for user {discord_user_id}: {e}", exc_info=True)
+    _flash_control_result(dispatch_control("spotify_skip", _control_guild_id(), user_id=discord_user_id))
     return redirect("/")
 
 @app.route("/web_control/previous")
 def prev_spotify_web_control():
     """สั่งให้ Spotify เล่นเพลงก่อนหน้า"""
     current_session_id = session.get('session_id')
-    discord_user_id = web_logged_in_users.get(current_session_id)
+    discord_user_id = get_web_session_user(current_session_id)
     
     if not discord_user_id:
         flash("Please login with Discord first to control Spotify playback.", "error")
         return redirect("/")
 
-    sp_user = get_user_spotify_client(discord_user_id)
-    if not sp_user:
-        flash("Your Spotify is not linked or token expired. Please re-link.", "error")
-        return redirect("/")
-
-    try:
-        # ดำเนินการเรียก Spotify API ใน bot's event loop
-        asyncio.run_coroutine_threadsafe(
-            asyncio.to_thread(sp_user.previous_track),
-            bot.loop
-        ).result()
-        flash("Spotify track changed to previous.", "info")
-        logging.info("Spotify track changed to previous via web.")
-    except spotipy.exceptions.SpotifyException as e:
-        flash(f"Error going to previous Spotify track: {e}", "error")
-        logging.error(f"Error going to previous Spotify track via web for user {discord_user_id}: {e}", exc_info=True)
-    except Exception as e:
-        flash(f"An unexpected error occurred while going to previous track: {e}", "error")
-        logging.error(f"Unexpected error going to previous Spotify track via web for user {discord_user_id}: {e}", exc_info=True)
+    _flash_control_result(dispatch_control("spotify_previous", _control_guild_id(), user_id=discord_user_id))
     return redirect("/")
 
 @app.route("/web_control/volume_up")
 def volume_up_web_control():
     """เพิ่มระดับเสียงของบอท Discord (สำหรับ YouTube/SoundCloud)"""
-    global volume
-    volume = min(volume + 0.1, 2.0) # ระดับเสียงสูงสุด 2.0 (200%)
-    if voice_client and voice_client.source: 
-        voice_client.source.volume = volume
-    flash(f"Volume increased to {volume*100:.0f}%", "info")
-    logging.info(f"Volume up: {volume}")
+    _flash_control_result(dispatch_control("volume_step", _control_guild_id(), step=0.1))
     return redirect("/")
 
 @app.route("/web_control/volume_down")
 def volume_down_web_control():
     """ลดระดับเสียงของบอท Discord (สำหรับ YouTube/SoundCloud)"""
-    global volume
-    volume = max(volume - 0.1, 0.1) # ระดับเสียงต่ำสุด 0.1 (10%) เพื่อไม่ให้เงียบสนิท
-    if voice_client and voice_client.source:
-        voice_client.source.volume = volume
-    flash(f"Volume decreased to {volume*100:.0f}%", "info")
-    logging.info(f"Volume down: {volume}")
+    _flash_control_result(dispatch_control("volume_step", _control_guild_id(), step=-0.1))
+    return redirect("/")
+
+@app.route("/web_control/seek")
+def seek_web_control():
+    """เลื่อนตำแหน่งเพลงในคิวที่กำลังเล่น ?position= (วินาที หรือ m:ss)"""
+    try:
+        position = parse_timestamp(request.args.get("position", ""))
+    except ValueError:
+        flash("Invalid seek position.", "error")
+        return redirect("/")
+    _flash_control_result(dispatch_control("seek", _control_guild_id(), position=position))
     return redirect("/")
 
+@app.route("/api/now_playing")
+def now_playing_api():
+    """สถานะและความคืบหน้าของเพลงในคิวที่กำลังเล่น (JSON สำหรับแถบความคืบหน้าบนหน้าเว็บ)"""
+    return jsonify(dispatch_control("now_playing", _control_guild_id()))
+
 # --- Run Flask + Discord bot ---
 def run_web():
     """ฟังก์ชันสำหรับรัน Flask web server ในเธรดแยก"""
+    if STATIC_ASSET_CACHE:
+        static_assets.load() # เตรียมไฟล์ static ก่อนรับ request แรก
     # Flask app ควรจะรันในเธรดของตัวเอง
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=False)
 
+def run_supervisor():
+    """
+    โหมด supervisor: รันเว็บในโปรเซสนี้ และสร้าง worker process ของบอทตาม SHARD_PROCESSES
+    แต่ละ worker ดูแล shard ของตัวเอง และรับคำสั่งจากเว็บผ่าน IPC
+    worker ที่หยุดทำงานจะถูกเริ่มใหม่อัตโนมัติ
+    """
+    global IPC_SECRET
+    # RUN_MODE=all: เว็บอยู่ในโปรเซสนี้ จึงสุ่ม secret ใช้ร่วมกับ worker ได้ (RUN_MODE=bot ถูกตรวจแล้วว่าตั้งค่าไว้)
+    IPC_SECRET = IPC_SECRET or os.urandom(16).hex()
+    workers = {}
+
+    def spawn_worker(worker_index: int):
+        env = dict(
+            os.environ,
+            WORKER_INDEX=str(worker_index),
+            SHARD_COUNT=str(SHARD_COUNT),
+            SHARD_PROCESSES=str(SHARD_PROCESSES),
+            IPC_SECRET=IPC_SECRET,
+        )
+        workers[worker_index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        logging.info("เริ่ม worker %s (pid %s) สำหรับ shards %s",
+                     worker_index, workers[worker_index].pid, _worker_shard_ids(worker_index))
+
+    for worker_index in range(SHARD_PROCESSES):
+        spawn_worker(worker_index)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+
+    # RUN_MODE=bot: เว็บรันแยก (เช่น gunicorn main:app ด้วย RUN_MODE=web) supervisor จึงดูแลแค่ worker
+    if RUN_MODE == "all":
+        threading.Thread(target=run_web, daemon=True).start()
+
+        # เว็บต้องการเฉพาะเซสชันของผู้ใช้ Spotify client อยู่ใน worker
+        _start_firebase_init()
+        asyncio.run_coroutine_threadsafe(load_all_user_data_from_firestore(include_spotify=False), _get_async_loop())
+
+    try:
+        while not stopping.wait(5):
+            for worker_index, process in list(workers.items()):
+                if process.poll() is not None:
+                    logging.warning("worker %s หยุดทำงาน (exit code %s) กำลังเริ่มใหม่", worker_index, process.returncode)
+                    spawn_worker(worker_index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
 if __name__ == "__main__":
     print("\n--- Initializing Bot and Web Server ---")
     print("Ensure FFmpeg and Opus are installed for voice functions.")
     print("---------------------------------------\n")
 
-    # เริ่ม Flask web server ในเธรดแยก
-    web_thread = threading.Thread(target=run_web)
-    web_thread.start()
+    ipc_problem = _ipc_secret_problem()
+    if ipc_problem:
+        logging.error("ไม่สามารถเริ่มทำงาน: %s", ipc_problem)
+        sys.exit(1)
+
+    if IS_SUPERVISOR:
+        run_supervisor()
+        sys.exit(0)
+
+    if IS_WEB_ONLY:
+        # สำหรับพัฒนาเท่านั้น ในการใช้งานจริงให้รัน `gunicorn -w <N> main:app` พร้อม RUN_MODE=web
+        _start_firebase_init()
+        run_web()
+        sys.exit(0)
+
+    # เริ่ม Flask web server ในเธรดแยก (worker process และ RUN_MODE=bot ไม่รันเว็บ)
+    if not IS_WORKER and RUN_MODE == "all":
+        # daemon: เมื่อบอทปิดตัวแล้ว (เช่นหลัง SIGTERM) โปรเซสจะจบได้โดยไม่ต้องรอเว็บ
+        web_thread = threading.Thread(target=run_web, daemon=True)
+        web_thread.start()
     
+    # เริ่มต้น Firebase ในพื้นหลังให้ทำงานพร้อมกับการเข้าสู่ระบบ Discord
+    _start_firebase_init()
+
     # รัน Discord bot (นี่เป็นการเรียกแบบบล็อก)
     # bot.run() ควรเป็นคำสั่งสุดท้ายใน main thread
-    bot.run(DISCORD_TOKEN)
+    _bot_run_started = time.perf_counter()
+    # log_handler=None: ใช้ pipeline แบบคิวที่ตั้งค่าไว้แล้ว แทน handler แบบ synchronous ของ discord.py
+    bot.run(DISCORD_TOKEN, log_handler=None)
@@ -95,8 +95,9 @@ const spotifyLoginLink = document.getElementById('spotifyLoginLink');
 
 
 // --- State Variables ---
-let currentPlaybackData = null; // Stores data from /api/now_playing_data
+let currentPlaybackData = null; // Stores the playback shown in the UI (derived from /api/state)
 let updateInterval;
+let serverClockOffsetMs = 0; // server time minus browser time, from the X-Server-Time-Ms header
 
 
 // --- Utility Functions ---
@@ -138,17 +139,31 @@ async function fetchAuthStatus() {
     }
 }
 
+// Converts one side of the /api/state snapshot into the shape updateNowPlayingUI expects.
+// While playing the server sends started_at_ms (so the snapshot and its ETag stay stable); progress is derived here.
+function playbackFromState(playback, extra = {}) {
+    const progressMs = playback.started_at_ms !== undefined
+        ? Date.now() + serverClockOffsetMs - playback.started_at_ms
+        : (playback.progress_ms || 0);
+    return { ...playback, ...extra, is_paused: !!playback.is_paused, progress_ms: progressMs };
+}
+
 async function fetchNowPlayingAndQueue() {
     try {
-        const nowPlayingResponse = await fetch(urls.getNowPlayingData);
-        if (!nowPlayingResponse.ok) throw new Error(`HTTP error! status: ${nowPlayingResponse.status}`);
-        currentPlaybackData = await nowPlayingResponse.json();
+        // The browser revalidates with If-None-Match (Cache-Control: no-cache), so unchanged polls are a 304
+        const stateResponse = await fetch(urls.getState);
+        if (!stateResponse.ok) throw new Error(`HTTP error! status: ${stateResponse.status}`);
+        const serverTime = Number(stateResponse.headers.get('X-Server-Time-Ms'));
+        if (serverTime) serverClockOffsetMs = serverTime - Date.now();
+        const state = await stateResponse.json();
+
+        // Prefer the user's Spotify playback when it is active, otherwise the bot's queue player
+        const spotify = state.spotify;
+        currentPlaybackData = spotify && spotify.is_playing
+            ? playbackFromState(spotify)
+            : playbackFromState(state.player, { status: "ok" });
         updateNowPlayingUI(currentPlaybackData);
-
-        const queueResponse = await fetch(urls.getQueueData);
-        if (!queueResponse.ok) throw new Error(`HTTP error! status: ${queueResponse.status}`);
-        const queueData = await queueResponse.json();
-        updateQueueUI(queueData.queue);
+        updateQueueUI(state.player.queue);
 
     } catch (error) {
         console.error('Error fetching now playing or queue data from Flask:', error);
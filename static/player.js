@@ -0,0 +1,97 @@
+// สคริปต์ของหน้า index.html (โหลดแบบ defer) URL ของ API มาจาก data-* ของแท็ก <script>
+const pageUrls = document.currentScript.dataset;
+
+// Initialize Lucide icons
+lucide.createIcons();
+
+// Optional: JavaScript for fade-out flash messages
+document.addEventListener('DOMContentLoaded', () => {
+    const flashMessages = document.querySelectorAll('.flash-message');
+    flashMessages.forEach(msg => {
+        setTimeout(() => {
+            msg.style.opacity = '0';
+            setTimeout(() => msg.remove(), 500); // Remove after fade out
+        }, 5000); // Messages disappear after 5 seconds
+    });
+
+    // ความคืบหน้าของเพลงในคิวบอท: ดึงตำแหน่งจากเซิร์ฟเวอร์เป็นระยะ แล้วนับต่อในเบราว์เซอร์ระหว่างรอบ
+    const progressBar = document.getElementById('queueProgressBar');
+    const elapsedSpan = document.getElementById('queueElapsed');
+    const durationSpan = document.getElementById('queueDuration');
+    const titleSpan = document.getElementById('queueTitle');
+    let progress = null;
+    let serverClockOffsetMs = 0;
+
+    const formatTime = (ms) => {
+        const total = Math.max(0, Math.floor(ms / 1000));
+        const minutes = Math.floor(total / 60);
+        const seconds = total % 60;
+        return `${minutes}:${seconds < 10 ? '0' : ''}${seconds}`;
+    };
+
+    const renderProgress = () => {
+        if (!progress || !(progress.is_playing || progress.is_paused)) {
+            progressBar.style.width = '0%';
+            elapsedSpan.textContent = '0:00';
+            durationSpan.textContent = '0:00';
+            titleSpan.textContent = '';
+            return;
+        }
+        // ระหว่างเล่น เซิร์ฟเวอร์ส่งเวลาที่เริ่มเพลง (snapshot จึงไม่เปลี่ยนและได้ 304) จึงคำนวณตำแหน่งเอง
+        let elapsed = progress.started_at_ms !== undefined
+            ? Date.now() + serverClockOffsetMs - progress.started_at_ms
+            : (progress.progress_ms || 0);
+        if (progress.duration_ms) {
+            elapsed = Math.min(elapsed, progress.duration_ms);
+            progressBar.style.width = `${(elapsed / progress.duration_ms) * 100}%`;
+            durationSpan.textContent = formatTime(progress.duration_ms);
+        } else {
+            progressBar.style.width = '0%';
+            durationSpan.textContent = '--:--';
+        }
+        elapsedSpan.textContent = formatTime(elapsed);
+        titleSpan.textContent = progress.title || '';
+    };
+
+    const fetchProgress = async () => {
+        try {
+            // เบราว์เซอร์ส่ง If-None-Match ให้เอง (Cache-Control: no-cache) poll ที่ไม่มีอะไรเปลี่ยนจะได้ 304
+            const response = await fetch(pageUrls.stateUrl);
+            if (!response.ok) return;
+            const serverTime = Number(response.headers.get('X-Server-Time-Ms'));
+            if (serverTime) serverClockOffsetMs = serverTime - Date.now();
+            progress = (await response.json()).player;
+        } catch (error) {
+            console.error('Error fetching now playing progress:', error);
+        }
+    };
+
+    fetchProgress();
+    setInterval(fetchProgress, 5000);
+    setInterval(renderProgress, 500);
+
+    // HTML ของหน้าถูกแคชร่วมกันทุกผู้ใช้ จึงเติม Discord User ID ของเซสชันนี้ภายหลัง
+    const discordUserIdSpan = document.getElementById('discordUserId');
+    if (discordUserIdSpan) {
+        fetch(pageUrls.discordUserIdUrl)
+            .then(response => response.json())
+            .then(data => {
+                if (data.discord_user_id) discordUserIdSpan.textContent = ` (ID: ${data.discord_user_id})`;
+            })
+            .catch(error => console.error('Error fetching Discord user ID:', error));
+    }
+
+    // Placeholder for Spotify Playback status (not connected to bot's real-time status yet)
+    const spotifyPlayBtn = document.getElementById('spotify_play_btn');
+    const spotifyPauseBtn = document.getElementById('spotify_pause_btn');
+
+    // Example of how you *would* toggle if you had real-time status:
+    // let isSpotifyPlaying = false; // This would come from your backend API
+    // if (isSpotifyPlaying) {
+    //     spotifyPlayBtn.classList.add('hidden');
+    //     spotifyPauseBtn.classList.remove('hidden');
+    // } else {
+    //     spotifyPlayBtn.classList.remove('hidden');
+    //     spotifyPauseBtn.classList.add('hidden');
+    // }
+});